@@ -1,5 +1,10 @@
 """Stored results of offline content targeting analysis."""
 
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.cache import caches
 from django.db import models
 from django.utils.translation import gettext_lazy as _
 from django_extensions.db.models import TimeStampedModel
@@ -74,6 +79,13 @@ class BaseAnalyzedUrl(TimeStampedModel):
 class AnalyzedUrl(BaseAnalyzedUrl):
     """Analyzed keywords for a given URL."""
 
+    # Keywords are looked up on most ad decisions but only change when a URL is analyzed
+    # They're cached briefly on each worker and for longer in the shared cache.
+    # Saving an analyzed URL writes its keywords through to both caches.
+    KEYWORDS_CACHE_KEY_PREFIX = "analyzed-url-keywords"
+    KEYWORDS_CACHE_TIMEOUT = 60 * 60 * 24
+    KEYWORDS_LOCAL_CACHE_TIMEOUT = 60
+
     publisher = models.ForeignKey(
         Publisher,
         help_text=_("Publisher where this URL appears"),
@@ -98,6 +110,55 @@ class AnalyzedUrl(BaseAnalyzedUrl):
     class Meta:
         unique_together = ("url", "publisher")
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self.cache_keywords()
+
+    @classmethod
+    def keywords_cache_key(cls, url, publisher_id):
+        url_hash = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return f"{cls.KEYWORDS_CACHE_KEY_PREFIX}::{publisher_id}::{url_hash}"
+
+    @classmethod
+    def get_keywords(cls, url, publisher):
+        """
+        Get the analyzed keywords for a URL on a publisher's site.
+
+        URLs that haven't been analyzed are cached too (as having no keywords).
+
+        :returns: a list of keywords or ``None`` if there are none
+        """
+        url = normalize_url(url)
+        cache_key = cls.keywords_cache_key(url, publisher.pk)
+
+        local_cache = caches[settings.CACHE_LOCAL_ALIAS]
+        keywords = local_cache.get(cache_key)
+        if keywords is None:
+            keywords = cache.get(cache_key)
+            if keywords is None:
+                analyzed_url = (
+                    cls.objects.filter(url=url, publisher=publisher)
+                    .only("keywords")
+                    .first()
+                )
+                keywords = (analyzed_url and analyzed_url.keywords) or []
+                cache.set(cache_key, keywords, timeout=cls.KEYWORDS_CACHE_TIMEOUT)
+
+            local_cache.set(
+                cache_key, keywords, timeout=cls.KEYWORDS_LOCAL_CACHE_TIMEOUT
+            )
+
+        return keywords or None
+
+    def cache_keywords(self):
+        """Write this URL's keywords through to the caches used by ad decisions."""
+        cache_key = self.keywords_cache_key(self.url, self.publisher_id)
+        keywords = self.keywords or []
+        cache.set(cache_key, keywords, timeout=self.KEYWORDS_CACHE_TIMEOUT)
+        caches[settings.CACHE_LOCAL_ALIAS].set(
+            cache_key, keywords, timeout=self.KEYWORDS_LOCAL_CACHE_TIMEOUT
+        )
+
 
 class AnalyzedAdvertiserUrl(BaseAnalyzedUrl):
     """Analyzed keywords for a given URL."""
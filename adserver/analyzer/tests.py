@@ -4,7 +4,10 @@ import io
 import pytest
 import requests
 import responses
+from django.conf import settings
 from django.core import management
+from django.core.cache import cache
+from django.core.cache import caches
 from django.core.exceptions import ValidationError
 from django.test import TestCase
 from django.utils import timezone
@@ -94,6 +97,10 @@ class TestUtils(TestCase):
 
 class TestModels(TestCase):
     def setUp(self):
+        # Analyzed keywords are written through to the caches
+        self.addCleanup(cache.clear)
+        self.addCleanup(caches[settings.CACHE_LOCAL_ALIAS].clear)
+
         self.publisher = get(Publisher)
         self.analyzed_url = AnalyzedUrl.objects.create(
             url="https://example.com",
@@ -109,6 +116,42 @@ class TestModels(TestCase):
         with self.assertRaises(ValidationError):
             self.analyzed_url.save()
 
+    def test_get_keywords(self):
+        url = "https://example.com?utm_source=test"
+
+        # Saving wrote the keywords through to the cache
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                AnalyzedUrl.get_keywords(url, self.publisher), ["python", "django"]
+            )
+
+        # Updates are written through
+        self.analyzed_url.keywords = ["rust"]
+        self.analyzed_url.save()
+        self.assertEqual(AnalyzedUrl.get_keywords(url, self.publisher), ["rust"])
+
+        # Cached in the local and shared caches after one query
+        cache.clear()
+        caches[settings.CACHE_LOCAL_ALIAS].clear()
+        with self.assertNumQueries(1):
+            AnalyzedUrl.get_keywords(url, self.publisher)
+            AnalyzedUrl.get_keywords(url, self.publisher)
+        caches[settings.CACHE_LOCAL_ALIAS].clear()
+        with self.assertNumQueries(0):
+            self.assertEqual(AnalyzedUrl.get_keywords(url, self.publisher), ["rust"])
+
+        # URLs that aren't analyzed are cached too
+        url2 = "https://example.com/unanalyzed/"
+        with self.assertNumQueries(1):
+            self.assertIsNone(AnalyzedUrl.get_keywords(url2, self.publisher))
+            self.assertIsNone(AnalyzedUrl.get_keywords(url2, self.publisher))
+
+        # Until they're analyzed
+        AnalyzedUrl.objects.create(
+            url=url2, publisher=self.publisher, keywords=["python"]
+        )
+        self.assertEqual(AnalyzedUrl.get_keywords(url2, self.publisher), ["python"])
+
 
 class TestNaiveAnalyzer(TestCase):
     def setUp(self):
@@ -276,6 +319,10 @@ class TestTasks(BaseAdModelsTestCase):
     def setUp(self):
         super().setUp()
 
+        # Analyzed keywords are written through to the caches
+        self.addCleanup(cache.clear)
+        self.addCleanup(caches[settings.CACHE_LOCAL_ALIAS].clear)
+
         self.url = "https://example.com"
         self.analyzed_url = AnalyzedUrl.objects.create(
             url=self.url,
@@ -312,6 +359,12 @@ class TestTasks(BaseAdModelsTestCase):
         self.assertEqual(self.analyzed_url.keywords, ["backend"])
         self.assertEqual(self.analyzed_url.visits_since_last_analyzed, 0)
 
+        # The new keywords are used for ad decisions right away
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                AnalyzedUrl.get_keywords(self.url, self.publisher), ["backend"]
+            )
+
     def test_daily_visited_urls_aggregation(self):
         url2 = "https://example.com/path/"
         yesterday = timezone.now() - datetime.timedelta(days=1)
@@ -9,6 +9,9 @@ from django.utils.translation import gettext_lazy as _
 from rest_framework import serializers
 
 from ..constants import ALL_CAMPAIGN_TYPES
+from ..constants import DEDUPLICATE_ADVERTISER
+from ..constants import DEDUPLICATE_OPTIONS
+from ..decisionengine.publisher import get_publisher_decision_context
 from ..models import Advertisement
 from ..models import Advertiser
 from ..models import Flight
@@ -105,14 +108,14 @@ class AdDecisionSerializer(serializers.Serializer):
         return campaign_types
 
     def validate_publisher(self, publisher_slug):
-        # Resolve the publisher slug into the actual Publisher
-        publisher = Publisher.objects.filter(slug=publisher_slug).first()
-        if not publisher:
+        # Resolve the publisher slug into the (cached) publisher decision context
+        publisher_context = get_publisher_decision_context(publisher_slug)
+        if not publisher_context:
             raise serializers.ValidationError("Invalid publisher")
-        if publisher.disabled:
+        if publisher_context.publisher.disabled:
             raise serializers.ValidationError("Disabled publisher")
 
-        return publisher
+        return publisher_context
 
     def validate_keywords(self, keywords):
         # API users may send more than this, but keywords beyond this are ignored
@@ -149,6 +152,34 @@ class AdDecisionSerializer(serializers.Serializer):
 
         return ip
 
+    def validate(self, data):
+        # Return the actual Publisher along with its decision context
+        publisher_context = data["publisher"]
+        data["publisher"] = publisher_context.publisher
+        data["publisher_context"] = publisher_context
+        return data
+
+
+class AdBatchDecisionSerializer(AdDecisionSerializer):
+    """De-serializes incoming requests for multiple ads (one per placement)."""
+
+    # The most placements that can be filled by a single request
+    MAX_PLACEMENTS = 10
+
+    # Whether ads are unique per advertiser (the default) or per flight
+    deduplicate = serializers.ChoiceField(
+        choices=DEDUPLICATE_OPTIONS, default=DEDUPLICATE_ADVERTISER, required=False
+    )
+
+    def validate_placements(self, placements):
+        placements = super().validate_placements(placements)
+        if len(placements) > self.MAX_PLACEMENTS:
+            raise serializers.ValidationError(
+                f"At most {self.MAX_PLACEMENTS} placements are allowed"
+            )
+
+        return placements
+
 
 class PublisherSerializer(serializers.HyperlinkedModelSerializer):
     class Meta:
@@ -4,9 +4,11 @@ from django.conf import settings
 from django.urls import path
 from rest_framework import routers
 
+from .views import AdBatchDecisionView
 from .views import AdDecisionView
 from .views import AdvertisementViewSet
 from .views import AdvertiserViewSet
+from .views import AsyncAdDecisionView
 from .views import FlightViewSet
 from .views import PublisherViewSet
 
@@ -15,6 +17,8 @@ app_name = "api"
 
 urlpatterns = [
     path(r"decision/", AdDecisionView.as_view(), name="decision"),
+    path(r"decision/batch/", AdBatchDecisionView.as_view(), name="decision-batch"),
+    path(r"decision/async/", AsyncAdDecisionView.as_view(), name="decision-async"),
     # The flight/advertisement API paths match the URL structure of the advertiser dashboard.
     # These viewsets are wired manually because they're nested under the advertiser
     # which the router can't do: any extra @actions on them must also be added here.
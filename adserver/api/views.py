@@ -3,9 +3,14 @@
 import logging
 from datetime import timedelta
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.core.cache import cache
+from django.db import close_old_connections
+from django.db import connection
+from django.db import transaction
 from django.utils import timezone
+from django.utils.decorators import classonlymethod
 from rest_framework import status
 from rest_framework import viewsets
 from rest_framework.decorators import action
@@ -16,6 +21,17 @@ from rest_framework_jsonp.renderers import JSONPRenderer
 
 from ..constants import PAID_CAMPAIGN
 from ..decisionengine import get_ad_decision_backend
+from ..decisionengine.deadline import DecisionDeadlineExceeded
+from ..decisionengine.deadline import NullDecisionDeadline
+from ..decisionengine.deadline import get_decision_deadline
+from ..decisionengine.shadow import ShadowDecision
+from ..decisionengine.shadow import get_shadow_backend
+from ..decisionengine.shadow import schedule_shadow_decision
+from ..decisionengine.shadow import should_shadow_decision
+from ..decisionengine.trace import TRACE_HEADER
+from ..decisionengine.trace import DecisionTrace
+from ..decisionengine.trace import NullDecisionTrace
+from ..decisionengine.trace import should_trace_decision
 from ..models import AdImpression
 from ..models import Advertisement
 from ..models import Advertiser
@@ -30,6 +46,7 @@ from ..utils import get_client_id
 from ..utils import parse_date_string
 from .mixins import GeoIpMixin
 from .permissions import AdDecisionPermission
+from .serializers import AdBatchDecisionSerializer
 from .serializers import AdDecisionSerializer
 from .serializers import AdvertisementSerializer
 from .serializers import AdvertiserSerializer
@@ -159,6 +176,26 @@ class AdDecisionView(GeoIpMixin, APIView):
 
     permission_classes = (AdDecisionPermission,)
     renderer_classes = (JSONRenderer, JSONPRenderer)
+    serializer_class = AdDecisionSerializer
+
+    # Whether the same client can be shown the same ad for a short time
+    # See ``Publisher.cache_ads`` and ``ADSERVER_STICKY_DECISION_DURATION``
+    sticky_decisions = True
+
+    # Replaced by a ``DecisionTrace`` when this decision is traced
+    trace = NullDecisionTrace()
+
+    # Whether the backend runs slow lookups (embeddings) in a thread pool
+    concurrent_lookups = False
+
+    # Whether a sample of decisions are compared against the shadow backend
+    shadow_decisions = True
+
+    # Replaced by a ``ShadowDecision`` when this decision is also made by the shadow backend
+    shadow = None
+
+    # Replaced by a ``DecisionDeadline`` when decisions have a time budget
+    deadline = NullDecisionDeadline()
 
     def _prepare_response(
         self,
@@ -185,7 +222,7 @@ class AdDecisionView(GeoIpMixin, APIView):
 
         # Check if this client should get a sticky ad decision
         data = None
-        if publisher.cache_ads and ad_type_slug:
+        if self.sticky_decisions and publisher.cache_ads and ad_type_slug:
             cache_key = self._sticky_decision_cache_key(publisher, ad_type_slug)
             data = cache.get(cache_key)
 
@@ -203,17 +240,18 @@ class AdDecisionView(GeoIpMixin, APIView):
                 )
                 return {}
 
-            data = ad.offer_ad(
-                request=self.request,
-                publisher=publisher,
-                ad_type_slug=ad_type_slug,
-                div_id=div_id,
-                keywords=keywords,
-                url=url,
-                forced=forced,
-                paid_eligible=paid_eligible,
-                rotations=rotations,
-            )
+            with self.trace.stage("offer_ad"):
+                data = ad.offer_ad(
+                    request=self.request,
+                    publisher=publisher,
+                    ad_type_slug=ad_type_slug,
+                    div_id=div_id,
+                    keywords=keywords,
+                    url=url,
+                    forced=forced,
+                    paid_eligible=paid_eligible,
+                    rotations=rotations,
+                )
             log.debug(
                 "Offering ad. publisher=%s ad_type=%s div_id=%s keywords=%s",
                 publisher,
@@ -221,7 +259,7 @@ class AdDecisionView(GeoIpMixin, APIView):
                 div_id,
                 keywords,
             )
-            if publisher.cache_ads:
+            if self.sticky_decisions and publisher.cache_ads:
                 duration = (
                     publisher.cache_ads_duration
                     or settings.ADSERVER_STICKY_DECISION_DURATION
@@ -237,6 +275,9 @@ class AdDecisionView(GeoIpMixin, APIView):
                 referrer,
             )
 
+        if self.trace:
+            self.trace.ads.append(data.get("id"))
+
         # The div where the ad is chosen to go is echoed back to the client
         data.update({"div_id": div_id})
         return data
@@ -296,7 +337,9 @@ class AdDecisionView(GeoIpMixin, APIView):
         :param data: data needed for the decision (query params, post data, etc.)
         :return: An add decision (JSON) or an empty JSON dict
         """
-        serializer = AdDecisionSerializer(data=data)
+        # The time budget includes validating the request (eg. looking up the publisher)
+        self.deadline = get_decision_deadline()
+        serializer = self.serializer_class(data=data)
 
         if serializer.is_valid():
             publisher = serializer.validated_data["publisher"]
@@ -333,29 +376,49 @@ class AdDecisionView(GeoIpMixin, APIView):
             ):
                 paid_eligible = True
 
-            backend = get_ad_decision_backend()(
+            if should_trace_decision(request):
+                self.trace = DecisionTrace(
+                    publisher=publisher.slug,
+                    url=url,
+                    country=request.geo.country,
+                    placements=len(serializer.validated_data["placements"]),
+                    campaign_types=campaign_types,
+                    forced=forced,
+                )
+
+            backend_kwargs = {
                 # Required parameters
-                request=request,
-                placements=serializer.validated_data["placements"],
-                publisher=publisher,
+                "request": request,
+                "placements": serializer.validated_data["placements"],
+                "publisher": publisher,
                 # Optional parameters
-                keywords=keywords,
-                campaign_types=campaign_types,
-                url=url,
-                placement_index=serializer.validated_data.get("placement_index"),
+                "publisher_context": serializer.validated_data["publisher_context"],
+                "keywords": keywords,
+                "campaign_types": campaign_types,
+                "url": url,
+                "placement_index": serializer.validated_data.get("placement_index"),
                 # Debugging parameters
-                ad_slug=serializer.validated_data.get("force_ad"),
-                campaign_slug=serializer.validated_data.get("force_campaign"),
+                "ad_slug": serializer.validated_data.get("force_ad"),
+                "campaign_slug": serializer.validated_data.get("force_campaign"),
+            }
+            backend = get_ad_decision_backend()(
+                trace=self.trace,
+                concurrent_lookups=self.concurrent_lookups,
+                deadline=self.deadline,
+                **backend_kwargs,
             )
-            ad, placement = backend.get_ad_and_placement()
 
-            return Response(
-                self._prepare_response(
-                    ad=ad,
-                    placement=placement,
+            if self.shadow_decisions and not forced and should_shadow_decision():
+                self.shadow = ShadowDecision(get_shadow_backend(), **backend_kwargs)
+            if self.trace:
+                # The combined publisher/user/analyzer keywords
+                self.trace.context["keywords"] = backend.keywords
+
+            response = Response(
+                self.make_decision(
+                    backend,
+                    serializer.validated_data,
                     publisher=publisher,
-                    # We need backend.keywords here to get the combined publisher/user/analyzer keywords
-                    keywords=backend.keywords,
                     url=url,
                     forced=forced,
                     paid_eligible=paid_eligible,
@@ -363,8 +426,173 @@ class AdDecisionView(GeoIpMixin, APIView):
                 )
             )
 
+            if self.trace:
+                if self.deadline.degradations:
+                    self.trace.context["degraded"] = list(self.deadline.degradations)
+                self.trace.finish()
+                if request.user.is_staff:
+                    response[TRACE_HEADER] = self.trace.id
+
+            if self.shadow:
+                schedule_shadow_decision(self.shadow)
+
+            return response
+
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+    def make_decision(self, backend, validated_data, **kwargs):
+        """
+        Choose an ad with the decision backend and offer it.
+
+        :param backend: the decision backend for this request
+        :param validated_data: the validated decision request data
+        :param kwargs: additional arguments passed to ``_prepare_response``
+        :return: the ad decision data (an empty dict if there's no ad)
+        """
+        try:
+            if self.shadow:
+                ad, placement = self.shadow.run_primary(backend)
+            else:
+                ad, placement = backend.get_ad_and_placement()
+        except DecisionDeadlineExceeded:
+            ad, placement = backend.get_fallback_ad_and_placement()
+
+        return self._prepare_response(
+            ad=ad,
+            placement=placement,
+            # We need backend.keywords here to get the combined publisher/user/analyzer keywords
+            keywords=backend.keywords,
+            **kwargs,
+        )
+
+
+class AdBatchDecisionView(AdDecisionView):
+    """
+    Make decisions on multiple `Advertisement` to show on the same page.
+
+    Rather than making a separate decision request for each ad on a page,
+    this fills each placement with a different ad in a single request.
+    Only publishers allowed to have multiple placements per page
+    get more than the first placement filled.
+
+    .. http:get:: /api/v1/decision/batch/
+
+        Request an advertisement for each placement on a page.
+
+        The parameters are the same as the single ad decision API except:
+
+        :<json string div_ids: A ``|`` delimited string of on-page ids.
+            Each div ID is a separate placement that gets a different ad.
+        :<json string deduplicate: Whether ads in the different placements
+            must be from different advertisers (``advertiser``, the default)
+            or only from different flights (``flight``).
+
+        :>json array decisions: An array of ad decisions for the filled placements.
+            Each decision has the same fields as the single ad decision API
+            and the ``div_id`` of the placement it fills.
+            Placements that couldn't be filled are not included.
+
+        An example::
+
+            {
+                "ad_types": "image-v1|image-v1",
+                "div_ids": "sidebar-div|footer-div"
+            }
+
+    .. http:post:: /api/v1/decision/batch/
+
+        As with the single ad decision API, authentication is required.
+        Each of the ``placements`` is a separate placement that gets a different ad.
+        At most 10 placements can be filled in a single request.
+    """
+
+    serializer_class = AdBatchDecisionSerializer
+
+    # Sticky decisions are per ad type and would show the same ad in multiple placements
+    sticky_decisions = False
+
+    # The shadow backend is only compared on single ad decisions
+    shadow_decisions = False
+
+    def make_decision(self, backend, validated_data, **kwargs):
+        try:
+            ads_and_placements = backend.get_ads_and_placements(
+                deduplicate=validated_data["deduplicate"]
+            )
+        except DecisionDeadlineExceeded:
+            ads_and_placements = backend.get_fallback_ads_and_placements()
+
+        decisions = []
+        for ad, placement in ads_and_placements:
+            data = self._prepare_response(
+                ad=ad,
+                placement=placement,
+                keywords=backend.keywords,
+                **kwargs,
+            )
+            if data:
+                decisions.append(data)
+
+        return {"decisions": decisions}
+
+
+class AsyncAdDecisionView(AdDecisionView):
+    """
+    An async variant of the ad decision API for running under ASGI.
+
+    Django REST Framework views are synchronous and under ASGI Django runs
+    all synchronous views in a single thread, one request at a time.
+    This view instead runs each decision in a thread pool
+    so many decisions can wait on I/O (the database, cache and embeddings) at once.
+    Embedding lookups also run concurrently with choosing the candidate flights.
+
+    .. http:get:: /api/v1/decision/async/
+
+        The same parameters and response as ``/api/v1/decision/``.
+    """
+
+    concurrent_lookups = True
+
+    # Run decisions in a shared thread pool rather than Django's single sync thread.
+    # Thread sensitive decisions run in the same thread (and connection) as the caller
+    thread_sensitive = False
+
+    @classonlymethod
+    def as_view(cls, **initkwargs):
+        sync_view = view = super().as_view(**initkwargs)
+        if connection.settings_dict["ATOMIC_REQUESTS"]:
+            view = transaction.atomic(sync_view)
+
+        def run_decision(request, *args, **kwargs):
+            response = view(request, *args, **kwargs)
+            # Render in this thread rather than in Django's single sync thread
+            response.render()
+            return response
+
+        def run_pooled_decision(request, *args, **kwargs):
+            # Pooled threads don't get request started/finished signals
+            # so manage database connections the way a request would
+            close_old_connections()
+            try:
+                return run_decision(request, *args, **kwargs)
+            finally:
+                close_old_connections()
+
+        # Django can't wrap async views in a transaction (ATOMIC_REQUESTS)
+        # so the decision's transaction is started in the decision's thread instead
+        @transaction.non_atomic_requests
+        async def async_view(request, *args, **kwargs):
+            if cls.thread_sensitive:
+                func = sync_to_async(run_decision, thread_sensitive=True)
+            else:
+                func = sync_to_async(run_pooled_decision, thread_sensitive=False)
+            return await func(request, *args, **kwargs)
+
+        async_view.csrf_exempt = sync_view.csrf_exempt
+        async_view.cls = sync_view.cls
+        async_view.initkwargs = sync_view.initkwargs
+        return async_view
+
 
 class AdvertiserViewSet(viewsets.ReadOnlyModelViewSet):
     """
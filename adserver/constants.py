@@ -29,6 +29,15 @@ CAMPAIGN_TYPES = (
     (PUBLISHER_HOUSE_CAMPAIGN, _("Publisher House")),
     (HOUSE_CAMPAIGN, _("House")),
 )
+
+# Batch ad decisions never show ads from the same advertiser (or flight) twice
+DEDUPLICATE_ADVERTISER = "advertiser"
+DEDUPLICATE_FLIGHT = "flight"
+DEDUPLICATE_OPTIONS = (
+    (DEDUPLICATE_ADVERTISER, _("Advertiser")),
+    (DEDUPLICATE_FLIGHT, _("Flight")),
+)
+
 FLIGHT_STATE_CURRENT = _("Current")
 FLIGHT_STATE_UPCOMING = _("Upcoming")
 FLIGHT_STATE_PAST = _("Past")
@@ -0,0 +1,172 @@
+"""
+Counters that are buffered in Redis and added to the database in batches.
+
+Counts are kept in Redis hashes (``HINCRBY``) when the default cache is django-redis
+and the hashes with counts are tracked in a set so a flush only reads those.
+A flush atomically reads and deletes a batch of hashes at a time
+and counts that fail to write are put back to be retried.
+Without Redis, counts are kept in a per-process counter which is only suitable
+for development and testing since counts in it are lost when the process exits.
+"""
+
+import collections
+import logging
+import threading
+
+from django.core.cache import cache
+
+
+log = logging.getLogger(__name__)  # noqa
+
+
+def get_redis_client():
+    """Get the Redis client for the default cache or ``None`` if it isn't django-redis."""
+    try:
+        from django_redis import get_redis_connection  # noqa
+
+        return get_redis_connection("default")
+    except (ImportError, NotImplementedError):
+        return None
+
+
+def decode(value):
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+class HashCounters:
+    """
+    Counts by hash key and field.
+
+    Counts are passed around as dictionaries of ``(key, field) -> count``
+    so the caller decides what its keys and fields mean.
+    """
+
+    def __init__(self, key_prefix, timeout):
+        """
+        Set up a group of counters.
+
+        :param key_prefix: the cache key prefix of the hashes
+            (the set of hashes with counts is ``<key_prefix>-dirty``)
+        :param timeout: seconds before a hash that's never flushed expires
+        """
+        self.key_prefix = key_prefix
+        self.dirty_key = f"{key_prefix}-dirty"
+        self.timeout = timeout
+
+        # (Key, field) -> count when the cache isn't Redis
+        self._local_counts = collections.Counter()
+        self._local_lock = threading.Lock()
+
+    def incr(self, key, counts):
+        """
+        Add to the counts in a hash.
+
+        :param counts: a dictionary of field -> count (negative to subtract)
+        """
+        client = get_redis_client()
+        if client:
+            pipeline = client.pipeline(transaction=False)
+            for field, count in counts.items():
+                pipeline.hincrby(cache.make_key(key), field, count)
+            pipeline.expire(cache.make_key(key), self.timeout)
+            pipeline.sadd(cache.make_key(self.dirty_key), key)
+            pipeline.execute()
+            return
+
+        with self._local_lock:
+            for field, count in counts.items():
+                self._local_counts[(key, field)] += count
+
+    def get(self, keys):
+        """
+        Get the counts that haven't been flushed yet without taking them.
+
+        :returns: a list of dictionaries of field -> count (one for each key)
+        """
+        client = get_redis_client()
+        if client:
+            pipeline = client.pipeline(transaction=False)
+            for key in keys:
+                pipeline.hgetall(cache.make_key(key))
+            return [
+                {decode(field): int(count) for field, count in values.items()}
+                for values in pipeline.execute()
+            ]
+
+        values = {key: {} for key in keys}
+        with self._local_lock:
+            for (key, field), count in self._local_counts.items():
+                if key in values:
+                    values[key][field] = count
+        return [values[key] for key in keys]
+
+    def take(self, batch_size):
+        """
+        Atomically read and delete a batch of hashes.
+
+        :returns: a 2-tuple of the counts and the number of hashes read
+            (``None`` without Redis where all the counts are taken at once)
+        """
+        client = get_redis_client()
+        if not client:
+            with self._local_lock:
+                counts = collections.Counter(self._local_counts)
+                self._local_counts.clear()
+            return counts, None
+
+        keys = [
+            decode(key)
+            for key in client.spop(cache.make_key(self.dirty_key), batch_size) or []
+        ]
+
+        counts = collections.Counter()
+        if not keys:
+            return counts, 0
+
+        pipeline = client.pipeline(transaction=True)
+        for key in keys:
+            pipeline.hgetall(cache.make_key(key))
+            pipeline.delete(cache.make_key(key))
+        results = pipeline.execute()
+
+        for key, values in zip(keys, results[::2]):
+            for field, count in values.items():
+                counts[(key, decode(field))] += int(count)
+        return counts, len(keys)
+
+    def restore(self, counts):
+        """Put back counts that were taken but couldn't be written."""
+        fields = collections.defaultdict(dict)
+        for (key, field), count in counts.items():
+            fields[key][field] = count
+        for key, key_counts in fields.items():
+            self.incr(key, key_counts)
+
+    def flush(self, write, batch_size):
+        """
+        Take all the counts a batch at a time and write them.
+
+        :param write: a function that writes a batch of counts
+            and returns the number of rows it updated
+        :param batch_size: hashes per batch
+        :returns: the number of rows updated
+        """
+        updated = 0
+        while True:
+            counts, batch = self.take(batch_size)
+
+            # A concurrent flush may have emptied every hash in a full batch
+            if counts:
+                try:
+                    updated += write(counts)
+                except Exception:
+                    # Put the counts back so they're written by the next flush
+                    log.exception("Failed to write counts. prefix=%s", self.key_prefix)
+                    self.restore(counts)
+                    raise
+
+            # Stop after a partial batch rather than chasing new counts
+            if batch is None or batch < batch_size:
+                break
+
+        return updated
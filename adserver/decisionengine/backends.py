@@ -2,23 +2,43 @@
 
 import logging
 import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from django.conf import settings
+from django.db import close_old_connections
 from django.db import models
 from django.utils import timezone
-from user_agents import parse
 
 from ..constants import AFFILIATE_CAMPAIGN
 from ..constants import ALL_CAMPAIGN_TYPES
 from ..constants import COMMUNITY_CAMPAIGN
+from ..constants import DEDUPLICATE_ADVERTISER
+from ..constants import DEDUPLICATE_FLIGHT
 from ..constants import HOUSE_CAMPAIGN
 from ..constants import PAID_CAMPAIGN
 from ..constants import PUBLISHER_HOUSE_CAMPAIGN
+from ..models import Advertisement
 from ..models import Flight
 from ..models import Region
 from ..models import Topic
+from ..utils import GeolocationData
 from ..utils import get_ad_day
+from ..utils import get_client_id
 from ..utils import get_client_user_agent
+from ..utils import parse_user_agent
+from .deadline import NullDecisionDeadline
+from .deadline import choose_fallback_ad
+from .embeddings import get_embedding_index
+from .frequency import get_frequency_counts
+from .inventory import INVENTORY_CAMPAIGN_TYPES
+from .inventory import check_no_inventory
+from .inventory import record_no_inventory
+from .pacing import get_pacing_snapshot
+from .publisher import PublisherDecisionContext
+from .sampling import WeightedSampler
+from .snapshot import get_flight_snapshot
+from .trace import NullDecisionTrace
 
 
 if "adserver.analyzer" in settings.INSTALLED_APPS:
@@ -28,6 +48,34 @@ else:
 
 log = logging.getLogger(__name__)
 
+# Slow I/O bound lookups (eg. embeddings) can run concurrently with the decision
+_lookup_executor = None
+_lookup_executor_lock = threading.Lock()
+
+
+def get_lookup_executor():
+    """Get the thread pool used for running lookups concurrently with ad decisions."""
+    global _lookup_executor  # noqa: PLW0603
+
+    with _lookup_executor_lock:
+        if _lookup_executor is None:
+            _lookup_executor = ThreadPoolExecutor(thread_name_prefix="adserver-lookup")
+    return _lookup_executor
+
+
+def _run_lookup(func, *args, **kwargs):
+    try:
+        return func(*args, **kwargs)
+    finally:
+        # Pooled threads aren't part of a request so clean up connections like one
+        close_old_connections()
+
+
+def _get_publisher_embeddings(url):
+    from ethicalads_ext.embedding.utils import get_publisher_embeddings  # noqa
+
+    return get_publisher_embeddings(url=url)
+
 
 class BaseAdDecisionBackend:
     """A base decision backend -- other decision backends should extend this."""
@@ -41,15 +89,23 @@ class BaseAdDecisionBackend:
         :param kwargs: Any additional possible arguments for the backend
         """
         self.request = request
-        self.user_agent = parse(get_client_user_agent(request))
+        self.user_agent = parse_user_agent(get_client_user_agent(request))
         self.placements = placements
         self.publisher = publisher
 
+        # The publisher's groups, default keywords and caps resolved ahead of time
+        self.publisher_context = kwargs.get(
+            "publisher_context"
+        ) or PublisherDecisionContext.from_publisher(publisher)
+
         self.ad_types = [p["ad_type"] for p in self.placements]
         self.url = kwargs.get("url") or ""
 
         self.geolocation = request.geo
 
+        # Optional stages are skipped when the decision's time budget runs out
+        self.deadline = kwargs.get("deadline") or NullDecisionDeadline()
+
         # Optional parameters
         self.keywords = kwargs.get("keywords", []) or []
         requested_campaign_types = kwargs.get("campaign_types", []) or []
@@ -57,13 +113,13 @@ class BaseAdDecisionBackend:
             requested_campaign_types = ALL_CAMPAIGN_TYPES
 
         # Add default keywords from publisher
-        if self.publisher.keywords:
+        if self.publisher_context.keywords:
             log.debug(
                 "Adding default keywords: publisher=%s keywords=%s",
                 self.publisher.slug,
-                self.publisher.keywords,
+                self.publisher_context.keywords,
             )
-            merged_keywords = set(self.keywords) | set(self.publisher.keywords)
+            merged_keywords = set(self.keywords) | set(self.publisher_context.keywords)
             self.keywords = list(merged_keywords)
 
         analyzer_keywords = self.get_analyzer_keywords()
@@ -105,8 +161,8 @@ class BaseAdDecisionBackend:
         # Remove paid ads if this publisher exceeds their daily cap
         if (
             PAID_CAMPAIGN in self.campaign_types
-            and self.publisher.daily_cap
-            and self.publisher.get_daily_earn() >= self.publisher.daily_cap
+            and self.publisher_context.daily_cap
+            and self.publisher.get_daily_earn() >= self.publisher_context.daily_cap
         ):
             log.debug("Publisher has hit their daily cap. publisher=%s", self.publisher)
             self.campaign_types.remove(PAID_CAMPAIGN)
@@ -121,6 +177,18 @@ class BaseAdDecisionBackend:
 
         self.niche_weights = None
 
+        # Records rejections and timings when this decision is traced
+        self.trace = kwargs.get("trace") or NullDecisionTrace()
+
+        # Run slow lookups (eg. embeddings) in a thread pool alongside the decision
+        self.concurrent_lookups = kwargs.get("concurrent_lookups", False)
+
+        # Flight ID -> how many times this user saw the flight today (frequency caps)
+        self.frequency_counts = {}
+
+        # Shadow decisions (see ``shadow``) are only compared and have no side effects
+        self.shadow = kwargs.get("shadow", False)
+
     def get_analyzer_keywords(self):
         """Get keywords for this URL from the analyzer."""
         if not self.url:
@@ -130,14 +198,10 @@ class BaseAdDecisionBackend:
             log.debug("Not using Analyzer keywords. Analyzer is not in INSTALLED_APPS.")
             return None
 
-        normalized_url = self.url
-        analyzed_url = AnalyzedUrl.objects.filter(
-            url=normalized_url, publisher=self.publisher
-        ).first()
-        if analyzed_url:
-            return analyzed_url.keywords
+        if not self.deadline.allows("analyzer"):
+            return None
 
-        return None
+        return AnalyzedUrl.get_keywords(self.url, self.publisher)
 
     def get_ad_and_placement(self):
         """
@@ -161,19 +225,89 @@ class BaseAdDecisionBackend:
             "subclasses of BaseAdDecisionBackend must override get_ad_and_placement()"
         )
 
-    def get_placement(self, advertisement):
+    def get_ads_and_placements(self, deduplicate=DEDUPLICATE_ADVERTISER):
+        """
+        Choose distinct ads to fill each of the placements (a batch decision).
+
+        Unlike ``get_ad_and_placement`` where the placements are alternatives
+        for a single ad, here every placement is a separate slot on the page.
+        Ads from the same advertiser (or flight) are not shown in more than one slot.
+
+        :param deduplicate: whether ads are unique per advertiser or per flight
+        :return: A list of 2-tuples of the `Advertisement` (or None) and the placement
+            with one entry per placement in the same order
+        """
+        raise NotImplementedError(
+            "subclasses of BaseAdDecisionBackend must override get_ads_and_placements()"
+        )
+
+    def get_fallback_ad_and_placement(self):
+        """
+        Choose a house ad when the decision runs out of time (see ``deadline``).
+
+        Fallback ads are not targeted or paced.
+        Forced decisions don't get a fallback.
+
+        :return: A 2-tuple of the `Advertisement` (or None) and the matching `placement`
+        """
+        self.deadline.degrade("fallback")
+        ad = None
+        if not (self.ad_slug or self.campaign_slug) and self.should_display_ads():
+            ad = self._choose_fallback_ad(self.placements)
+        return ad, self.get_placement(ad)
+
+    def get_fallback_ads_and_placements(self):
+        """
+        Choose distinct house ads for each placement when a batch decision runs out of time.
+
+        :return: A list of 2-tuples like ``get_ads_and_placements``
+        """
+        self.deadline.degrade("fallback")
+        fill = 0
+        if not (self.ad_slug or self.campaign_slug) and self.should_display_ads():
+            fill = (
+                len(self.placements) if self.publisher.allow_multiple_placements else 1
+            )
+
+        results = []
+        chosen = set()
+        for index, placement in enumerate(self.placements):
+            ad = None
+            if index < fill:
+                ad = self._choose_fallback_ad([placement], exclude=chosen)
+            if ad:
+                chosen.add(ad.pk)
+            results.append((ad, placement))
+        return results
+
+    def _choose_fallback_ad(self, placements, exclude=()):
+        for placement in placements:
+            ad = choose_fallback_ad(
+                self.publisher,
+                placement["ad_type"],
+                self.campaign_types,
+                exclude=exclude,
+            )
+            if ad:
+                return ad
+        return None
+
+    def get_placement(self, advertisement, placements=None):
         """Gets the first matching placement for a given ad."""
+        placements = placements or self.placements
+
         if not advertisement:
             # Always select the placement if there is only 1 for Decisions
-            if len(self.placements) == 1:
-                return self.placements[0]
+            if len(placements) == 1:
+                return placements[0]
             return None
 
-        for placement in self.placements:
+        ad_type_slugs = self.get_ad_type_slugs(advertisement)
+        for placement in placements:
             # A placement "matches" if the ad type matches
             # If the ad or campaign is specified, they must also match
             if (
-                placement["ad_type"] in [t.slug for t in advertisement.ad_types.all()]
+                placement["ad_type"] in ad_type_slugs
                 and (not self.ad_slug or advertisement.slug == self.ad_slug)
                 and (
                     not self.campaign_slug
@@ -184,6 +318,10 @@ class BaseAdDecisionBackend:
 
         return None
 
+    def get_ad_type_slugs(self, advertisement):
+        """Get the slugs of the ad's ad types."""
+        return {t.slug for t in advertisement.ad_types.all()}
+
     def should_display_ads(self):
         """Whether to not display ads based on the user, request, or other settings."""
         # Check if the publisher is allowed to have multiple placements
@@ -210,6 +348,9 @@ class AdvertisingDisabledBackend(BaseAdDecisionBackend):
     def get_ad_and_placement(self):
         return None, None
 
+    def get_ads_and_placements(self, deduplicate=DEDUPLICATE_ADVERTISER):
+        return [(None, placement) for placement in self.placements]
+
     def should_display_ads(self):
         return False
 
@@ -237,14 +378,13 @@ class AdvertisingEnabledBackend(BaseAdDecisionBackend):
             )
             flights = Flight.objects.filter(campaign__slug=self.campaign_slug)
         else:
+            publisher_group_ids = self.publisher_context.publisher_group_ids
             flights = (
                 Flight.objects.filter(
                     advertisements__ad_types__slug__in=self.ad_types,
                     campaign__campaign_type__in=self.campaign_types,
                 )
-                .filter(
-                    campaign__publisher_groups__in=self.publisher.publisher_groups.all()
-                )
+                .filter(campaign__publisher_groups__in=publisher_group_ids)
                 .exclude(campaign__exclude_publishers=self.publisher)
             )
 
@@ -271,6 +411,29 @@ class AdvertisingEnabledBackend(BaseAdDecisionBackend):
         # Ensure we prefetch necessary data so it doesn't result in N queries for each flight
         return flights.select_related("campaign")
 
+    def get_traced_candidate_flights(self):
+        """
+        Get the candidate flights and record the count and time taken when tracing.
+
+        The candidates are annotated with their placement priority
+        so the query evaluated (and timed) here is the one used for the decision.
+        """
+        self.deadline.check("candidates")
+        self.start_concurrent_lookups()
+
+        if not self.trace:
+            return self.annotate_placement_priority(self.get_candidate_flights())
+
+        with self.trace.stage("candidates"):
+            flights = self.annotate_placement_priority(self.get_candidate_flights())
+            # Evaluate the candidate query here so it is timed
+            self.trace.candidates = len(flights)
+
+        return flights
+
+    def start_concurrent_lookups(self):
+        """Start any lookups that can run while candidate flights are chosen."""
+
     def filter_flight(self, flight, regions=None, topics=None):
         """
         Apply flight targeting.
@@ -284,71 +447,240 @@ class AdvertisingEnabledBackend(BaseAdDecisionBackend):
             return True
 
         # Skip if we aren't meant to show to this country/state/dma
-        if not flight.show_to_geo(self.geolocation, regions=regions):
+        if not self.flight_matches_geo(flight, regions=regions):
+            self.trace.reject(flight, "geo")
             return False
 
         # Skip if we aren't meant to show to these keywords
-        if not flight.show_to_keywords(self.keywords, topics=topics):
+        if not self.flight_matches_keywords(flight, topics=topics):
+            self.trace.reject(flight, "keywords")
             return False
 
         # Skip if we aren't meant to show to this traffic because it is mobile or non-mobile
         if not flight.show_to_mobile(self.user_agent.is_mobile):
+            self.trace.reject(flight, "mobile")
             return False
 
         # Skip if this flight is ineligible for this publisher
         if not flight.show_on_publisher(self.publisher):
+            self.trace.reject(flight, "publisher")
             return False
 
         # Skip if we shouldn't show this flight on this domain
         if not flight.show_on_domain(self.url):
+            self.trace.reject(flight, "domain")
             return False
 
         # Skip if there are no clicks or views needed today/this interval (ad pacing)
-        if flight.weighted_clicks_needed_this_interval() <= 0:
+        if self.get_flight_weight(flight) <= 0:
+            self.trace.reject(flight, "pacing")
             return False
 
         # Skip if the flight is not meant to show on these days
         if not flight.show_to_day(timezone.now().strftime("%A").lower()):
+            self.trace.reject(flight, "day")
             return False
 
         # Skip if the flight if the similarity is not high enough
         if not flight.show_to_niche_targeting(self.niche_weights):
+            self.trace.reject(flight, "niche")
             return False
 
         # Skip if the flight has reached its daily cap
         if flight.daily_cap_exceeded():
+            self.trace.reject(flight, "daily_cap")
+            return False
+
+        # Skip if this user has seen this flight enough times today
+        if self.flight_exceeds_frequency_cap(flight):
+            self.trace.reject(flight, "frequency_cap")
             return False
 
         return True
 
+    def load_frequency_counts(self, flights):
+        """Read how many times this user saw each of the flights with a frequency cap today."""
+        if self.shadow:
+            return
+
+        capped_flights = [
+            flight
+            for flight in flights
+            if flight.frequency_cap and flight.pk not in self.frequency_counts
+        ]
+        if capped_flights:
+            self.frequency_counts.update(
+                get_frequency_counts(get_client_id(self.request), capped_flights)
+            )
+
+    def flight_exceeds_frequency_cap(self, flight):
+        """Whether this user has seen this flight as many times today as its frequency cap."""
+        if not flight.frequency_cap or self.shadow:
+            return False
+
+        # Counts are normally read for all candidates at once before filtering
+        self.load_frequency_counts([flight])
+        return self.frequency_counts[flight.pk] >= flight.frequency_cap
+
+    def flight_matches_geo(self, flight, regions=None):
+        """Whether the flight's geo targeting and traffic caps match this request."""
+        return flight.show_to_geo(self.geolocation, regions=regions)
+
+    def flight_matches_keywords(self, flight, topics=None):
+        """Whether the flight's keyword and topic targeting matches this request."""
+        return flight.show_to_keywords(self.keywords, topics=topics)
+
+    def get_flight_weight(self, flight, publisher=None):
+        """
+        Get the clicks needed by this flight this interval weighted by its value (ad pacing).
+
+        Uses the passed publisher for a better CTR estimate if passed.
+        """
+        return flight.weighted_clicks_needed_this_interval(publisher)
+
     def select_flight(self):
         """Naively select a flight from the candidates."""
-        flights = self.get_candidate_flights()
+        flights = self.get_traced_candidate_flights()
 
         # Filter and randomly sort
         valid_flights = []
         regions = Region.load_from_cache()
         topics = Topic.load_from_cache()
 
-        for flight in flights:
-            if self.filter_flight(flight, regions=regions, topics=topics):
-                valid_flights.append(flight)
+        self.deadline.check("filtering")
+        with self.trace.stage("filtering"):
+            self.load_frequency_counts(flights)
+            for flight in flights:
+                if self.filter_flight(flight, regions=regions, topics=topics):
+                    valid_flights.append(flight)
 
         if valid_flights:
             return random.choice(valid_flights)
 
         return None
 
-    def select_ad_for_flight(self, flight):
+    def get_weighted_flight_tiers(self, flights):
+        """
+        Yield lists of eligible flights and their weights in the order they should be chosen.
+
+        This naive backend weights all valid flights equally.
+        """
+        regions = Region.load_from_cache()
+        topics = Topic.load_from_cache()
+
+        self.deadline.check("filtering")
+        with self.trace.stage("filtering"):
+            self.load_frequency_counts(flights)
+            weighted_flights = [
+                (flight, 1)
+                for flight in flights
+                if self.filter_flight(flight, regions=regions, topics=topics)
+            ]
+
+        yield weighted_flights
+
+    def annotate_placement_priority(self, flights):
+        """Annotate the candidate flights with the highest priority placement they match."""
+        return flights
+
+    def get_placement_priority(self, flight):
+        """Get the highest priority placement this flight matches (default 1)."""
+        return 1
+
+    def choose_flight(self, weighted_flights):
+        """Choose a random flight from a list of flights and their weights."""
+        sampler = WeightedSampler(weighted_flights)
+
+        # The higher weighted flights will have more total "chances".
+        return sampler.find(random.randint(0, sampler.total_weight))
+
+    def get_flight_ad_types(self, flights):
+        """Get the ad types of the live ads for each of the flights (flight ID -> slugs)."""
+        flight_ad_types = {}
+        for flight_id, ad_type_slug in Advertisement.ad_types.through.objects.filter(
+            advertisement__flight__in=flights,
+            advertisement__live=True,
+        ).values_list("advertisement__flight_id", "adtype__slug"):
+            flight_ad_types.setdefault(flight_id, set()).add(ad_type_slug)
+        return flight_ad_types
+
+    def get_ads_and_placements(self, deduplicate=DEDUPLICATE_ADVERTISER):
+        placements = self.placements
+        if not self.publisher.allow_multiple_placements:
+            # Only fill the first slot just like a request with `placement_index` > 0
+            placements = placements[:1]
+
+        results = []
+
+        # The candidate flights and their targeting is evaluated once for all slots
+        flights = list(self.get_traced_candidate_flights())
+        forced = self.ad_slug or self.campaign_slug
+        if forced:
+            tiers = iter([[(flight, 1) for flight in flights]])
+            flight_ad_types = {}
+        else:
+            tiers = self.get_weighted_flight_tiers(flights)
+            flight_ad_types = self.get_flight_ad_types(flights)
+
+        # Lower priority tiers are only evaluated when a slot needs them
+        evaluated_tiers = []
+
+        def get_tiers():
+            yield from evaluated_tiers
+            for tier in tiers:
+                evaluated_tiers.append(tier)
+                yield tier
+
+        chosen = set()
+        for placement in placements:
+            ad = None
+            for weighted_flights in get_tiers():
+                # Boost the weight of flights that match a high priority placement
+                flight = self.choose_flight(
+                    [
+                        (flight, weight * self.get_placement_priority(flight))
+                        for flight, weight in weighted_flights
+                        if (
+                            forced
+                            or placement["ad_type"]
+                            in flight_ad_types.get(flight.pk, ())
+                        )
+                        and self._get_deduplication_key(flight, deduplicate)
+                        not in chosen
+                    ]
+                )
+                if flight:
+                    ad = self.select_ad_for_flight(flight, placements=[placement])
+                    if ad:
+                        chosen.add(self._get_deduplication_key(flight, deduplicate))
+                        break
+
+            results.append((ad, placement))
+
+        # Slots that can't be filled are returned without an ad
+        results.extend(
+            (None, placement) for placement in self.placements[len(placements) :]
+        )
+        return results
+
+    def _get_deduplication_key(self, flight, deduplicate):
+        if deduplicate == DEDUPLICATE_FLIGHT:
+            return flight.pk
+        return flight.campaign.advertiser_id
+
+    def select_ad_for_flight(self, flight, placements=None):
         """Naively choose an ad from the selected flight."""
         if not flight:
             return None
 
-        return (
-            flight.advertisements.filter(live=True, ad_types__slug__in=self.ad_types)
-            .order_by("?")
-            .first()
-        )
+        placements = placements or self.placements
+        ad_types = [p["ad_type"] for p in placements]
+
+        # Choosing randomly here is much cheaper than ordering randomly in the database
+        ads = list(flight.advertisements.filter(live=True, ad_types__slug__in=ad_types))
+        if not ads:
+            return None
+        return random.choice(ads)
 
     def get_ad_and_placement(self):
         flight = self.select_flight()
@@ -372,25 +704,115 @@ class ProbabilisticFlightBackend(AdvertisingEnabledBackend):
         * Choose paid over community over house campaigns
         * Prioritize the flight that needs the most impressions
         """
-        flights = self.get_candidate_flights()
-        whens = [
-            models.When(
-                advertisements__ad_types__slug=placement["ad_type"],
-                advertisements__live=True,
-                then=models.Value(placement.get("priority", 1)),
+        flights = self.get_traced_candidate_flights()
+
+        if flights and (self.ad_slug or self.campaign_slug):
+            # Ignore priorities for forcing a specific ad/campaign
+            return random.choice(flights)
+
+        # We iterate over the possible flights in order of priority,
+        # and serve the first type that has any budget.
+        for weighted_flights in self.get_weighted_flight_tiers(flights):
+            # Boost the weight of flights that match a high priority placement
+            flight = self.choose_flight(
+                [
+                    (flight, weight * self.get_placement_priority(flight))
+                    for flight, weight in weighted_flights
+                ]
             )
-            for placement in self.placements
+            if flight:
+                return flight
+
+        return None
+
+    def get_traced_candidate_flights(self):
+        self.check_inventory()
+        return super().get_traced_candidate_flights()
+
+    def get_inventory_request(self):
+        """
+        Get the parts of this request that paid, affiliate and community inventory depends on.
+
+        :returns: the arguments for ``check_no_inventory`` and ``record_no_inventory``
+            or ``None`` if this request can't use the negative cache
+        """
+        campaign_types = [
+            ct for ct in self.campaign_types if ct in INVENTORY_CAMPAIGN_TYPES
         ]
-        flights = flights.annotate(
-            max_placement_priority=models.Max(
-                models.Case(
-                    *whens,
-                    default=models.Value(1),
-                    output_field=models.IntegerField(),
-                )
+        if (
+            not settings.ADSERVER_DECISION_NEGATIVE_CACHE_TIMEOUT
+            or self.shadow
+            or not campaign_types
+            or self.ad_slug
+            or self.campaign_slug
+            # These requests get no candidates whatever inventory there is
+            or not self.should_display_ads()
+        ):
+            return None
+
+        return {
+            "publisher": self.publisher,
+            "ad_types": self.ad_types,
+            "campaign_types": campaign_types,
+            "country": self.geolocation.country,
+        }
+
+    def check_inventory(self):
+        """Only look for house ads if a recent decision found no other inventory for this request."""
+        self.inventory_generation = None
+        inventory_request = self.get_inventory_request()
+        if not inventory_request:
+            return
+
+        no_inventory, self.inventory_generation = check_no_inventory(
+            **inventory_request
+        )
+        if no_inventory:
+            log.debug("Skipping paid inventory. publisher=%s", self.publisher)
+            self.inventory_generation = None
+            self.campaign_types = [
+                ct for ct in self.campaign_types if ct not in INVENTORY_CAMPAIGN_TYPES
+            ]
+            if self.trace:
+                self.trace.context["no_inventory"] = True
+
+    def record_inventory(self, flights, regions=None):
+        """Remember this request has no inventory if none of these flights can ever match it."""
+        if getattr(self, "inventory_generation", None) is None:
+            return
+
+        if all(self.flight_never_matches(flight, regions) for flight in flights):
+            record_no_inventory(
+                **self.get_inventory_request(), generation=self.inventory_generation
             )
+
+    def flight_never_matches(self, flight, regions=None):
+        """
+        Whether the flight can't match any request with the same publisher, ad types and country.
+
+        Only targeting that depends on nothing else is checked.
+        """
+        # Traffic caps and state/metro targeting depend on more than the country
+        if (
+            flight.traffic_cap
+            or flight.included_state_provinces
+            or flight.included_metro_codes
+        ):
+            return False
+
+        return not flight.show_on_publisher(self.publisher) or not flight.show_to_geo(
+            GeolocationData(country=self.geolocation.country), regions=regions
         )
 
+    def get_weighted_flight_tiers(self, flights):
+        """
+        Yield the eligible flights and the clicks they need for each campaign type.
+
+        * Choose paid over community over house campaigns
+        * Weight flights by the impressions they need (ad pacing)
+
+        Lower priority campaign types are only evaluated if they are needed.
+        """
         paid_flights = []
         affiliate_flights = []
         community_flights = []
@@ -410,26 +832,35 @@ class ProbabilisticFlightBackend(AdvertisingEnabledBackend):
             else:
                 house_flights.append(flight)
 
-        if flights and (self.ad_slug or self.campaign_slug):
-            # Ignore priorities for forcing a specific ad/campaign
-            return random.choice(flights)
-
         # Fetch embeddings once at the start to reuse in both niche targeting and ad similarity scoring
         # Store as instance variables so they can be accessed in select_ad_for_flight()
         self.publisher_embedding = None
         self.domain_embedding = None
-        if "ethicalads_ext.embedding" in settings.INSTALLED_APPS and self.url:
-            from ethicalads_ext.embedding.utils import get_publisher_embeddings
+        self.embedding_scores = None
+        if self.embeddings_enabled() and self.deadline.allows("embedding"):
+            with self.trace.stage("embedding"):
+                self.publisher_embedding, self.domain_embedding = (
+                    self.get_publisher_embeddings()
+                )
 
-            self.publisher_embedding, self.domain_embedding = get_publisher_embeddings(
-                url=self.url
-            )
+                # Score every flight and ad against the page at once with a local index
+                embedding_index = get_embedding_index()
+                if embedding_index and (
+                    self.publisher_embedding or self.domain_embedding
+                ):
+                    self.embedding_scores = embedding_index.score(
+                        (self.publisher_embedding, self.domain_embedding)
+                    )
 
         regions = Region.load_from_cache()
         topics = Topic.load_from_cache()
 
-        # We iterate over the possible flights in order of priority,
-        # and serve the first type that has any budget.
+        with self.trace.stage("filtering"):
+            self.load_frequency_counts(flights)
+            self.record_inventory(
+                paid_flights + affiliate_flights + community_flights, regions=regions
+            )
+
         for possible_flights in (
             paid_flights,
             affiliate_flights,
@@ -437,9 +868,11 @@ class ProbabilisticFlightBackend(AdvertisingEnabledBackend):
             publisher_house_flights,
             house_flights,
         ):
+            # Give up on the decision (and serve a fallback) if there's no time left
+            self.deadline.check("filtering")
+
             # Choose a flight based on the impressions needed
-            flight_range = []
-            total_clicks_needed = 0
+            weighted_flights = []
             self.niche_weights = None
 
             flights_with_niche_targeting = [
@@ -448,65 +881,153 @@ class ProbabilisticFlightBackend(AdvertisingEnabledBackend):
 
             # Apply niche targeting only when any flight has it.
             # This is to track whether we should do expensive distance queries.
-            if flights_with_niche_targeting and (
-                self.publisher_embedding or self.domain_embedding
+            # Without time for the distance queries, niche targeted flights aren't shown
+            if (
+                flights_with_niche_targeting
+                and (self.publisher_embedding or self.domain_embedding)
+                and self.deadline.allows("niche")
             ):
                 # We have to do this here,
                 # so we can filter by the weight in the filter_flight call below
-                from ethicalads_ext.embedding.utils import get_niche_weights  # noqa
-
-                self.niche_weights = get_niche_weights(
-                    url=self.url,
-                    flights=flights_with_niche_targeting,
-                    publisher_embedding=self.publisher_embedding,
-                    domain_embedding=self.domain_embedding,
-                )
+                with self.trace.stage("embedding"):
+                    self.niche_weights = self.get_niche_weights(
+                        flights_with_niche_targeting
+                    )
                 if self.niche_weights:
                     log.debug("Niche targeting weights: %s", self.niche_weights)
 
-            for flight in possible_flights:
-                # Handle excluding flights based on targeting
-                if not self.filter_flight(flight, regions=regions, topics=topics):
-                    continue
-
-                # If any impressions/clicks are needed, add this flight
-                # to the possible list of flights
-                if any(
-                    (
-                        (flight.clicks_needed_this_interval() > 0),
-                        (flight.views_needed_this_interval() > 0),
-                    )
-                ):
-                    # NOTE: takes into account views for CPM ads
-                    # Takes eCPM (CTR * CPC for CPC ads) into account
-                    weighted_clicks_needed_this_interval = (
-                        flight.weighted_clicks_needed_this_interval(
-                            self.publisher,
+            with self.trace.stage("filtering"):
+                for flight in possible_flights:
+                    # Handle excluding flights based on targeting
+                    if not self.filter_flight(flight, regions=regions, topics=topics):
+                        continue
+
+                    # If any impressions/clicks are needed, add this flight
+                    # to the possible list of flights
+                    if self.flight_needs_impressions(flight):
+                        # NOTE: takes into account views for CPM ads
+                        # Takes eCPM (CTR * CPC for CPC ads) into account
+                        weighted_flights.append(
+                            (flight, self.get_flight_weight(flight, self.publisher))
                         )
-                    )
+                    else:
+                        self.trace.reject(flight, "pacing")
 
-                    # Boost the weight of this flight if it matches a high priority placement
-                    priority = getattr(flight, "max_placement_priority", 1)
+            yield weighted_flights
 
-                    weighted_clicks_needed_this_interval *= priority
+    def get_niche_weights(self, flights):
+        """
+        Get the distance from the page to the closest niche of each flight's advertiser.
 
-                    flight_range.append(
-                        [
-                            total_clicks_needed,
-                            total_clicks_needed + weighted_clicks_needed_this_interval,
-                            flight,
-                        ]
-                    )
-                    total_clicks_needed += weighted_clicks_needed_this_interval
+        Lower distances are closer. See ``Flight.show_to_niche_targeting``.
+        """
+        if self.embedding_scores is None:
+            from ethicalads_ext.embedding.utils import get_niche_weights  # noqa
+
+            return get_niche_weights(
+                url=self.url,
+                flights=flights,
+                publisher_embedding=self.publisher_embedding,
+                domain_embedding=self.domain_embedding,
+            )
 
-            # Choose a random flight based on the weights computed above.
-            # The higher priority flights will have more total "chances".
-            choice = random.randint(0, total_clicks_needed)
-            for min_clicks, max_clicks, flight in flight_range:
-                if min_clicks <= choice <= max_clicks:
-                    return flight
+        niche_weights = {}
+        for flight in flights:
+            distance = self.embedding_scores.flight_distances.get(flight.pk)
+            if distance is None:
+                continue
+            advertiser = flight.campaign.advertiser
+            niche_weights[advertiser] = min(
+                distance, niche_weights.get(advertiser, distance)
+            )
+        return niche_weights
+
+    def get_ad_similarity_scores(self, ads):
+        """Get the similarity (0-1) of the page to each of the ads (ad ID -> score)."""
+        if self.embedding_scores is None:
+            from ethicalads_ext.embedding.utils import get_ad_similarity_scores  # noqa
+
+            # Reuse the publisher_embedding and domain_embedding fetched earlier
+            return get_ad_similarity_scores(
+                url=self.url,
+                ads=ads,
+                publisher_embedding=getattr(self, "publisher_embedding", None),
+                domain_embedding=getattr(self, "domain_embedding", None),
+            )
 
-        return None
+        ad_similarities = self.embedding_scores.ad_similarities
+        return {ad.id: ad_similarities[ad.id] for ad in ads if ad.id in ad_similarities}
+
+    def embeddings_enabled(self):
+        """Whether embeddings are used for niche targeting and ad similarity."""
+        return "ethicalads_ext.embedding" in settings.INSTALLED_APPS and bool(self.url)
+
+    def start_concurrent_lookups(self):
+        self.embeddings_future = None
+        if self.concurrent_lookups and self.embeddings_enabled():
+            self.embeddings_future = get_lookup_executor().submit(
+                _run_lookup, _get_publisher_embeddings, self.url
+            )
+
+    def get_publisher_embeddings(self):
+        """Get the publisher and domain embeddings (waiting on a concurrent lookup)."""
+        future = getattr(self, "embeddings_future", None)
+        if future is None:
+            return _get_publisher_embeddings(self.url)
+
+        try:
+            return future.result(timeout=self.deadline.remaining())
+        except TimeoutError:
+            # Don't wait on the lookup past the decision's time budget
+            self.deadline.degrade("embedding")
+            return None, None
+
+    def flight_needs_impressions(self, flight):
+        """Whether a flight needs any clicks or views this interval."""
+        return any(
+            (
+                (flight.clicks_needed_this_interval() > 0),
+                (flight.views_needed_this_interval() > 0),
+            )
+        )
+
+    def annotate_placement_priority(self, flights):
+        """Annotate the candidate flights with the highest priority placement they match."""
+        whens = [
+            models.When(
+                advertisements__ad_types__slug=placement["ad_type"],
+                advertisements__live=True,
+                then=models.Value(placement.get("priority", 1)),
+            )
+            for placement in self.placements
+        ]
+        return flights.annotate(
+            max_placement_priority=models.Max(
+                models.Case(
+                    *whens,
+                    default=models.Value(1),
+                    output_field=models.IntegerField(),
+                )
+            )
+        )
+
+    def get_placement_priority(self, flight):
+        """Get the highest priority placement this flight matches (default 1)."""
+        return getattr(flight, "max_placement_priority", 1)
+
+    def get_candidate_ads(self, flight, ad_types):
+        """Get the ads in the flight that may be shown for these ad types."""
+        if self.ad_slug:
+            # Ignore live and adtype checks when forcing a specific ad
+            candidate_ads = flight.advertisements.filter(slug=self.ad_slug)
+        else:
+            candidate_ads = flight.advertisements.filter(
+                live=True, ad_types__slug__in=ad_types
+            )
+
+        return candidate_ads.select_related(
+            "flight", "flight__campaign", "flight__campaign__advertiser"
+        ).prefetch_related("ad_types")
 
     def get_ad_ctr_weight(self, ad):
         """
@@ -566,7 +1087,7 @@ class ProbabilisticFlightBackend(AdvertisingEnabledBackend):
 
         return ad_weighting
 
-    def select_ad_for_flight(self, flight):
+    def select_ad_for_flight(self, flight, placements=None):
         """
         Choose an ad from the selected flight filtered requested ``self.ad_types``.
 
@@ -575,48 +1096,35 @@ class ProbabilisticFlightBackend(AdvertisingEnabledBackend):
         - Requested placement priority
         - Sampled ad CTR
         - Ad content similarity to page (using embeddings)
+
+        The ads can be limited to only some of the placements (eg. for batch decisions).
         """
         if not flight:
             return None
 
-        chosen_ad = None
-        weighted_ad_choices = []
-
-        if self.ad_slug:
-            # Ignore live and adtype checks when forcing a specific ad
-            candidate_ads = flight.advertisements.filter(slug=self.ad_slug)
-        else:
-            candidate_ads = flight.advertisements.filter(
-                live=True, ad_types__slug__in=self.ad_types
-            )
+        placements = placements or self.placements
+        ad_types = [p["ad_type"] for p in placements]
 
-        candidate_ads = candidate_ads.select_related(
-            "flight", "flight__campaign", "flight__campaign__advertiser"
-        ).prefetch_related("ad_types")
+        chosen_ad = None
+        weighted_ads = []
+        candidate_ads = self.get_candidate_ads(flight, ad_types)
 
         # Get similarity scores for candidate ads if embedding support is available
-        # Reuse the publisher_embedding and domain_embedding fetched earlier to avoid duplicate queries
         ad_similarity_scores = {}
-        if "ethicalads_ext.embedding" in settings.INSTALLED_APPS and self.url:
+        if self.embeddings_enabled() and self.deadline.allows("similarity"):
             try:
-                from ethicalads_ext.embedding.utils import get_ad_similarity_scores
-
-                ad_similarity_scores = get_ad_similarity_scores(
-                    url=self.url,
-                    ads=candidate_ads,
-                    publisher_embedding=getattr(self, "publisher_embedding", None),
-                    domain_embedding=getattr(self, "domain_embedding", None),
-                )
+                with self.trace.stage("embedding"):
+                    ad_similarity_scores = self.get_ad_similarity_scores(candidate_ads)
             except Exception as e:
                 log.warning("Failed to get ad similarity scores: %s", e)
 
         for advertisement in candidate_ads:
-            placement = self.get_placement(advertisement)
+            placement = self.get_placement(advertisement, placements)
             if not placement:
                 log.warning(
                     "Couldn't find a matching ad placement. ad=%s, placements=%s",
                     advertisement,
-                    self.placements,
+                    placements,
                 )
                 continue
 
@@ -634,16 +1142,140 @@ class ProbabilisticFlightBackend(AdvertisingEnabledBackend):
                     advertisement, ad_similarity_scores
                 )
 
-            for _ in range(priority):
-                weighted_ad_choices.append(advertisement)
+            weighted_ads.append((advertisement, priority))
 
-        if weighted_ad_choices:
-            chosen_ad = random.choice(weighted_ad_choices)
+        if weighted_ads:
+            chosen_ad = WeightedSampler(weighted_ads).sample()
         else:
             log.warning(
                 "Chosen flight has no matching live ads! flight=%s, ad_types=%s",
                 flight,
-                self.ad_types,
+                ad_types,
             )
 
         return chosen_ad
+
+
+class SnapshotFlightBackend(ProbabilisticFlightBackend):
+    """
+    A probabilistic backend that chooses candidates from an in-memory flight snapshot.
+
+    Rather than querying the database for candidate flights on every decision,
+    candidates are chosen from a compiled snapshot of live flights
+    that is rebuilt in the background whenever flights change.
+    See ``adserver.decisionengine.snapshot``.
+
+    Geo and keyword targeting are checked against indexes built with the snapshot
+    and ads are chosen from the live ads stored with each snapshot flight.
+    Flight pacing is read from the periodically computed pacing snapshot
+    (see ``adserver.decisionengine.pacing``) when it is available.
+
+    Requests forcing a specific ad or campaign still query the database.
+    """
+
+    def __init__(self, request, placements, publisher, **kwargs):
+        super().__init__(request, placements, publisher, **kwargs)
+
+        # Flight ID -> the ad types of its live ads (from the snapshot)
+        self.flight_ad_types = {}
+
+        # Flight ID -> its live ads (from the snapshot)
+        self.flight_ads = {}
+
+        # Ad ID -> the slugs of its ad types (from the snapshot)
+        self.ad_type_slugs = {}
+
+        self.pacing = None
+
+        # The flights matching this request's geo and keywords (from the snapshot's indexes)
+        self.geo_match = None
+        self.keyword_match = None
+
+    def get_candidate_flights(self):
+        if self.ad_slug or self.campaign_slug or not self.should_display_ads():
+            return super().get_candidate_flights()
+
+        snapshot = get_flight_snapshot()
+        self.pacing = get_pacing_snapshot()
+        candidates = snapshot.get_candidate_flights(
+            self.publisher,
+            ad_types=self.ad_types,
+            campaign_types=self.campaign_types,
+            day=get_ad_day().date(),
+        )
+        self.flight_ad_types = {
+            sflight.flight.pk: sflight.ad_type_slugs for sflight in candidates
+        }
+        self.flight_ads = {sflight.flight.pk: sflight.ads for sflight in candidates}
+        self.ad_type_slugs = {
+            sad.advertisement.pk: sad.ad_type_slugs
+            for sflight in candidates
+            for sad in sflight.ads
+        }
+        self.geo_match = snapshot.geo_index.match(self.geolocation)
+        self.keyword_match = snapshot.keyword_index.match(self.keywords)
+
+        return [sflight.flight for sflight in candidates]
+
+    def flight_matches_geo(self, flight, regions=None):
+        if self.geo_match is not None and flight.pk in self.flight_ad_types:
+            return flight.pk in self.geo_match
+        return super().flight_matches_geo(flight, regions=regions)
+
+    def flight_matches_keywords(self, flight, topics=None):
+        if self.keyword_match is not None and flight.pk in self.flight_ad_types:
+            return flight.pk in self.keyword_match
+        return super().flight_matches_keywords(flight, topics=topics)
+
+    def get_candidate_ads(self, flight, ad_types):
+        if self.ad_slug or flight.pk not in self.flight_ads:
+            return super().get_candidate_ads(flight, ad_types)
+
+        ad_types = frozenset(ad_types)
+        return [
+            sad.advertisement
+            for sad in self.flight_ads[flight.pk]
+            if not sad.ad_type_slugs.isdisjoint(ad_types)
+        ]
+
+    def get_ad_type_slugs(self, advertisement):
+        if advertisement.pk in self.ad_type_slugs:
+            return self.ad_type_slugs[advertisement.pk]
+        return super().get_ad_type_slugs(advertisement)
+
+    def get_flight_weight(self, flight, publisher=None):
+        if self.pacing:
+            weight = self.pacing.get_weight(flight, publisher)
+            if weight is not None:
+                return weight
+        return super().get_flight_weight(flight, publisher)
+
+    def flight_needs_impressions(self, flight):
+        if self.pacing and flight.pk in self.pacing.weights:
+            # A positive weight means clicks or views are needed
+            return self.get_flight_weight(flight) > 0
+        return super().flight_needs_impressions(flight)
+
+    def get_flight_ad_types(self, flights):
+        if all(flight.pk in self.flight_ad_types for flight in flights):
+            return self.flight_ad_types
+        return super().get_flight_ad_types(flights)
+
+    def annotate_placement_priority(self, flights):
+        if isinstance(flights, list):
+            # Priorities for snapshot flights are computed from the snapshot
+            return flights
+        return super().annotate_placement_priority(flights)
+
+    def get_placement_priority(self, flight):
+        if flight.pk not in self.flight_ad_types:
+            return super().get_placement_priority(flight)
+
+        # Matches the database annotation where the first matching placement wins
+        priorities = [1]
+        for ad_type_slug in self.flight_ad_types[flight.pk]:
+            for placement in self.placements:
+                if placement["ad_type"] == ad_type_slug:
+                    priorities.append(placement.get("priority", 1))
+                    break
+        return max(priorities)
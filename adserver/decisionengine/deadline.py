@@ -0,0 +1,224 @@
+"""
+Time budgets for ad decisions so slow dependencies degrade decisions rather than stall them.
+
+Each ad decision gets a time budget (``ADSERVER_DECISION_TIME_BUDGET``).
+Optional stages of a decision (analyzer keywords, embeddings, niche targeting
+and ad similarity scoring) are skipped once the budget is used up.
+If the budget runs out before the candidate flights are evaluated,
+the decision is abandoned and a fallback house ad is served instead.
+
+Fallback ads are chosen from the flight snapshot this worker already has loaded
+(even if it's out of date) so serving one never waits on the database or the cache.
+Decision backends other than the snapshot backend don't load the snapshot
+so it's loaded (or reloaded when it's stale) before the clock starts on a decision.
+The fallback ads for each publisher and ad type are computed once per snapshot.
+
+Every skipped stage and fallback is logged.
+"""
+
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+
+from ..constants import HOUSE_CAMPAIGN
+from ..constants import PUBLISHER_HOUSE_CAMPAIGN
+from ..utils import get_ad_day
+from .snapshot import get_flight_snapshot
+from .snapshot import get_loaded_flight_snapshot
+
+
+log = logging.getLogger(__name__)  # noqa
+
+# Campaign types that fallback ads are chosen from
+FALLBACK_CAMPAIGN_TYPES = (PUBLISHER_HOUSE_CAMPAIGN, HOUSE_CAMPAIGN)
+
+# Seconds before a worker reloads its flight snapshot for fallback ads
+# The snapshot backend reloads it on every decision when it changes
+FALLBACK_SNAPSHOT_MAX_AGE = 60 * 5
+_fallback_snapshot_loaded = None
+
+# (Publisher ID, ad type, campaign types) -> the fallback ads for the loaded snapshot
+_fallback_ads = {}
+_fallback_ads_version = None
+_fallback_ads_lock = threading.Lock()
+
+
+class DecisionDeadlineExceeded(Exception):
+    """The time budget for an ad decision ran out before a flight was chosen."""
+
+    def __init__(self, stage):
+        super().__init__(f"Ad decision time budget exceeded before {stage}")
+        self.stage = stage
+
+
+class DecisionDeadline:
+    """The time left to make a single ad decision."""
+
+    def __init__(self, budget):
+        """
+        Start the clock on an ad decision.
+
+        :param budget: seconds that the decision may take
+        """
+        self.budget = budget
+        self.start_time = time.perf_counter()
+
+        # The stages skipped because the budget ran out (in order)
+        self.degradations = []
+
+    def __bool__(self):
+        return True
+
+    def remaining(self):
+        """Seconds left in the budget (never negative)."""
+        return max(0.0, self.budget - (time.perf_counter() - self.start_time))
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def allows(self, stage):
+        """
+        Whether there's time left to run an optional stage.
+
+        The stage is recorded as degraded when there isn't.
+        """
+        if self.expired():
+            self.degrade(stage)
+            return False
+        return True
+
+    def check(self, stage):
+        """Abandon the decision if there's no time left to run a required stage."""
+        if self.expired():
+            self.degrade(stage)
+            raise DecisionDeadlineExceeded(stage)
+
+    def degrade(self, stage):
+        """Record that a stage was skipped (or cut short) because the budget ran out."""
+        self.degradations.append(stage)
+        log.info(
+            "Ad decision degraded. stage=%s, budget=%s, elapsed=%.3f",
+            stage,
+            self.budget,
+            time.perf_counter() - self.start_time,
+        )
+
+
+class NullDecisionDeadline:
+    """A deadline that never expires for decisions without a time budget."""
+
+    degradations = ()
+
+    def __bool__(self):
+        return False
+
+    def remaining(self):
+        return None
+
+    def expired(self):
+        return False
+
+    def allows(self, stage):
+        return True
+
+    def check(self, stage):
+        pass
+
+    def degrade(self, stage):
+        pass
+
+
+def get_decision_deadline():
+    """Get the deadline for a new ad decision based on ``ADSERVER_DECISION_TIME_BUDGET``."""
+    if not settings.ADSERVER_DECISION_TIME_BUDGET:
+        return NullDecisionDeadline()
+
+    # Loaded outside of the budget so a fallback never waits on the snapshot
+    load_fallback_snapshot()
+    return DecisionDeadline(settings.ADSERVER_DECISION_TIME_BUDGET)
+
+
+def load_fallback_snapshot():
+    """
+    Make sure this worker has a flight snapshot loaded to choose fallback ads from.
+
+    This is a no-op unless the worker hasn't loaded a snapshot
+    or hasn't checked for a newer one in ``FALLBACK_SNAPSHOT_MAX_AGE`` seconds.
+    """
+    global _fallback_snapshot_loaded  # noqa: PLW0603
+
+    now = time.monotonic()
+    if (
+        get_loaded_flight_snapshot() is None
+        or _fallback_snapshot_loaded is None
+        or now - _fallback_snapshot_loaded > FALLBACK_SNAPSHOT_MAX_AGE
+    ):
+        get_flight_snapshot()
+        _fallback_snapshot_loaded = now
+
+
+def get_fallback_ads(publisher, ad_type_slug, campaign_types=FALLBACK_CAMPAIGN_TYPES):
+    """
+    Get the house ads that may be served to this publisher when a decision runs out of time.
+
+    Targeting and pacing are not checked.
+    This only uses the flight snapshot already loaded by this worker.
+
+    :returns: a list of ``Advertisement`` instances (empty if there's no snapshot loaded)
+    """
+    global _fallback_ads_version  # noqa: PLW0603
+
+    snapshot = get_loaded_flight_snapshot()
+    if snapshot is None:
+        return []
+
+    campaign_types = tuple(sorted(campaign_types))
+    key = (publisher.pk, ad_type_slug, campaign_types)
+    with _fallback_ads_lock:
+        if _fallback_ads_version != snapshot.version:
+            _fallback_ads.clear()
+            _fallback_ads_version = snapshot.version
+        ads = _fallback_ads.get(key)
+
+    if ads is None:
+        ads = [
+            sad.advertisement
+            for sflight in snapshot.get_candidate_flights(
+                publisher,
+                ad_types=[ad_type_slug],
+                campaign_types=campaign_types,
+                day=get_ad_day().date(),
+            )
+            for sad in sflight.ads
+            if ad_type_slug in sad.ad_type_slugs
+        ]
+        with _fallback_ads_lock:
+            if _fallback_ads_version == snapshot.version:
+                _fallback_ads[key] = ads
+
+    return ads
+
+
+def choose_fallback_ad(publisher, ad_type_slug, campaign_types, exclude=()):
+    """
+    Choose a random fallback ad for this publisher and ad type.
+
+    :param campaign_types: the campaign types this decision allows
+    :param exclude: IDs of ads that may not be chosen (eg. already in another slot)
+    :returns: an ``Advertisement`` or ``None``
+    """
+    campaign_types = [ct for ct in FALLBACK_CAMPAIGN_TYPES if ct in campaign_types]
+    if not campaign_types:
+        return None
+
+    ads = [
+        ad
+        for ad in get_fallback_ads(publisher, ad_type_slug, campaign_types)
+        if ad.pk not in exclude
+    ]
+    if not ads:
+        return None
+    return random.choice(ads)
@@ -0,0 +1,271 @@
+"""
+A local index of flight and ad embeddings for niche targeting and ad similarity.
+
+Niche targeting compares a page's embeddings to the embeddings of each flight's
+niche targeting URLs and ads are weighted by how similar they are to the page.
+Rather than running distance queries during every ad decision,
+the embeddings of flights and ads are held in an index in each worker
+and each decision scores all of them with a single vectorized call.
+
+* Embeddings are loaded by the function ``ADSERVER_EMBEDDING_INDEX_LOADER``
+  which returns the flight and ad embeddings (eg. from an extension's models)
+* The index is an ``ADSERVER_EMBEDDING_INDEX_BACKEND``.
+  The default is a NumPy matrix searched by cosine similarity.
+* Like the flight snapshot, the index is built by a Celery task and published
+  to the shared cache with a version. Workers reload it when the version changes.
+  The task runs periodically and should also be run after embeddings change
+  (``adserver.tasks.refresh_embedding_index``).
+* Without a loader or a published index, the decision engine
+  gets niche weights and ad similarity scores from ``ethicalads_ext.embedding``
+* NumPy is only installed with the ``analyzer`` extra.
+  Without it, the default index is never built or used.
+"""
+
+import logging
+from dataclasses import dataclass
+
+import uuid_utils.compat as uuid
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+log = logging.getLogger(__name__)  # noqa
+
+# Workers hold the most recently loaded index in memory
+_local_embedding_index = None
+
+
+@dataclass(frozen=True, slots=True)
+class EmbeddingScores:
+    """How close a page is to the flights and ads in an embedding index."""
+
+    # Flight ID -> cosine distance from the page to the flight's closest niche URL
+    flight_distances: dict
+
+    # Ad ID -> cosine similarity between the page and the ad (the most similar ads)
+    ad_similarities: dict
+
+
+class BaseEmbeddingIndex:
+    """
+    An index of flight and ad embeddings used by the decision engine.
+
+    Indexes are pickled to the shared cache so they should be plain data.
+    """
+
+    CACHE_KEY = "decisionengine-embedding-index"
+    VERSION_CACHE_KEY = "decisionengine-embedding-index-version"
+
+    # The index is refreshed periodically but it is never served if it is older than this
+    CACHE_TIMEOUT = 60 * 60 * 6
+
+    version = None
+
+    @classmethod
+    def is_available(cls):
+        """Whether the dependencies of this index are installed."""
+        return True
+
+    @classmethod
+    def build(cls, flight_embeddings, ad_embeddings):
+        """
+        Build an index from embeddings.
+
+        :param flight_embeddings: an iterable of ``(flight_id, vector)`` for each
+            niche targeting URL of a flight. Flights can have many vectors.
+        :param ad_embeddings: an iterable of ``(ad_id, vector)``
+        """
+        raise NotImplementedError
+
+    def score(self, query_embeddings):
+        """
+        Score all the flights and ads against the embeddings of a page.
+
+        :param query_embeddings: the page's embeddings (eg. the publisher and domain).
+            ``None`` embeddings are ignored and each flight or ad is scored
+            by the closest embedding.
+        :returns: ``EmbeddingScores``
+        """
+        raise NotImplementedError
+
+
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class NumpyEmbeddingIndex(BaseEmbeddingIndex):
+    """An in-memory matrix of normalized embeddings searched with a batched dot product."""
+
+    # Only the most similar ads get a similarity score
+    AD_SIMILARITY_TOP_K = 100
+
+    @classmethod
+    def is_available(cls):
+        return np is not None
+
+    def __init__(
+        self,
+        version,
+        created,
+        flight_ids,
+        flight_offsets,
+        flight_matrix,
+        ad_ids,
+        ad_matrix,
+    ):
+        self.version = version
+        self.created = created
+
+        # The flight ID of each group of rows in the flight matrix
+        # and the offset of each group. Rows are grouped by flight
+        self.flight_ids = flight_ids
+        self.flight_offsets = flight_offsets
+        self.flight_matrix = flight_matrix
+
+        self.ad_ids = ad_ids
+        self.ad_matrix = ad_matrix
+
+    @classmethod
+    def build(cls, flight_embeddings, ad_embeddings):
+        flight_embeddings = sorted(flight_embeddings, key=lambda item: item[0])
+        flight_ids = []
+        flight_offsets = []
+        for offset, (flight_id, _) in enumerate(flight_embeddings):
+            if not flight_ids or flight_ids[-1] != flight_id:
+                flight_ids.append(flight_id)
+                flight_offsets.append(offset)
+
+        ad_embeddings = list(ad_embeddings)
+
+        return cls(
+            version=str(uuid.uuid7()),
+            created=timezone.now(),
+            flight_ids=np.array(flight_ids, dtype=np.int64),
+            flight_offsets=np.array(flight_offsets, dtype=np.int64),
+            flight_matrix=cls._build_matrix(flight_embeddings),
+            ad_ids=np.array([ad_id for ad_id, _ in ad_embeddings], dtype=np.int64),
+            ad_matrix=cls._build_matrix(ad_embeddings),
+        )
+
+    @staticmethod
+    def _build_matrix(embeddings):
+        if not embeddings:
+            return np.zeros((0, 0), dtype=np.float32)
+        return _normalize(np.array([vector for _, vector in embeddings], np.float32))
+
+    def score(self, query_embeddings):
+        queries = [query for query in query_embeddings if query is not None]
+        if not queries:
+            return EmbeddingScores(flight_distances={}, ad_similarities={})
+
+        # One column per page embedding
+        queries = _normalize(np.array(queries, dtype=np.float32)).T
+
+        flight_distances = {}
+        if len(self.flight_ids):
+            # The similarity of each niche URL to the closest page embedding
+            similarities = (self.flight_matrix @ queries).max(axis=1)
+            # The most similar niche URL of each flight
+            similarities = np.maximum.reduceat(similarities, self.flight_offsets)
+            flight_distances = dict(
+                zip(self.flight_ids.tolist(), (1.0 - similarities).tolist())
+            )
+
+        ad_similarities = {}
+        if len(self.ad_ids):
+            similarities = (self.ad_matrix @ queries).max(axis=1)
+            top = np.arange(len(similarities))
+            if len(similarities) > self.AD_SIMILARITY_TOP_K:
+                top = np.argpartition(-similarities, self.AD_SIMILARITY_TOP_K)[
+                    : self.AD_SIMILARITY_TOP_K
+                ]
+            ad_similarities = dict(
+                zip(self.ad_ids[top].tolist(), similarities[top].tolist())
+            )
+
+        return EmbeddingScores(
+            flight_distances=flight_distances, ad_similarities=ad_similarities
+        )
+
+
+def get_embedding_index_class():
+    return import_string(settings.ADSERVER_EMBEDDING_INDEX_BACKEND)
+
+
+def publish_embedding_index():
+    """
+    Load all the embeddings, build an index and publish it to the shared cache.
+
+    :returns: the index or ``None`` if there's no ``ADSERVER_EMBEDDING_INDEX_LOADER``
+        or the index's dependencies (eg. NumPy) aren't installed
+    """
+    if not settings.ADSERVER_EMBEDDING_INDEX_LOADER:
+        return None
+
+    index_class = get_embedding_index_class()
+    if not index_class.is_available():
+        log.warning(
+            "Embedding index dependencies aren't installed. backend=%s",
+            settings.ADSERVER_EMBEDDING_INDEX_BACKEND,
+        )
+        return None
+
+    start_time = timezone.now()
+    loader = import_string(settings.ADSERVER_EMBEDDING_INDEX_LOADER)
+    flight_embeddings, ad_embeddings = loader()
+    index = index_class.build(flight_embeddings, ad_embeddings)
+
+    # Set the index before the version so workers never see a version
+    # that doesn't have an index available
+    cache.set(BaseEmbeddingIndex.CACHE_KEY, index, BaseEmbeddingIndex.CACHE_TIMEOUT)
+    cache.set(
+        BaseEmbeddingIndex.VERSION_CACHE_KEY,
+        index.version,
+        BaseEmbeddingIndex.CACHE_TIMEOUT,
+    )
+
+    log.info(
+        "Published embedding index. version=%s, duration=%s",
+        index.version,
+        timezone.now() - start_time,
+    )
+    return index
+
+
+def get_embedding_index():
+    """
+    Get the current embedding index or ``None`` if no index is published.
+
+    Like the flight snapshot, this costs a single cache lookup
+    when the worker already has the current version loaded.
+    """
+    global _local_embedding_index  # noqa: PLW0603
+
+    if (
+        not settings.ADSERVER_EMBEDDING_INDEX_LOADER
+        or not get_embedding_index_class().is_available()
+    ):
+        return None
+
+    version = cache.get(BaseEmbeddingIndex.VERSION_CACHE_KEY)
+    if not version:
+        return None
+
+    index = _local_embedding_index
+    if index is None or index.version != version:
+        index = cache.get(BaseEmbeddingIndex.CACHE_KEY)
+        if index is None or index.version != version:
+            return None
+        _local_embedding_index = index
+
+    return index
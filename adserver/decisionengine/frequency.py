@@ -0,0 +1,119 @@
+"""
+Per-user daily frequency caps for flights using compact probabilistic counters.
+
+How many times a user saw a flight's ads today is estimated
+with a count-min sketch per capped flight per day.
+The sketch is a few rows of small counters and every view increments one counter
+in each row chosen by hashing the user's client ID.
+A user's estimate is the smallest of their counters.
+Estimates are never too low but other users sharing counters can make them too high
+so a user is occasionally capped a bit early.
+The memory used is fixed by the width of the sketch
+(``ADSERVER_FREQUENCY_CAP_SKETCH_WIDTH``) no matter how many users there are.
+
+With Redis (django-redis), each row is a Redis string of 8-bit counters
+that stop at 255 (the largest allowed cap),
+updated with ``BITFIELD``. All the counters needed for an ad decision
+are read in a single pipelined round trip.
+Other caches (eg. in development and testing) store each counter as a cache key.
+"""
+
+import hashlib
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+
+from ..counters import get_redis_client
+from ..utils import get_ad_day
+
+
+log = logging.getLogger(__name__)  # noqa
+
+CACHE_KEY_PREFIX = "frequency-cap"
+CACHE_TIMEOUT = 60 * 60 * 48
+
+# Rows in each sketch. More rows make estimates more accurate but cost more to update
+SKETCH_DEPTH = 4
+
+
+def get_sketch_columns(client_id):
+    """Get the counter in each row of a sketch for this user."""
+    width = settings.ADSERVER_FREQUENCY_CAP_SKETCH_WIDTH
+    digest = hashlib.blake2b(
+        str(client_id).encode("utf-8"), digest_size=4 * SKETCH_DEPTH
+    ).digest()
+    return [
+        int.from_bytes(digest[row * 4 : (row + 1) * 4], "big") % width
+        for row in range(SKETCH_DEPTH)
+    ]
+
+
+def get_sketch_key(flight_id, row, day=None):
+    day = day or get_ad_day().date()
+    return f"{CACHE_KEY_PREFIX}::{flight_id}::{day:%Y-%m-%d}::{row}"
+
+
+def get_frequency_counts(client_id, flights):
+    """
+    Estimate how many times this user saw each of the flights today.
+
+    :returns: a dictionary of flight ID -> estimated views today
+    """
+    flight_ids = [flight.pk for flight in flights]
+    if not flight_ids:
+        return {}
+
+    columns = get_sketch_columns(client_id)
+    client = get_redis_client()
+
+    counts = {}
+    if client:
+        pipeline = client.pipeline(transaction=False)
+        for flight_id in flight_ids:
+            for row, column in enumerate(columns):
+                sketch_key = cache.make_key(get_sketch_key(flight_id, row))
+                bitfield = pipeline.bitfield(sketch_key)
+                bitfield.get("u8", f"#{column}").execute()
+
+        results = iter(pipeline.execute())
+        for flight_id in flight_ids:
+            counts[flight_id] = min(next(results)[0] for _ in columns)
+    else:
+        keys = {
+            (flight_id, row): f"{get_sketch_key(flight_id, row)}::{column}"
+            for flight_id in flight_ids
+            for row, column in enumerate(columns)
+        }
+        values = cache.get_many(keys.values())
+        for flight_id in flight_ids:
+            counts[flight_id] = min(
+                values.get(keys[(flight_id, row)], 0) for row in range(SKETCH_DEPTH)
+            )
+
+    return counts
+
+
+def record_frequency(client_id, flight):
+    """Count a view of one of the flight's ads by this user today."""
+    columns = get_sketch_columns(client_id)
+    client = get_redis_client()
+
+    if client:
+        pipeline = client.pipeline(transaction=False)
+        for row, column in enumerate(columns):
+            sketch_key = cache.make_key(get_sketch_key(flight.pk, row))
+            bitfield = pipeline.bitfield(sketch_key, default_overflow="SAT")
+            bitfield.incrby("u8", f"#{column}", 1).execute()
+            pipeline.expire(sketch_key, CACHE_TIMEOUT)
+        pipeline.execute()
+        return
+
+    for row, column in enumerate(columns):
+        key = f"{get_sketch_key(flight.pk, row)}::{column}"
+        if not cache.add(key, 1, timeout=CACHE_TIMEOUT):
+            try:
+                cache.incr(key)
+            except ValueError:
+                # The counter expired since it was added
+                cache.add(key, 1, timeout=CACHE_TIMEOUT)
@@ -0,0 +1,275 @@
+"""
+Targeting indexes over the flights in a flight snapshot.
+
+Rather than checking the targeting of every candidate flight on every ad decision,
+these indexes are built once with the flight snapshot
+(see ``adserver.decisionengine.snapshot``)
+so a decision can find the eligible flights with a few set lookups.
+"""
+
+import logging
+from dataclasses import dataclass
+
+
+log = logging.getLogger(__name__)  # noqa
+
+
+@dataclass(frozen=True, slots=True)
+class KeywordMatch:
+    """The flights matching the keywords for an ad decision."""
+
+    included: frozenset
+    topic_included: frozenset
+    excluded: frozenset
+    keyword_targeted: frozenset
+    topic_targeted: frozenset
+
+    def __contains__(self, flight_id):
+        """Whether the flight is eligible for these keywords (``Flight.show_to_keywords``)."""
+        if flight_id in self.excluded:
+            return False
+        if flight_id in self.keyword_targeted and flight_id not in self.included:
+            return False
+        if flight_id in self.topic_targeted and flight_id not in self.topic_included:
+            return False
+        return True
+
+
+@dataclass(frozen=True, slots=True)
+class KeywordIndex:
+    """
+    An inverted index from a keyword to the flights that target it.
+
+    Flights can include a keyword directly, include it via a topic, or exclude it.
+    """
+
+    # Keyword -> flight IDs
+    includes: dict
+    topic_includes: dict
+    excludes: dict
+
+    # Flights that only show for certain keywords or topics
+    keyword_targeted: frozenset
+    topic_targeted: frozenset
+
+    @classmethod
+    def build(cls, snapshot_flights, topics):
+        """
+        Build the index from the snapshot flights.
+
+        :param snapshot_flights: an iterable of ``SnapshotFlight``
+        :param topics: the topic to keywords mapping from ``Topic.load_from_cache``
+        """
+        includes = {}
+        topic_includes = {}
+        excludes = {}
+        keyword_targeted = set()
+        topic_targeted = set()
+
+        for sflight in snapshot_flights:
+            flight_id = sflight.flight.pk
+            targeting = sflight.targeting
+
+            if targeting.include_keywords:
+                keyword_targeted.add(flight_id)
+            for keyword in targeting.include_keywords:
+                includes.setdefault(keyword, set()).add(flight_id)
+
+            for keyword in targeting.exclude_keywords:
+                excludes.setdefault(keyword, set()).add(flight_id)
+
+            if targeting.include_topics:
+                topic_targeted.add(flight_id)
+            for topic_slug in targeting.include_topics:
+                # Unknown topics can never match any keywords
+                if topic_slug not in topics:
+                    log.warning(
+                        "Unknown topic being targeted. Topic=%s, Flight=%s",
+                        topic_slug,
+                        sflight.flight,
+                    )
+                    continue
+                for keyword in topics[topic_slug]:
+                    topic_includes.setdefault(keyword, set()).add(flight_id)
+
+        return cls(
+            includes={k: frozenset(v) for k, v in includes.items()},
+            topic_includes={k: frozenset(v) for k, v in topic_includes.items()},
+            excludes={k: frozenset(v) for k, v in excludes.items()},
+            keyword_targeted=frozenset(keyword_targeted),
+            topic_targeted=frozenset(topic_targeted),
+        )
+
+    def match(self, keywords):
+        """Get the flights matching these keywords (test with ``flight_id in match``)."""
+        empty = frozenset()
+        keywords = set(keywords)
+
+        return KeywordMatch(
+            included=empty.union(*(self.includes.get(k, empty) for k in keywords)),
+            topic_included=empty.union(
+                *(self.topic_includes.get(k, empty) for k in keywords)
+            ),
+            excluded=empty.union(*(self.excludes.get(k, empty) for k in keywords)),
+            keyword_targeted=self.keyword_targeted,
+            topic_targeted=self.topic_targeted,
+        )
+
+
+@dataclass(frozen=True, slots=True)
+class GeoMatch:
+    """The flights matching the geolocation for an ad decision (as a bitset)."""
+
+    bits: int
+    flight_bits: dict
+
+    def __contains__(self, flight_id):
+        """Whether the flight is eligible for this geo (``Flight.show_to_geo``)."""
+        bit = self.flight_bits.get(flight_id)
+        if bit is None:
+            return False
+        return bool(self.bits >> bit & 1)
+
+
+@dataclass(frozen=True, slots=True)
+class GeoIndex:
+    """
+    A geo targeting index where sets of flights are integer bitsets.
+
+    Each flight in the snapshot is assigned a bit.
+    Countries, states and metros map to the flights that include (or exclude) them
+    and regions and traffic caps are expanded into the countries they cover.
+    Matching a geolocation is then a handful of ANDs.
+    """
+
+    # Flight ID -> the flight's bit
+    flight_bits: dict
+    all_flights: int
+
+    # Flights without any targeting of that kind
+    country_untargeted: int
+    state_untargeted: int
+    metro_untargeted: int
+    region_untargeted: int
+
+    # Country/state/metro -> flights
+    country_includes: dict
+    country_excludes: dict
+    state_includes: dict
+    metro_includes: dict
+
+    # Country -> flights including/excluding a region with that country
+    region_includes: dict
+    region_excludes: dict
+
+    # Country -> flights that have exceeded their traffic cap for the country
+    # (or for a region with that country)
+    traffic_capped: dict
+
+    @classmethod
+    def build(cls, snapshot_flights, regions):
+        """
+        Build the index from the snapshot flights.
+
+        :param snapshot_flights: an iterable of ``SnapshotFlight``
+        :param regions: the region to countries mapping from ``Region.load_from_cache``
+        """
+        flight_bits = {}
+        country_untargeted = state_untargeted = metro_untargeted = 0
+        region_untargeted = 0
+        country_includes = {}
+        country_excludes = {}
+        state_includes = {}
+        metro_includes = {}
+        region_includes = {}
+        region_excludes = {}
+        traffic_capped = {}
+
+        def add(mapping, key, bit):
+            mapping[key] = mapping.get(key, 0) | bit
+
+        for position, sflight in enumerate(snapshot_flights):
+            flight = sflight.flight
+            targeting = sflight.targeting
+            bit = 1 << position
+            flight_bits[flight.pk] = position
+
+            if not targeting.include_countries:
+                country_untargeted |= bit
+            for country in targeting.include_countries:
+                add(country_includes, country, bit)
+            for country in targeting.exclude_countries:
+                add(country_excludes, country, bit)
+
+            if not targeting.include_state_provinces:
+                state_untargeted |= bit
+            for state in targeting.include_state_provinces:
+                add(state_includes, state, bit)
+
+            if not targeting.include_metro_codes:
+                metro_untargeted |= bit
+            for metro in targeting.include_metro_codes:
+                add(metro_includes, metro, bit)
+
+            # Unknown regions are ignored (they match no countries)
+            if not targeting.include_regions:
+                region_untargeted |= bit
+            for region_slug in targeting.include_regions:
+                for country in regions.get(region_slug, ()):
+                    add(region_includes, country, bit)
+            for region_slug in targeting.exclude_regions:
+                for country in regions.get(region_slug, ()):
+                    add(region_excludes, country, bit)
+
+            # Traffic caps change only when the traffic fill is updated
+            # which causes the snapshot to be rebuilt
+            if not flight.traffic_cap or not flight.traffic_fill:
+                continue
+
+            if "countries" in flight.traffic_cap:
+                limited_countries = flight.traffic_cap["countries"]
+                country_fill = flight.traffic_fill.get("countries", {})
+                for country, fill in country_fill.items():
+                    if fill > limited_countries.get(country, 100.0):
+                        add(traffic_capped, country, bit)
+
+            if "regions" in flight.traffic_cap:
+                limited_regions = flight.traffic_cap["regions"]
+                region_fill = flight.traffic_fill.get("regions", {})
+                for region_slug, countries in regions.items():
+                    if region_fill.get(region_slug, 0.0) > limited_regions.get(
+                        region_slug, 100.0
+                    ):
+                        for country in countries:
+                            add(traffic_capped, country, bit)
+
+        return cls(
+            flight_bits=flight_bits,
+            all_flights=(1 << len(flight_bits)) - 1,
+            country_untargeted=country_untargeted,
+            state_untargeted=state_untargeted,
+            metro_untargeted=metro_untargeted,
+            region_untargeted=region_untargeted,
+            country_includes=country_includes,
+            country_excludes=country_excludes,
+            state_includes=state_includes,
+            metro_includes=metro_includes,
+            region_includes=region_includes,
+            region_excludes=region_excludes,
+            traffic_capped=traffic_capped,
+        )
+
+    def match(self, geo_data):
+        """Get the flights matching this geolocation (test with ``flight_id in match``)."""
+        country = geo_data.country
+
+        bits = self.all_flights
+        bits &= self.country_untargeted | self.country_includes.get(country, 0)
+        bits &= self.state_untargeted | self.state_includes.get(geo_data.region, 0)
+        bits &= self.metro_untargeted | self.metro_includes.get(geo_data.metro, 0)
+        bits &= self.region_untargeted | self.region_includes.get(country, 0)
+        bits &= ~self.country_excludes.get(country, 0)
+        bits &= ~self.region_excludes.get(country, 0)
+        bits &= ~self.traffic_capped.get(country, 0)
+
+        return GeoMatch(bits=bits, flight_bits=self.flight_bits)
@@ -0,0 +1,89 @@
+"""
+A short-lived negative cache of ad requests that can't match any paid inventory.
+
+Many ad decisions come from publishers or ad types that no paid, affiliate
+or community flight can match. Rather than querying and filtering the candidate
+flights again for each of these requests, a decision that finds no such flight
+is remembered for ``ADSERVER_DECISION_NEGATIVE_CACHE_TIMEOUT`` seconds
+and similar requests only look for house ads.
+
+* Requests are similar when they have the same publisher, ad types,
+  (non-house) campaign types and country
+* A request is only remembered when every candidate flight for it is ruled out
+  by targeting that only depends on those (geo targeting by country and publisher targeting)
+* Any committed change to flights, campaigns, ads or publisher groups (see ``adserver.signals``)
+  that can affect targeting starts a new generation,
+  which invalidates everything remembered before it
+"""
+
+import logging
+
+import uuid_utils.compat as uuid
+from django.conf import settings
+from django.core.cache import cache
+
+from ..constants import AFFILIATE_CAMPAIGN
+from ..constants import COMMUNITY_CAMPAIGN
+from ..constants import PAID_CAMPAIGN
+
+
+log = logging.getLogger(__name__)  # noqa
+
+CACHE_KEY_PREFIX = "decisionengine-no-inventory"
+GENERATION_CACHE_KEY = "decisionengine-inventory-generation"
+GENERATION_CACHE_TIMEOUT = 60 * 60 * 24
+
+# The campaign types that are skipped for requests without any inventory
+INVENTORY_CAMPAIGN_TYPES = (PAID_CAMPAIGN, AFFILIATE_CAMPAIGN, COMMUNITY_CAMPAIGN)
+
+
+def get_no_inventory_cache_key(publisher, ad_types, campaign_types, country):
+    ad_types = ",".join(sorted(ad_types))
+    campaign_types = ",".join(sorted(campaign_types))
+    return (
+        f"{CACHE_KEY_PREFIX}::{publisher.pk}::{ad_types}::{campaign_types}::{country}"
+    )
+
+
+def check_no_inventory(publisher, ad_types, campaign_types, country):
+    """
+    Check whether a recent decision for this request found no flights of these campaign types.
+
+    This costs a single cache lookup.
+
+    :returns: a 2-tuple of whether the request has no inventory
+        and the current generation (passed to ``record_no_inventory``)
+    """
+    key = get_no_inventory_cache_key(publisher, ad_types, campaign_types, country)
+    values = cache.get_many([key, GENERATION_CACHE_KEY])
+    generation = values.get(GENERATION_CACHE_KEY)
+    if generation is None:
+        cache.add(GENERATION_CACHE_KEY, str(uuid.uuid7()), GENERATION_CACHE_TIMEOUT)
+        return False, cache.get(GENERATION_CACHE_KEY)
+
+    return values.get(key) == generation, generation
+
+
+def record_no_inventory(publisher, ad_types, campaign_types, country, generation):
+    """
+    Remember that no flights of these campaign types can match this request.
+
+    :param generation: the generation when the decision started.
+        If flights changed since then, what's remembered is never used.
+    """
+    log.debug(
+        "No inventory for request. publisher=%s, ad_types=%s, country=%s",
+        publisher,
+        ad_types,
+        country,
+    )
+    cache.set(
+        get_no_inventory_cache_key(publisher, ad_types, campaign_types, country),
+        generation,
+        settings.ADSERVER_DECISION_NEGATIVE_CACHE_TIMEOUT,
+    )
+
+
+def invalidate_no_inventory():
+    """Forget every request remembered as having no inventory (eg. after flights change)."""
+    cache.set(GENERATION_CACHE_KEY, str(uuid.uuid7()), GENERATION_CACHE_TIMEOUT)
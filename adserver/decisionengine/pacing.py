@@ -0,0 +1,140 @@
+"""
+Precomputed ad pacing for the decision engine.
+
+Pacing a flight (how many clicks and views it needs this interval weighted by its value)
+involves a fair bit of date math for every candidate flight on every ad decision.
+Instead, the pacing weights of all live flights are computed periodically
+by a Celery task and published to the shared cache.
+Since the weight depends on the publisher's CTR for CPC flights,
+a weight is computed for each publisher CTR bucket.
+
+Decisions read the precomputed weights and fall back to computing
+the pacing for flights that aren't in the snapshot (eg. brand new flights).
+"""
+
+import bisect
+import datetime
+import logging
+from dataclasses import dataclass
+
+import uuid_utils.compat as uuid
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from ..models import Flight
+
+
+log = logging.getLogger(__name__)  # noqa
+
+# Publisher CTRs (in percent) are bucketed to the nearest lower value here
+# Publishers with a CTR of 0.01% or less use the flight's own CTR
+PACING_CTR_BUCKETS = (
+    0.01,
+    0.02,
+    0.03,
+    0.05,
+    0.075,
+    0.1,
+    0.125,
+    0.15,
+    0.2,
+    0.3,
+    0.5,
+)
+
+# Workers hold the most recently loaded pacing snapshot in memory
+_local_pacing_snapshot = None
+
+
+def get_ctr_bucket(publisher):
+    """
+    Get the index of the pacing weight to use for this publisher.
+
+    Index 0 is the weight using the flight's CTR.
+    """
+    if not publisher or publisher.sampled_ctr <= 0.01:
+        return 0
+
+    return bisect.bisect_right(PACING_CTR_BUCKETS, publisher.sampled_ctr)
+
+
+@dataclass(frozen=True, slots=True)
+class PacingSnapshot:
+    """The pacing weights for all live flights at a point in time."""
+
+    CACHE_KEY = "decisionengine-pacing-snapshot"
+    VERSION_CACHE_KEY = "decisionengine-pacing-snapshot-version"
+
+    version: str
+    created: datetime.datetime
+
+    # Flight ID -> weight for each CTR bucket (see ``get_ctr_bucket``)
+    weights: dict
+
+    @classmethod
+    def build(cls):
+        """Compute the pacing weights for all live flights."""
+        weights = {}
+        for flight in Flight.objects.filter(live=True).select_related("campaign"):
+            impressions_needed = flight.impressions_needed_this_interval()
+            weights[flight.pk] = tuple(
+                flight.weight_impressions_needed(impressions_needed, publisher_ctr)
+                for publisher_ctr in (None, *PACING_CTR_BUCKETS)
+            )
+
+        return cls(
+            version=str(uuid.uuid7()),
+            created=timezone.now(),
+            weights=weights,
+        )
+
+    def get_weight(self, flight, publisher=None):
+        """Get the pacing weight of a flight or ``None`` if it isn't in the snapshot."""
+        flight_weights = self.weights.get(flight.pk)
+        if flight_weights is None:
+            return None
+        return flight_weights[get_ctr_bucket(publisher)]
+
+
+def publish_pacing_snapshot():
+    """Compute the pacing weights of all live flights and publish them to the shared cache."""
+    start_time = timezone.now()
+    snapshot = PacingSnapshot.build()
+
+    # Stale pacing is worse than computing it during the decision
+    # so expire it if it isn't refreshed for a few intervals
+    timeout = settings.ADSERVER_PACING_SNAPSHOT_INTERVAL * 5
+    cache.set(PacingSnapshot.CACHE_KEY, snapshot, timeout)
+    cache.set(PacingSnapshot.VERSION_CACHE_KEY, snapshot.version, timeout)
+
+    log.info(
+        "Published pacing snapshot. version=%s, flights=%s, duration=%s",
+        snapshot.version,
+        len(snapshot.weights),
+        timezone.now() - start_time,
+    )
+    return snapshot
+
+
+def get_pacing_snapshot():
+    """
+    Get the current pacing snapshot or ``None`` if no current snapshot is published.
+
+    Like the flight snapshot, this costs a single cache lookup
+    when the worker already has the current version loaded.
+    """
+    global _local_pacing_snapshot  # noqa: PLW0603
+
+    version = cache.get(PacingSnapshot.VERSION_CACHE_KEY)
+    if not version:
+        return None
+
+    snapshot = _local_pacing_snapshot
+    if snapshot is None or snapshot.version != version:
+        snapshot = cache.get(PacingSnapshot.CACHE_KEY)
+        if snapshot is None or snapshot.version != version:
+            return None
+        _local_pacing_snapshot = snapshot
+
+    return snapshot
@@ -0,0 +1,89 @@
+"""
+A cached, pre-resolved view of a publisher for the decision engine.
+
+Every ad decision resolves the publisher by its slug, checks its groups
+for candidate flights and parses its default keywords.
+Publishers change rarely relative to the number of ad decisions
+so these are resolved once and stored in the shared cache by slug.
+Cached contexts are invalidated when a publisher or its groups change
+(see ``adserver.signals``).
+"""
+
+import logging
+from dataclasses import dataclass
+
+from django.core.cache import cache
+
+from ..models import Publisher
+from ..models import PublisherGroup
+
+
+log = logging.getLogger(__name__)  # noqa
+
+
+@dataclass(frozen=True, slots=True)
+class PublisherDecisionContext:
+    """
+    Everything the decision engine needs about a publisher.
+
+    The ``publisher`` instance is used for offers and the publisher's flags
+    and is shared between decisions so it must be treated as read-only.
+    """
+
+    CACHE_KEY_PREFIX = "decisionengine-publisher-context"
+
+    # Contexts are invalidated when publishers change
+    # but they are never served if they are older than this
+    CACHE_TIMEOUT = 60 * 60
+
+    publisher: Publisher
+    publisher_group_ids: frozenset
+    keywords: tuple
+    allowed_domains: frozenset
+    daily_cap: float | None
+
+    @classmethod
+    def cache_key(cls, publisher_slug):
+        return f"{cls.CACHE_KEY_PREFIX}::{publisher_slug}"
+
+    @classmethod
+    def from_publisher(cls, publisher):
+        """Resolve the decision context for a publisher from the database."""
+        group_ids = PublisherGroup.publishers.through.objects.filter(
+            publisher_id=publisher.pk
+        ).values_list("publishergroup_id", flat=True)
+
+        return cls(
+            publisher=publisher,
+            publisher_group_ids=frozenset(group_ids),
+            keywords=tuple(publisher.keywords),
+            allowed_domains=frozenset(publisher.allowed_domains_as_list()),
+            daily_cap=float(publisher.daily_cap) if publisher.daily_cap else None,
+        )
+
+
+def get_publisher_decision_context(publisher_slug):
+    """
+    Get the decision context for the publisher with this slug.
+
+    This costs a single cache lookup when the context is already cached.
+
+    :returns: a ``PublisherDecisionContext`` or ``None`` if there's no such publisher
+    """
+    cache_key = PublisherDecisionContext.cache_key(publisher_slug)
+    context = cache.get(cache_key)
+    if context is None:
+        publisher = Publisher.objects.filter(slug=publisher_slug).first()
+        if not publisher:
+            return None
+
+        log.debug("Caching publisher decision context. publisher=%s", publisher_slug)
+        context = PublisherDecisionContext.from_publisher(publisher)
+        cache.set(cache_key, context, PublisherDecisionContext.CACHE_TIMEOUT)
+
+    return context
+
+
+def invalidate_publisher_decision_context(publisher_slug):
+    """Remove a publisher's cached decision context so the next decision rebuilds it."""
+    cache.delete(PublisherDecisionContext.cache_key(publisher_slug))
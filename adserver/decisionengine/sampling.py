@@ -0,0 +1,77 @@
+"""
+Weighted random sampling for choosing flights and ads.
+
+Flights are chosen in proportion to the impressions they need
+and ads in proportion to their placement priority, CTR and similarity.
+Rather than materializing a copy of each item for every unit of weight
+or scanning a list of ranges, the cumulative weights are computed once
+and a sample is a single random draw and a binary search.
+"""
+
+import bisect
+import itertools
+import random
+
+
+class WeightedSampler:
+    """
+    An immutable weighted sampler over a sequence of items.
+
+    Building the sampler is linear in the number of items (not their weights)
+    and each sample is ``O(log n)``.
+    Since it holds no per-request state, a sampler can be cached and reused.
+    """
+
+    __slots__ = ("items", "cumulative_weights", "total_weight")
+
+    def __init__(self, weighted_items):
+        """
+        Build the sampler.
+
+        :param weighted_items: an iterable of ``(item, weight)`` pairs
+            where weights are non-negative
+        """
+        weighted_items = list(weighted_items)
+        self.items = tuple(item for item, _ in weighted_items)
+        self.cumulative_weights = tuple(
+            itertools.accumulate(weight for _, weight in weighted_items)
+        )
+        self.total_weight = (
+            self.cumulative_weights[-1] if self.cumulative_weights else 0
+        )
+
+    def __len__(self):
+        return len(self.items)
+
+    def __bool__(self):
+        return bool(self.items)
+
+    def find(self, value):
+        """
+        Get the item where ``value`` falls in its range of cumulative weights.
+
+        Ranges include both endpoints and the first matching item wins
+        so the first item covers ``[0, w1]`` and the second ``(w1, w1 + w2]``.
+        Returns ``None`` if ``value`` is outside ``[0, total_weight]``.
+        """
+        if not self.items or value < 0 or value > self.total_weight:
+            return None
+        return self.items[bisect.bisect_left(self.cumulative_weights, value)]
+
+    def sample(self):
+        """
+        Choose a random item with probability proportional to its weight.
+
+        Returns ``None`` if there are no items or they all have no weight.
+        """
+        if self.total_weight <= 0:
+            return None
+
+        if isinstance(self.total_weight, int):
+            value = random.randrange(self.total_weight)
+        else:
+            value = random.random() * self.total_weight
+        index = bisect.bisect_right(self.cumulative_weights, value)
+
+        # Guard against floating point rounding at the upper end
+        return self.items[min(index, len(self.items) - 1)]
@@ -0,0 +1,176 @@
+"""
+Shadow mode for comparing a new decision backend against the current one on real traffic.
+
+For a sampled fraction of ad decisions (``ADSERVER_DECISION_SHADOW_SAMPLE_RATE``),
+the shadow backend (``ADSERVER_DECISION_SHADOW_BACKEND``) makes the same decision
+after the response is sent (when the ``request_finished`` signal is sent).
+The shadow backend only chooses an ad: no offer is recorded
+and it doesn't read or write the negative inventory cache or frequency caps.
+The chosen flights and ads, the latencies and the query counts of both backends
+are logged as JSON.
+
+Both backends choose ads randomly (weighted by pacing and targeting)
+so some differences are expected. Consistent differences are what to look for.
+"""
+
+import contextvars
+import json
+import logging
+import random
+import time
+
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db import close_old_connections
+from django.db import connection
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+
+log = logging.getLogger(__name__)  # noqa
+
+# The shadow decisions to run once the current request is finished
+_pending_shadow_decisions = contextvars.ContextVar(
+    "pending_shadow_decisions", default=None
+)
+
+
+def get_shadow_backend():
+    """Get the shadow decision backend class or ``None`` if shadow mode is off."""
+    if not settings.ADSERVER_DECISION_SHADOW_BACKEND:
+        return None
+
+    return import_string(settings.ADSERVER_DECISION_SHADOW_BACKEND)
+
+
+def should_shadow_decision():
+    """Whether to run the shadow backend for this ad decision."""
+    sample_rate = settings.ADSERVER_DECISION_SHADOW_SAMPLE_RATE
+    return (
+        bool(settings.ADSERVER_DECISION_SHADOW_BACKEND)
+        and bool(sample_rate)
+        and random.random() < sample_rate
+    )
+
+
+def schedule_shadow_decision(shadow):
+    """Run the shadow decision once the response for the current request is sent."""
+    pending = _pending_shadow_decisions.get()
+    if pending is None:
+        pending = []
+        _pending_shadow_decisions.set(pending)
+    pending.append(shadow)
+
+
+@receiver(request_finished)
+def run_shadow_decisions(sender, **kwargs):
+    """Run the shadow decisions scheduled during the request that just finished."""
+    pending = _pending_shadow_decisions.get()
+    if not pending:
+        return
+
+    _pending_shadow_decisions.set(None)
+    for shadow in pending:
+        shadow.run()
+
+    # Database connections were already cleaned up for this request
+    close_old_connections()
+
+
+class QueryCounter:
+    """A database execute wrapper that counts the queries run."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class DecisionMeasurement:
+    """The result, duration and query count of choosing an ad with a backend."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.ad = None
+        self.duration = None
+        self.queries = None
+
+    def run(self):
+        """Choose an ad with the backend and measure it."""
+        counter = QueryCounter()
+        with connection.execute_wrapper(counter):
+            start_time = time.perf_counter()
+            ad, placement = self.backend.get_ad_and_placement()
+            self.duration = time.perf_counter() - start_time
+
+        self.ad = ad
+        self.queries = counter.count
+        return ad, placement
+
+    def as_dict(self):
+        backend_class = type(self.backend)
+        return {
+            "backend": f"{backend_class.__module__}.{backend_class.__name__}",
+            "ad": self.ad.slug if self.ad else None,
+            "flight": self.ad.flight.slug if self.ad else None,
+            "duration": round(self.duration, 6),
+            "queries": self.queries,
+        }
+
+
+class ShadowDecision:
+    """Compares the current backend's decision with the shadow backend's decision."""
+
+    def __init__(self, backend_class, **backend_kwargs):
+        """
+        Prepare a shadow decision.
+
+        :param backend_class: the shadow decision backend class
+        :param backend_kwargs: the arguments the current backend was created with
+        """
+        self.backend_class = backend_class
+        self.backend_kwargs = backend_kwargs
+        self.primary = None
+
+    def run_primary(self, backend):
+        """Choose the ad for the response with the current backend, measuring it."""
+        self.primary = DecisionMeasurement(backend)
+        return self.primary.run()
+
+    def run(self):
+        """
+        Make the same decision with the shadow backend and log the comparison.
+
+        This runs after the response is sent and never raises.
+        """
+        if not self.primary or self.primary.duration is None:
+            return None
+
+        try:
+            shadow = DecisionMeasurement(
+                self.backend_class(shadow=True, **self.backend_kwargs)
+            )
+            shadow.run()
+        except Exception:
+            log.exception("Shadow decision failed. backend=%s", self.backend_class)
+            return None
+
+        primary_data = self.primary.as_dict()
+        shadow_data = shadow.as_dict()
+        data = {
+            "publisher": self.backend_kwargs["publisher"].slug,
+            "primary": primary_data,
+            "shadow": shadow_data,
+            "same_flight": primary_data["flight"] == shadow_data["flight"],
+            "same_ad": primary_data["ad"] == shadow_data["ad"],
+            # How long the shadow backend took relative to the current one
+            "latency_ratio": (
+                round(shadow.duration / self.primary.duration, 3)
+                if self.primary.duration
+                else None
+            ),
+        }
+        log.info("Shadow decision: %s", json.dumps(data))
+        return data
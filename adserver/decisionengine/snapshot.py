@@ -0,0 +1,322 @@
+"""
+An in-process, versioned snapshot of the live flights used by the decision engine.
+
+Building the candidate flights for an ad decision is a multi-join query
+across flights, campaigns, publisher groups, advertisements and ad types.
+Since live flights change rarely relative to the number of ad decisions,
+this module compiles everything needed to choose candidate flights
+(and the live ads in them) into an immutable snapshot
+which is rebuilt in the background when flights or ads change.
+
+* The snapshot is built by a Celery task and published to the shared cache
+  along with a version key
+* Each worker keeps its own copy in memory and only reloads it from the shared
+  cache when the published version changes
+* Changes to flights, campaigns, ads, publisher groups, regions and topics
+  trigger a rebuild (see ``adserver.signals``)
+"""
+
+import datetime
+import logging
+import threading
+from dataclasses import dataclass
+
+import uuid_utils.compat as uuid
+from django.core.cache import cache
+from django.utils import timezone
+
+from ..models import Advertisement
+from ..models import Campaign
+from ..models import Flight
+from ..models import PublisherGroup
+from ..models import Region
+from ..models import Topic
+from .indexes import GeoIndex
+from .indexes import KeywordIndex
+
+
+log = logging.getLogger(__name__)  # noqa
+
+# Workers hold the most recently loaded snapshot in memory
+_local_snapshot = None
+_local_snapshot_lock = threading.Lock()
+
+
+@dataclass(frozen=True, slots=True)
+class FlightTargeting:
+    """Targeting parameters for a flight parsed into sets for fast lookups."""
+
+    include_countries: frozenset
+    exclude_countries: frozenset
+    include_state_provinces: frozenset
+    include_metro_codes: frozenset
+    include_regions: frozenset
+    exclude_regions: frozenset
+    include_topics: frozenset
+    include_keywords: frozenset
+    exclude_keywords: frozenset
+    include_publishers: frozenset
+    exclude_publishers: frozenset
+    include_domains: frozenset
+    exclude_domains: frozenset
+    days: frozenset
+    mobile_traffic: str | None
+    niche_targeting: float
+
+    @classmethod
+    def from_flight(cls, flight):
+        mobile_traffic = None
+        if flight.targeting_parameters:
+            mobile_traffic = flight.targeting_parameters.get("mobile_traffic")
+
+        return cls(
+            include_countries=frozenset(flight.included_countries),
+            exclude_countries=frozenset(flight.excluded_countries),
+            include_state_provinces=frozenset(flight.included_state_provinces),
+            include_metro_codes=frozenset(flight.included_metro_codes),
+            include_regions=frozenset(flight.included_regions),
+            exclude_regions=frozenset(flight.excluded_regions),
+            include_topics=frozenset(flight.included_topics),
+            include_keywords=frozenset(flight.included_keywords),
+            exclude_keywords=frozenset(flight.excluded_keywords),
+            include_publishers=frozenset(flight.included_publishers),
+            exclude_publishers=frozenset(flight.excluded_publishers),
+            include_domains=frozenset(flight.included_domains),
+            exclude_domains=frozenset(flight.excluded_domains),
+            days=frozenset(flight.days),
+            mobile_traffic=mobile_traffic,
+            niche_targeting=flight.niche_targeting,
+        )
+
+
+@dataclass(frozen=True, slots=True)
+class SnapshotAd:
+    """
+    A live ad in a snapshot flight.
+
+    The ``advertisement`` instance has its ad types prefetched
+    and its flight, campaign and advertiser set so it can be rendered without queries.
+    Like the flight, it is shared between decisions and must be treated as read-only.
+    """
+
+    advertisement: Advertisement
+    ad_type_slugs: frozenset
+
+
+@dataclass(frozen=True, slots=True)
+class SnapshotFlight:
+    """
+    A live flight along with everything needed to decide if it's a candidate.
+
+    The ``flight`` instance (with its campaign and advertiser preloaded)
+    is shared between decisions and must be treated as read-only.
+    """
+
+    flight: Flight
+    campaign_type: str
+    start_date: datetime.date
+    publisher_group_ids: frozenset
+    excluded_publisher_ids: frozenset
+    ad_type_slugs: frozenset
+    ads: tuple
+    targeting: FlightTargeting
+
+
+@dataclass(frozen=True, slots=True)
+class FlightSnapshot:
+    """An immutable, versioned collection of all live flights."""
+
+    CACHE_KEY = "decisionengine-flight-snapshot"
+    VERSION_CACHE_KEY = "decisionengine-flight-snapshot-version"
+    REFRESH_PENDING_CACHE_KEY = "decisionengine-flight-snapshot-refresh-pending"
+
+    # The snapshot is rebuilt whenever flights change
+    # but it is never served if it is older than this
+    CACHE_TIMEOUT = 60 * 30
+
+    version: str
+    created: datetime.datetime
+    flights: tuple
+    publisher_groups: dict
+    geo_index: GeoIndex
+    keyword_index: KeywordIndex
+
+    @classmethod
+    def build(cls):
+        """Compile a new snapshot of all live flights from the database."""
+        flights = list(
+            Flight.objects.filter(live=True).select_related(
+                "campaign", "campaign__advertiser"
+            )
+        )
+        flight_ids = [f.pk for f in flights]
+        campaign_ids = {f.campaign_id for f in flights}
+
+        publisher_group_ids = {}
+        rows = Campaign.publisher_groups.through.objects.filter(
+            campaign_id__in=campaign_ids
+        ).values_list("campaign_id", "publishergroup_id")
+        for campaign_id, group_id in rows:
+            publisher_group_ids.setdefault(campaign_id, set()).add(group_id)
+
+        excluded_publisher_ids = {}
+        rows = Campaign.exclude_publishers.through.objects.filter(
+            campaign_id__in=campaign_ids
+        ).values_list("campaign_id", "publisher_id")
+        for campaign_id, publisher_id in rows:
+            excluded_publisher_ids.setdefault(campaign_id, set()).add(publisher_id)
+
+        # Live ads (and their ad types) in each flight so choosing an ad is in-memory
+        flights_by_id = {f.pk: f for f in flights}
+        ads = {}
+        for ad in (
+            Advertisement.objects.filter(flight_id__in=flight_ids, live=True)
+            .prefetch_related("ad_types")
+            .order_by("pk")
+        ):
+            # Share the flight (with its campaign and advertiser) used for rendering
+            ad.flight = flights_by_id[ad.flight_id]
+            ads.setdefault(ad.flight_id, []).append(
+                SnapshotAd(
+                    advertisement=ad,
+                    ad_type_slugs=frozenset(t.slug for t in ad.ad_types.all()),
+                )
+            )
+
+        # Publisher -> publisher groups so candidates can be chosen without a query
+        publisher_groups = {}
+        rows = PublisherGroup.publishers.through.objects.values_list(
+            "publishergroup_id", "publisher_id"
+        )
+        for group_id, publisher_id in rows:
+            publisher_groups.setdefault(publisher_id, set()).add(group_id)
+
+        snapshot_flights = tuple(
+            SnapshotFlight(
+                flight=flight,
+                campaign_type=flight.campaign.campaign_type,
+                start_date=flight.start_date,
+                publisher_group_ids=frozenset(
+                    publisher_group_ids.get(flight.campaign_id, ())
+                ),
+                excluded_publisher_ids=frozenset(
+                    excluded_publisher_ids.get(flight.campaign_id, ())
+                ),
+                ad_type_slugs=frozenset().union(
+                    *(sad.ad_type_slugs for sad in ads.get(flight.pk, ()))
+                ),
+                ads=tuple(ads.get(flight.pk, ())),
+                targeting=FlightTargeting.from_flight(flight),
+            )
+            for flight in flights
+        )
+
+        return cls(
+            version=str(uuid.uuid7()),
+            created=timezone.now(),
+            flights=snapshot_flights,
+            publisher_groups={
+                publisher_id: frozenset(group_ids)
+                for publisher_id, group_ids in publisher_groups.items()
+            },
+            # Load regions and topics from the database since they may have just changed
+            geo_index=GeoIndex.build(snapshot_flights, Region._load_db()),
+            keyword_index=KeywordIndex.build(snapshot_flights, Topic._load_db()),
+        )
+
+    def get_candidate_flights(self, publisher, ad_types, campaign_types, day):
+        """
+        Get the candidate flights for an ad decision.
+
+        This matches ``AdvertisingEnabledBackend.get_candidate_flights``:
+        live flights that have started, for the passed campaign types,
+        in one of the publisher's groups (and not excluding the publisher)
+        with a live ad of one of the requested ad types.
+
+        :returns: a list of ``SnapshotFlight`` instances
+        """
+        group_ids = self.publisher_groups.get(publisher.pk, frozenset())
+        ad_types = frozenset(ad_types)
+        campaign_types = frozenset(campaign_types)
+
+        return [
+            sflight
+            for sflight in self.flights
+            if sflight.campaign_type in campaign_types
+            and sflight.start_date <= day
+            and not sflight.ad_type_slugs.isdisjoint(ad_types)
+            and not sflight.publisher_group_ids.isdisjoint(group_ids)
+            and publisher.pk not in sflight.excluded_publisher_ids
+        ]
+
+
+def publish_flight_snapshot():
+    """Build a new flight snapshot and publish it to the shared cache."""
+    start_time = timezone.now()
+    snapshot = FlightSnapshot.build()
+
+    # Set the snapshot before the version so workers never see a version
+    # that doesn't have a snapshot available
+    cache.set(FlightSnapshot.CACHE_KEY, snapshot, FlightSnapshot.CACHE_TIMEOUT)
+    cache.set(
+        FlightSnapshot.VERSION_CACHE_KEY, snapshot.version, FlightSnapshot.CACHE_TIMEOUT
+    )
+
+    log.info(
+        "Published flight snapshot. version=%s, flights=%s, duration=%s",
+        snapshot.version,
+        len(snapshot.flights),
+        timezone.now() - start_time,
+    )
+    return snapshot
+
+
+def get_flight_snapshot():
+    """
+    Get the current flight snapshot for this worker.
+
+    This costs a single cache lookup (the version) when the worker
+    already has the current snapshot loaded in memory.
+    If no snapshot has been published, one is built and published.
+    """
+    global _local_snapshot  # noqa: PLW0603
+
+    version = cache.get(FlightSnapshot.VERSION_CACHE_KEY)
+    snapshot = _local_snapshot
+    if snapshot is not None and version and snapshot.version == version:
+        return snapshot
+
+    with _local_snapshot_lock:
+        # Another thread may have loaded the snapshot while we waited
+        snapshot = _local_snapshot
+        if snapshot is not None and version and snapshot.version == version:
+            return snapshot
+
+        snapshot = None
+        if version:
+            snapshot = cache.get(FlightSnapshot.CACHE_KEY)
+        if snapshot is None or snapshot.version != version:
+            log.debug("No current flight snapshot published. Building one.")
+            snapshot = publish_flight_snapshot()
+
+        _local_snapshot = snapshot
+
+    return snapshot
+
+
+def get_loaded_flight_snapshot():
+    """
+    Get the snapshot this worker has loaded without checking if it's current.
+
+    This never touches the cache or the database.
+    Returns ``None`` if this worker hasn't loaded a snapshot.
+    """
+    return _local_snapshot
+
+
+def clear_local_flight_snapshot():
+    """Clear this worker's snapshot so the next decision loads a fresh one."""
+    global _local_snapshot  # noqa: PLW0603
+
+    with _local_snapshot_lock:
+        _local_snapshot = None
@@ -0,0 +1,113 @@
+"""
+Opt-in tracing of ad decisions.
+
+A trace records why flights were rejected and how long each stage of a decision took.
+This helps answer why a publisher didn't get a paid ad
+and helps tune the order of the targeting filters.
+
+Decisions are traced when a staff user sends the ``X-Adserver-Trace`` header
+or for a sampled percentage of decisions (``ADSERVER_DECISION_TRACE_SAMPLE_RATE``).
+Finished traces are logged as JSON.
+"""
+
+import collections
+import contextlib
+import json
+import logging
+import random
+import time
+
+import uuid_utils.compat as uuid
+from django.conf import settings
+
+from ..utils import get_user_agent_cache_stats
+
+
+log = logging.getLogger(__name__)  # noqa
+
+TRACE_HEADER = "X-Adserver-Trace"
+
+
+class DecisionTrace:
+    """The candidate flights, rejections and stage timings of a single ad decision."""
+
+    def __init__(self, **context):
+        """
+        Start a new trace.
+
+        :param context: data identifying the decision (publisher, url, etc.)
+        """
+        self.id = str(uuid.uuid7())
+        self.context = context
+        self.candidates = 0
+
+        # Filter -> number of flights rejected by it
+        self.rejections = collections.Counter()
+
+        # Stage -> seconds spent in it
+        self.timings = collections.defaultdict(float)
+
+        self.ads = []
+        self.start_time = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Time a stage of the decision. Stages run more than once are summed."""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] += time.perf_counter() - start_time
+
+    def reject(self, flight, reason):
+        """Record that a flight was rejected by a filter."""
+        self.rejections[reason] += 1
+        log.debug(
+            "Flight rejected. trace=%s flight=%s reason=%s", self.id, flight, reason
+        )
+
+    def as_dict(self):
+        return {
+            "id": self.id,
+            **self.context,
+            "candidates": self.candidates,
+            "rejections": dict(self.rejections),
+            "timings": {stage: round(t, 6) for stage, t in self.timings.items()},
+            "ads": self.ads,
+            "duration": round(time.perf_counter() - self.start_time, 6),
+            # Per-worker stats to confirm parsed user agents are being reused
+            "user_agent_cache": get_user_agent_cache_stats(),
+        }
+
+    def finish(self):
+        """Log the trace as JSON."""
+        data = self.as_dict()
+        log.info("Decision trace: %s", json.dumps(data, default=str))
+        return data
+
+
+class NullDecisionTrace:
+    """A trace that records nothing for decisions that aren't traced."""
+
+    id = None
+
+    def __bool__(self):
+        return False
+
+    def stage(self, name):
+        return contextlib.nullcontext()
+
+    def reject(self, flight, reason):
+        pass
+
+    def finish(self):
+        return None
+
+
+def should_trace_decision(request):
+    """Whether to trace the ad decision for this request."""
+    if request.headers.get(TRACE_HEADER) and request.user.is_staff:
+        return True
+
+    sample_rate = settings.ADSERVER_DECISION_TRACE_SAMPLE_RATE
+    return bool(sample_rate) and random.random() < sample_rate
@@ -107,6 +107,7 @@ class FlightAdminForm(FlightMixin, forms.ModelForm):
             "cpm",
             "sold_impressions",
             "daily_cap",
+            "frequency_cap",
             "targeting_parameters",
             "traffic_fill",
             "traffic_cap",
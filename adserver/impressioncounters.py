@@ -0,0 +1,167 @@
+"""
+Buffered counters for ``AdImpression`` decisions, offers, views and clicks.
+
+Every decision, offer, view and click increments a counter on the ``AdImpression``
+for its ad, publisher and day. Popular ads on busy publishers update the same row
+many times a second and those updates wait on each other's row locks.
+When ``ADSERVER_IMPRESSION_COUNTERS`` is enabled, the increments are counted instead
+in a hash per ad per day with a field per publisher and metric (see ``counters``).
+
+The ``flush_buffered_impressions`` task runs every few seconds. It takes the counts
+and adds a batch of them at a time to the ``AdImpression`` rows in a single transaction.
+
+Code that reads today's counts (eg. ``Flight.views_today``)
+adds the counts that haven't been flushed yet (``get_pending_counts``).
+"""
+
+import collections
+import datetime
+import logging
+
+from django.apps import apps
+from django.conf import settings
+from django.db import models
+from django.db import transaction
+
+from .constants import IMPRESSION_TYPES
+from .counters import HashCounters
+
+
+log = logging.getLogger(__name__)  # noqa
+
+CACHE_KEY_PREFIX = "impression-counter"
+
+# Counts are flushed every few seconds. This only stops abandoned counts living forever
+CACHE_TIMEOUT = 60 * 60 * 48
+
+# Used in place of an ID for null offers (no advertisement)
+NULL_ID = "none"
+
+# A hash per ad per day with a field per publisher and impression type
+_counters = HashCounters(CACHE_KEY_PREFIX, CACHE_TIMEOUT)
+
+
+def _get_impression_model():
+    return apps.get_model("adserver", "AdImpression")
+
+
+def is_impression_counters_enabled():
+    return settings.ADSERVER_IMPRESSION_COUNTERS
+
+
+def get_counter_key(advertisement_id, day):
+    advertisement_id = NULL_ID if advertisement_id is None else advertisement_id
+    return f"{CACHE_KEY_PREFIX}::{advertisement_id}::{day:%Y-%m-%d}"
+
+
+def _parse_counter_key(key):
+    _, advertisement_id, day = key.split("::")
+    advertisement_id = None if advertisement_id == NULL_ID else int(advertisement_id)
+    return advertisement_id, datetime.date.fromisoformat(day)
+
+
+def _get_field(publisher_id, impression_type):
+    publisher_id = NULL_ID if publisher_id is None else publisher_id
+    return f"{publisher_id}:{impression_type}"
+
+
+def _parse_field(field):
+    publisher_id, impression_type = field.split(":")
+    publisher_id = None if publisher_id == NULL_ID else int(publisher_id)
+    return publisher_id, impression_type
+
+
+def record_impressions(advertisement_id, publisher_id, day, counts):
+    """
+    Count impressions to be added to an ``AdImpression`` when the counters are flushed.
+
+    :param counts: a dictionary of impression type -> count (negative for refunds)
+    """
+    counts = {
+        imp_type: count
+        for imp_type, count in counts.items()
+        if count and imp_type in IMPRESSION_TYPES
+    }
+    if not counts:
+        return
+
+    _counters.incr(
+        get_counter_key(advertisement_id, day),
+        {
+            _get_field(publisher_id, imp_type): count
+            for imp_type, count in counts.items()
+        },
+    )
+
+
+def get_pending_counts(advertisement_ids, day, publisher_id=None):
+    """
+    Get the impressions counted for these ads that haven't been flushed yet.
+
+    :param advertisement_ids: the IDs of ads (``None`` for null offers)
+    :param publisher_id: only count this publisher (all publishers by default)
+    :returns: a dictionary of impression type -> count
+    """
+    counts = dict.fromkeys(IMPRESSION_TYPES, 0)
+    if not is_impression_counters_enabled():
+        return counts
+
+    keys = [get_counter_key(ad_id, day) for ad_id in set(advertisement_ids)]
+    for values in _counters.get(keys):
+        for field, count in values.items():
+            field_publisher_id, imp_type = _parse_field(field)
+            if publisher_id is None or field_publisher_id == publisher_id:
+                counts[imp_type] += count
+    return counts
+
+
+def _write_counts(deltas):
+    """Add the counts to their ``AdImpression`` rows (creating any that don't exist)."""
+    model = _get_impression_model()
+
+    rows = collections.defaultdict(dict)
+    for (key, field), count in deltas.items():
+        if count:
+            advertisement_id, day = _parse_counter_key(key)
+            publisher_id, imp_type = _parse_field(field)
+            rows[(advertisement_id, publisher_id, day)][imp_type] = count
+
+    with transaction.atomic(using="default"):
+        model.objects.using("default").bulk_create(
+            [
+                model(advertisement_id=ad_id, publisher_id=publisher_id, date=day)
+                for ad_id, publisher_id, day in rows
+            ],
+            ignore_conflicts=True,
+        )
+        # Sort the rows so concurrent flushes lock them in the same order
+        for (ad_id, publisher_id, day), counts in sorted(
+            rows.items(),
+            key=lambda item: (str(item[0][0]), str(item[0][1]), item[0][2]),
+        ):
+            model.objects.using("default").filter(
+                advertisement_id=ad_id, publisher_id=publisher_id, date=day
+            ).update(
+                **{
+                    imp_type: models.F(imp_type) + count
+                    for imp_type, count in counts.items()
+                }
+            )
+
+    return len(rows)
+
+
+def flush_impression_counters(batch_size=None):
+    """
+    Add all the counted impressions to the ``AdImpression`` rows.
+
+    :param batch_size: counter hashes per transaction
+        (``ADSERVER_IMPRESSION_COUNTERS_BATCH_SIZE`` by default)
+    :returns: the number of ``AdImpression`` rows updated
+    """
+    batch_size = batch_size or settings.ADSERVER_IMPRESSION_COUNTERS_BATCH_SIZE
+    updated = _counters.flush(_write_counts, batch_size)
+
+    if updated:
+        log.info("Flushed impression counters. impressions=%s", updated)
+    return updated
@@ -7,6 +7,8 @@ As a result, archiving old offers can have a good effect on performance.
 This management command archives old offers to CSV files, zips them,
 can copy them to remote storage (settings.DATA_STORAGE)
 and with a passed flag can delete the archives from the DB.
+When the offers table is partitioned (see ``adserver/partitions.py``),
+partitions that were entirely archived are dropped rather than deleting their offers.
 """
 
 import datetime
@@ -22,6 +24,10 @@ from django.db import connections
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
+from ...partitions import drop_partition
+from ...partitions import get_partitions
+from ...partitions import is_partitioned
+
 
 class Command(BaseCommand):
     """Management command to help archive offers."""
@@ -193,6 +199,43 @@ class Command(BaseCommand):
             self.style.SUCCESS(_("Successfully removed %d offers.") % deleted_offers)
         )
 
+    def get_archived_partitions(self, start_date, end_date):
+        """Get the partitions of the offers table with only offers from these days."""
+        if not is_partitioned():
+            return []
+
+        return [
+            partition
+            for partition in get_partitions()
+            if partition.start >= start_date
+            and partition.end <= end_date + datetime.timedelta(days=1)
+        ]
+
+    def drop_partitions(self, partitions):
+        """Drops archived partitions (requires them to be copied to settings.DATA_STORAGE)."""
+        if "data" not in settings.STORAGES:
+            self.stdout.write(
+                self.style.WARNING(
+                    _(
+                        "Skipping dropping archived partitions (backups weren't copied)..."
+                    )
+                )
+            )
+            return
+
+        for partition in partitions:
+            self.stdout.write(
+                _("Dropping archived partition %s (%s - %s)...")
+                % (partition.name, partition.start, partition.end)
+            )
+            drop_partition(partition)
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                _("Successfully dropped %d partitions.") % len(partitions)
+            )
+        )
+
     def update_db_stats(self):
         """Updates DB stats after these changes."""
         self.stdout.write(_("Updating database statistics..."))
@@ -217,15 +260,27 @@ class Command(BaseCommand):
             self.style.SUCCESS(_("Archiving offers to %s...") % self.output_dir)
         )
 
+        partitions = []
+        if kwargs["delete_offers"]:
+            partitions = self.get_archived_partitions(
+                kwargs["start_date"], kwargs["end_date"]
+            )
+
         day = kwargs["start_date"]
         while day <= kwargs["end_date"]:
             archive_filepath = self.handle_archive_day(day)
             self.copy_offer_dump(archive_filepath)
-            if kwargs["delete_offers"]:
+            if kwargs["delete_offers"] and not any(
+                partition.start <= day < partition.end for partition in partitions
+            ):
                 self.delete_offers(day)
 
             day += datetime.timedelta(days=1)
 
+        if partitions:
+            # Dropping the partitions is much faster than deleting their offers
+            self.drop_partitions(partitions)
+
         if kwargs["delete_offers"]:
             # Update DB stats if we deleted anything
             self.update_db_stats()
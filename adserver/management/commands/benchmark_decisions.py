@@ -0,0 +1,448 @@
+"""
+Benchmarks the ad decision backends against synthetic flights.
+
+For each number of flights, this generates live flights with a realistic mix
+of targeting (geo, regions, topics, keywords, niche targeting and traffic caps),
+makes a number of ad decisions against them with each backend
+and measures decisions/second, latency percentiles and queries per decision.
+
+All synthetic data is created in a transaction that is rolled back
+so this is safe to run against a local SQLite or Postgres database.
+The benchmark uses its own in-memory caches so snapshots and cached decision data
+for the synthetic flights never reach a cache shared with running ad servers.
+Results can be written as JSON to compare runs and catch regressions::
+
+    ./manage.py benchmark_decisions --flights 10,100,1000 --output results.json
+"""
+
+import datetime
+import json
+import random
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import CommandError
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db import transaction
+from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.test.utils import override_settings
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from django.utils.translation import gettext_lazy as _
+
+from ...constants import COMMUNITY_CAMPAIGN
+from ...constants import HOUSE_CAMPAIGN
+from ...constants import PAID_CAMPAIGN
+from ...decisionengine.backends import SnapshotFlightBackend
+from ...decisionengine.pacing import publish_pacing_snapshot
+from ...decisionengine.publisher import get_publisher_decision_context
+from ...decisionengine.snapshot import clear_local_flight_snapshot
+from ...decisionengine.snapshot import publish_flight_snapshot
+from ...models import AdType
+from ...models import Advertisement
+from ...models import Advertiser
+from ...models import Campaign
+from ...models import Flight
+from ...models import Publisher
+from ...models import PublisherGroup
+from ...models import Region
+from ...models import Topic
+from ...utils import GeolocationData
+from ...utils import get_user_agent_cache_stats
+from ...utils import parse_user_agent
+
+
+# Visitor countries (and US states) roughly weighted by ad server traffic
+COUNTRIES = ("US", "US", "US", "CA", "GB", "DE", "FR", "IN", "IN", "BR", "JP", "AU")
+US_STATES = ("CA", "NY", "TX", "WA", "MA")
+KEYWORDS = (
+    "python",
+    "django",
+    "javascript",
+    "react",
+    "rust",
+    "golang",
+    "kubernetes",
+    "docker",
+    "devops",
+    "security",
+    "machine-learning",
+    "data-science",
+)
+USER_AGENTS = (
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:121.0) Gecko/20100101 Firefox/121.0",
+    "Mozilla/5.0 (iPhone; CPU iPhone OS 17_1 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.1 Mobile/15E148 Safari/604.1",
+)
+AD_TYPES = ("benchmark-image", "benchmark-text")
+
+# Caches used instead of the configured ones while benchmarking
+BENCHMARK_CACHES = {
+    alias: {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": f"benchmark-decisions-{alias}",
+    }
+    for alias in ("default", settings.CACHE_LOCAL_ALIAS)
+}
+
+
+def percentile(values, percent):
+    """Get the percentile of a list of values using the nearest rank."""
+    values = sorted(values)
+    index = max(0, round(percent / 100 * len(values)) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+class Command(BaseCommand):
+    """Management command to benchmark the ad decision engine."""
+
+    help = "Benchmarks ad decision backends against synthetic flights."
+
+    default_flight_counts = "10,100,1000,5000"
+
+    def add_arguments(self, parser):
+        """Add command line args for this command."""
+        parser.add_argument(
+            "-f",
+            "--flights",
+            default=self.default_flight_counts,
+            type=str,
+            help=_("Comma separated numbers of live flights to benchmark"),
+        )
+        parser.add_argument(
+            "-n",
+            "--decisions",
+            default=200,
+            type=int,
+            help=_("Number of ad decisions to measure for each backend"),
+        )
+        parser.add_argument(
+            "-w",
+            "--warmup",
+            default=10,
+            type=int,
+            help=_("Number of ad decisions to make before measuring"),
+        )
+        parser.add_argument(
+            "-b",
+            "--backend",
+            action="append",
+            dest="backends",
+            help=_(
+                "Dotted path to a decision backend (can be repeated, "
+                "defaults to ADSERVER_DECISION_BACKEND)"
+            ),
+        )
+        parser.add_argument(
+            "-s",
+            "--seed",
+            default=0,
+            type=int,
+            help=_("Random seed so runs are comparable"),
+        )
+        parser.add_argument(
+            "-o",
+            "--output",
+            default=None,
+            type=str,
+            help=_("Write the results as JSON to this file (- for stdout)"),
+        )
+
+    def handle(self, *args, **kwargs):
+        """Entrypoint to the command."""
+        try:
+            flight_counts = [int(c) for c in kwargs["flights"].split(",") if c]
+        except ValueError as e:
+            raise CommandError(_("--flights must be comma separated numbers")) from e
+
+        if kwargs["decisions"] < 1:
+            raise CommandError(_("--decisions must be at least 1"))
+
+        backend_paths = kwargs["backends"] or [
+            settings.ADSERVER_DECISION_BACKEND
+            or "adserver.decisionengine.backends.ProbabilisticFlightBackend"
+        ]
+        backends = [(path, import_string(path)) for path in backend_paths]
+
+        results = []
+        with override_settings(CACHES=BENCHMARK_CACHES):
+            for flight_count in flight_counts:
+                # Seed each size the same way so adding sizes doesn't change results
+                rng = random.Random(kwargs["seed"])
+
+                with transaction.atomic():
+                    self.stdout.write(
+                        _("Creating %s synthetic flights...") % flight_count
+                    )
+                    publisher = self.create_fixtures(flight_count, rng)
+                    requests = [
+                        self.create_request(rng)
+                        for _i in range(kwargs["warmup"] + kwargs["decisions"])
+                    ]
+
+                    for backend_path, backend_class in backends:
+                        result = self.run_benchmark(
+                            backend_class,
+                            publisher,
+                            requests,
+                            warmup=kwargs["warmup"],
+                        )
+                        result.update(
+                            {"backend": backend_path, "flights": flight_count}
+                        )
+                        results.append(result)
+                        self.write_result(result)
+
+                    # Discard all the synthetic data
+                    transaction.set_rollback(True)
+
+            self.clear_caches()
+
+        output = {
+            "created": timezone.now().isoformat(),
+            "database": connection.vendor,
+            "seed": kwargs["seed"],
+            "results": results,
+        }
+        if kwargs["output"] == "-":
+            self.stdout.write(json.dumps(output, indent=2))
+        elif kwargs["output"]:
+            with open(kwargs["output"], "w", encoding="utf-8") as fd:
+                json.dump(output, fd, indent=2)
+            self.stdout.write(
+                self.style.SUCCESS(_("Wrote results to %s") % kwargs["output"])
+            )
+
+    def create_fixtures(self, flight_count, rng):
+        """Create a publisher and the synthetic flights (with ads) it can show."""
+        publisher = Publisher.objects.create(
+            name="Benchmark Publisher",
+            slug="benchmark-publisher",
+            allow_paid_campaigns=True,
+            allow_affiliate_campaigns=True,
+            allow_community_campaigns=True,
+            allow_house_campaigns=True,
+        )
+        publisher_group = PublisherGroup.objects.create(
+            name="Benchmark Group", slug="benchmark-group"
+        )
+        publisher_group.publishers.add(publisher)
+
+        ad_types = [
+            AdType.objects.create(name=slug, slug=slug, has_image=False)
+            for slug in AD_TYPES
+        ]
+
+        # Advertisers typically have a few flights each
+        advertisers = Advertiser.objects.bulk_create(
+            Advertiser(
+                name=f"Benchmark Advertiser {i}", slug=f"benchmark-advertiser-{i}"
+            )
+            for i in range(max(1, flight_count // 5))
+        )
+        campaigns = Campaign.objects.bulk_create(
+            Campaign(
+                name=f"Benchmark Campaign {i}",
+                slug=f"benchmark-campaign-{i}",
+                advertiser=advertiser,
+                campaign_type=rng.choices(
+                    (PAID_CAMPAIGN, COMMUNITY_CAMPAIGN, HOUSE_CAMPAIGN),
+                    weights=(8, 1, 1),
+                )[0],
+            )
+            for i, advertiser in enumerate(advertisers)
+        )
+        Campaign.publisher_groups.through.objects.bulk_create(
+            Campaign.publisher_groups.through(
+                campaign=campaign, publishergroup=publisher_group
+            )
+            for campaign in campaigns
+        )
+
+        regions = list(Region.load_from_cache())
+        topics = list(Topic.load_from_cache())
+        today = timezone.now().date()
+
+        flights = []
+        for i in range(flight_count):
+            targeting, traffic_cap, traffic_fill = self.generate_targeting(
+                rng, regions, topics
+            )
+            flights.append(
+                Flight(
+                    name=f"Benchmark Flight {i}",
+                    slug=f"benchmark-flight-{i}",
+                    campaign=rng.choice(campaigns),
+                    live=True,
+                    start_date=today - datetime.timedelta(days=rng.randint(0, 20)),
+                    end_date=today + datetime.timedelta(days=rng.randint(1, 30)),
+                    cpc=2,
+                    sold_clicks=rng.randint(100, 10_000),
+                    total_clicks=rng.randint(0, 100),
+                    total_views=rng.randint(0, 50_000),
+                    priority_multiplier=rng.choice((1, 1, 1, 2, 3)),
+                    targeting_parameters=targeting,
+                    traffic_cap=traffic_cap,
+                    traffic_fill=traffic_fill,
+                )
+            )
+        flights = Flight.objects.bulk_create(flights)
+
+        ads = Advertisement.objects.bulk_create(
+            Advertisement(
+                name=f"Benchmark Ad {i}",
+                slug=f"benchmark-ad-{i}",
+                headline="Benchmark",
+                content="A synthetic ad for benchmarking",
+                cta="Learn more",
+                link="https://example.com",
+                live=True,
+                flight=flight,
+                sampled_ctr=rng.uniform(0.0, 0.2),
+            )
+            for i, flight in enumerate(f for f in flights for _ in range(2))
+        )
+        Advertisement.ad_types.through.objects.bulk_create(
+            Advertisement.ad_types.through(advertisement=ad, adtype=ad_type)
+            for ad in ads
+            for ad_type in ad_types
+            if rng.random() < 0.75
+        )
+
+        return publisher
+
+    def generate_targeting(self, rng, regions, topics):
+        """Generate the targeting parameters, traffic cap and traffic fill for a flight."""
+        targeting = {}
+        traffic_cap = None
+        traffic_fill = None
+
+        geo = rng.random()
+        if geo < 0.3:
+            targeting["include_countries"] = rng.sample(COUNTRIES, 3)
+        elif geo < 0.4:
+            targeting["exclude_countries"] = rng.sample(COUNTRIES, 2)
+        elif geo < 0.6 and regions:
+            targeting["include_regions"] = rng.sample(regions, 1)
+        elif geo < 0.65:
+            targeting["include_countries"] = ["US"]
+            targeting["include_state_provinces"] = rng.sample(US_STATES, 2)
+
+        keywords = rng.random()
+        if keywords < 0.2 and topics:
+            targeting["include_topics"] = rng.sample(topics, 1)
+        elif keywords < 0.4:
+            targeting["include_keywords"] = rng.sample(KEYWORDS, 3)
+        elif keywords < 0.5:
+            targeting["exclude_keywords"] = rng.sample(KEYWORDS, 2)
+
+        if rng.random() < 0.1:
+            targeting["niche_targeting"] = round(rng.uniform(0.2, 0.8), 2)
+
+        if rng.random() < 0.1:
+            traffic_cap = {"countries": {"US": 20.0}}
+            traffic_fill = {"countries": {"US": round(rng.uniform(0, 40), 1)}}
+        if rng.random() < 0.05 and regions:
+            region = rng.choice(regions)
+            traffic_cap = {**(traffic_cap or {}), "regions": {region: 30.0}}
+            traffic_fill = {
+                **(traffic_fill or {}),
+                "regions": {region: round(rng.uniform(0, 60), 1)},
+            }
+
+        return targeting, traffic_cap, traffic_fill
+
+    def create_request(self, rng):
+        """Create the request data for a single ad decision."""
+        country = rng.choice(COUNTRIES)
+        request = RequestFactory().get("/", HTTP_USER_AGENT=rng.choice(USER_AGENTS))
+        request.geo = GeolocationData(
+            country=country,
+            region=rng.choice(US_STATES) if country == "US" else None,
+        )
+
+        return {
+            "request": request,
+            "placements": [
+                {"div_id": "benchmark", "ad_type": rng.choice(AD_TYPES), "priority": 1}
+            ],
+            "keywords": rng.sample(KEYWORDS, rng.randint(0, 3)),
+            "url": "https://example.com/docs/",
+        }
+
+    def run_benchmark(self, backend_class, publisher, requests, warmup):
+        """Make an ad decision for each request and measure it."""
+        self.clear_caches()
+        parse_user_agent.cache_clear()
+        if issubclass(backend_class, SnapshotFlightBackend):
+            # Normally these are published in the background by Celery
+            publish_flight_snapshot()
+            publish_pacing_snapshot()
+
+        latencies = []
+        query_counts = []
+        filled = 0
+        for i, request_data in enumerate(requests):
+            with CaptureQueriesContext(connection) as queries:
+                start_time = time.perf_counter()
+                # Resolved by the decision API's serializer for real decisions
+                publisher_context = get_publisher_decision_context(publisher.slug)
+                backend = backend_class(
+                    publisher=publisher_context.publisher,
+                    publisher_context=publisher_context,
+                    **request_data,
+                )
+                ad, _placement = backend.get_ad_and_placement()
+                elapsed = time.perf_counter() - start_time
+
+            if i < warmup:
+                continue
+
+            latencies.append(elapsed)
+            query_counts.append(len(queries))
+            if ad:
+                filled += 1
+
+        total_time = sum(latencies)
+        return {
+            "decisions": len(latencies),
+            "fill_rate": round(filled / len(latencies), 4),
+            "decisions_per_second": round(len(latencies) / total_time, 2),
+            "latency_ms": {
+                "mean": round(total_time / len(latencies) * 1000, 3),
+                "p50": round(percentile(latencies, 50) * 1000, 3),
+                "p99": round(percentile(latencies, 99) * 1000, 3),
+                "max": round(max(latencies) * 1000, 3),
+            },
+            "queries": {
+                "mean": round(sum(query_counts) / len(query_counts), 2),
+                "max": max(query_counts),
+            },
+            "user_agent_cache": get_user_agent_cache_stats(),
+        }
+
+    def write_result(self, result):
+        self.stdout.write(
+            _(
+                "%(backend)s flights=%(flights)s: %(dps)s decisions/sec, "
+                "p50=%(p50)sms, p99=%(p99)sms, queries=%(queries)s, fill=%(fill)s"
+            )
+            % {
+                "backend": result["backend"],
+                "flights": result["flights"],
+                "dps": result["decisions_per_second"],
+                "p50": result["latency_ms"]["p50"],
+                "p99": result["latency_ms"]["p99"],
+                "queries": result["queries"]["mean"],
+                "fill": result["fill_rate"],
+            }
+        )
+
+    def clear_caches(self):
+        """Clear the benchmark caches and snapshots which may reference synthetic flights."""
+        for alias in BENCHMARK_CACHES:
+            caches[alias].clear()
+        clear_local_flight_snapshot()
@@ -0,0 +1,105 @@
+"""
+Creates a partitioned Offer table and its partitions.
+
+See ``adserver/partitions.py`` for details on partitioning the Offer table.
+Creating a partitioned table and rolling to it::
+
+    ./manage.py partition_offers --create-table adserver_offer_partitioned
+    # Then set ADSERVER_OFFER_DB_TABLE=adserver_offer_partitioned
+
+Upcoming partitions are created by the ``create_offer_partitions`` task
+and can be created manually (eg. for more months) with::
+
+    ./manage.py partition_offers --count 6
+"""
+
+import datetime
+
+from django.core.management import CommandError
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+
+from ...partitions import count_default_partition_offers
+from ...partitions import create_partitioned_table
+from ...partitions import create_partitions
+from ...partitions import get_partitions
+from ...partitions import is_partitioned
+
+
+class Command(BaseCommand):
+    """Management command to create a partitioned Offer table and its partitions."""
+
+    help = "Creates a partitioned Offer table and partitions of it."
+
+    def add_arguments(self, parser):
+        """Add command line args for this command."""
+        parser.add_argument(
+            "--create-table",
+            default=None,
+            type=str,
+            help=_("Create a new partitioned table like the Offer table"),
+        )
+        parser.add_argument(
+            "-s",
+            "--start-date",
+            default=timezone.now().date(),
+            type=datetime.date.fromisoformat,
+            help=_("Create partitions starting with this date (default today)"),
+        )
+        parser.add_argument(
+            "-c",
+            "--count",
+            default=None,
+            type=int,
+            help=_(
+                "Number of partitions to create (default ADSERVER_OFFER_PARTITIONS_PREMAKE)"
+            ),
+        )
+
+    def handle(self, *args, **kwargs):
+        """Entrypoint to the command."""
+        table = kwargs["create_table"]
+        if table:
+            self.stdout.write(_("Creating partitioned table %s...") % table)
+            create_partitioned_table(table)
+        elif not is_partitioned():
+            raise CommandError(
+                _("The Offer table isn't partitioned (use --create-table)")
+            )
+
+        for partition in create_partitions(
+            kwargs["start_date"], count=kwargs["count"], table=table
+        ):
+            self.stdout.write(
+                _("Created partition %s (%s - %s)")
+                % (partition.name, partition.start, partition.end)
+            )
+
+        self.stdout.write(_("Partitions:"))
+        for partition in get_partitions(table):
+            self.stdout.write(
+                "- %s (%s - %s)" % (partition.name, partition.start, partition.end)
+            )
+
+        default_offers = count_default_partition_offers(table)
+        if default_offers:
+            self.stdout.write(
+                self.style.WARNING(
+                    _(
+                        "%s offers are outside of every partition. "
+                        "Create partitions for their dates to move them."
+                    )
+                    % default_offers
+                )
+            )
+
+        if table:
+            self.stdout.write(
+                self.style.SUCCESS(
+                    _(
+                        "Successfully created %s. Set ADSERVER_OFFER_DB_TABLE=%s to use it."
+                    )
+                    % (table, table)
+                )
+            )
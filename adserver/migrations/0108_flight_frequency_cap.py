@@ -0,0 +1,24 @@
+# Generated by Django 5.2.11 on 2026-10-16 12:00
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('adserver', '0107_flight_auto_renew_notified_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='flight',
+            name='frequency_cap',
+            field=models.PositiveSmallIntegerField(blank=True, default=None, help_text="The most times a single user is shown this flight's ads each day. This is an estimate and users may occasionally be capped a bit early.", null=True, validators=[django.core.validators.MinValueValidator(1), django.core.validators.MaxValueValidator(255)], verbose_name='Daily frequency cap'),
+        ),
+        migrations.AddField(
+            model_name='historicalflight',
+            name='frequency_cap',
+            field=models.PositiveSmallIntegerField(blank=True, default=None, help_text="The most times a single user is shown this flight's ads each day. This is an estimate and users may occasionally be capped a bit early.", null=True, validators=[django.core.validators.MinValueValidator(1), django.core.validators.MaxValueValidator(255)], verbose_name='Daily frequency cap'),
+        ),
+    ]
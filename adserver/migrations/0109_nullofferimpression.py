@@ -0,0 +1,38 @@
+# Generated by Django 5.2.11 on 2026-10-16 12:00
+
+import django.db.models.deletion
+import django_countries.fields
+import django_extensions.db.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('adserver', '0108_flight_frequency_cap'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NullOfferImpression',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', django_extensions.db.fields.CreationDateTimeField(auto_now_add=True, verbose_name='created')),
+                ('modified', django_extensions.db.fields.ModificationDateTimeField(auto_now=True, verbose_name='modified')),
+                ('date', models.DateField(db_index=True, verbose_name='Date')),
+                ('ad_type_slug', models.CharField(blank=True, max_length=100, null=True, verbose_name='Ad type')),
+                ('div_id', models.CharField(blank=True, max_length=255, null=True)),
+                ('country', django_countries.fields.CountryField(max_length=2, null=True)),
+                ('keywords', models.JSONField(blank=True, null=True, verbose_name='Keyword targeting for this view')),
+                ('keywords_hash', models.CharField(blank=True, default='', max_length=32)),
+                ('paid_eligible', models.BooleanField(default=False)),
+                ('decisions', models.PositiveIntegerField(default=0, verbose_name='Decisions')),
+                ('publisher', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='null_offer_impressions', to='adserver.publisher')),
+            ],
+            options={
+                'verbose_name_plural': 'Null offer impressions',
+                'ordering': ('-date',),
+                'constraints': [models.UniqueConstraint(fields=('publisher', 'date', 'ad_type_slug', 'div_id', 'country', 'keywords_hash', 'paid_eligible'), name='null_offer_impression_unique', nulls_distinct=False)],
+            },
+        ),
+    ]
@@ -0,0 +1,61 @@
+# Generated by Django 5.2.11 on 2026-10-16 12:00
+
+import django_countries.fields
+from django.db import migrations, models
+from django.db.models import Count, Min, Sum
+
+
+UNIQUE_FIELDS = ('publisher_id', 'date', 'ad_type_slug', 'div_id', 'country', 'keywords_hash', 'paid_eligible')
+
+
+def forwards(apps, schema_editor):
+    """Store missing values as "" and merge the counts that are duplicates once they are."""
+    NullOfferImpression = apps.get_model('adserver', 'NullOfferImpression')
+
+    for field in ('ad_type_slug', 'div_id', 'country'):
+        NullOfferImpression.objects.filter(**{f'{field}__isnull': True}).update(**{field: ''})
+
+    duplicates = (
+        NullOfferImpression.objects.values(*UNIQUE_FIELDS)
+        .annotate(rows=Count('id'), first_id=Min('id'), total_decisions=Sum('decisions'))
+        .filter(rows__gt=1)
+        .order_by()
+    )
+    for values in duplicates:
+        lookup = {field: values[field] for field in UNIQUE_FIELDS}
+        NullOfferImpression.objects.filter(**lookup).exclude(pk=values['first_id']).delete()
+        NullOfferImpression.objects.filter(pk=values['first_id']).update(decisions=values['total_decisions'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('adserver', '0109_nullofferimpression'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='nullofferimpression',
+            name='null_offer_impression_unique',
+        ),
+        migrations.RunPython(forwards, reverse_code=migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='nullofferimpression',
+            name='ad_type_slug',
+            field=models.CharField(blank=True, default='', max_length=100, verbose_name='Ad type'),
+        ),
+        migrations.AlterField(
+            model_name='nullofferimpression',
+            name='div_id',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='nullofferimpression',
+            name='country',
+            field=django_countries.fields.CountryField(blank=True, default='', max_length=2),
+        ),
+        migrations.AddConstraint(
+            model_name='nullofferimpression',
+            constraint=models.UniqueConstraint(fields=('publisher', 'date', 'ad_type_slug', 'div_id', 'country', 'keywords_hash', 'paid_eligible'), name='null_offer_impression_unique'),
+        ),
+    ]
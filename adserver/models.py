@@ -38,7 +38,6 @@ from django_extensions.db.models import TimeStampedModel
 from djstripe.enums import InvoiceStatus
 from djstripe.models import Invoice
 from simple_history.models import HistoricalRecords
-from user_agents import parse
 
 from .constants import CAMPAIGN_TYPES
 from .constants import CLICKS
@@ -59,6 +58,17 @@ from .constants import PAYOUT_STRIPE
 from .constants import PENDING
 from .constants import PUBLISHER_PAYOUT_METHODS
 from .constants import VIEWS
+from .impressioncounters import get_pending_counts
+from .impressioncounters import is_impression_counters_enabled
+from .impressioncounters import record_impressions
+from .nonces import is_signed_nonces_enabled
+from .nonces import sign_nonce
+from .nonces import use_nonce
+from .nulloffers import count_null_offer
+from .nulloffers import should_store_null_offer
+from .offerbuffer import buffer_offer
+from .offerbuffer import is_write_behind_enabled
+from .offerbuffer import update_offer
 from .utils import COUNTRY_DICT
 from .utils import anonymize_ip_address
 from .utils import cached_method
@@ -71,6 +81,7 @@ from .utils import get_client_ip
 from .utils import get_client_user_agent
 from .utils import get_domain_from_url
 from .utils import is_proxy_ip
+from .utils import parse_user_agent
 from .validators import TargetingParametersValidator
 from .validators import TopicPricingValidator
 from .validators import TrafficFillValidator
@@ -78,6 +89,10 @@ from .validators import TrafficFillValidator
 
 log = logging.getLogger(__name__)  # noqa
 
+# Compiled ad type templates by ad type ID -> (modified, template, per offer)
+# Compiled templates can't be pickled so they are kept in memory per process
+_compiled_ad_type_templates = {}
+
 
 def default_flight_end_date():
     return datetime.date.today() + datetime.timedelta(days=30)
@@ -800,6 +815,12 @@ class Flight(TimeStampedModel, IndestructibleModel):
     # Shorter intervals (eg. an hour) spread flights more evenly across geographies
     DEFAULT_PACING_INTERVAL = 60 * 60  # 1 hour
 
+    # Views and clicks of flights with a daily cap are counted in the shared cache
+    # as they happen so checking the daily cap is a single cache read.
+    # The counters are periodically reconciled with the database.
+    DAILY_IMPRESSIONS_CACHE_KEY_PREFIX = "flight-daily-impressions"
+    DAILY_IMPRESSIONS_CACHE_TIMEOUT = 60 * 60 * 48
+
     name = models.CharField(_("Name"), max_length=200)
     slug = models.SlugField(_("Flight Slug"), max_length=200, unique=True)
     flight_logo = models.ImageField(
@@ -902,6 +923,17 @@ class Flight(TimeStampedModel, IndestructibleModel):
         null=True,
         help_text=_("A daily maximum this flight can spend."),
     )
+    frequency_cap = models.PositiveSmallIntegerField(
+        _("Daily frequency cap"),
+        default=None,
+        blank=True,
+        null=True,
+        validators=[MinValueValidator(1), MaxValueValidator(255)],
+        help_text=_(
+            "The most times a single user is shown this flight's ads each day. "
+            "This is an estimate and users may occasionally be capped a bit early."
+        ),
+    )
 
     # Denormalized fields
     total_views = models.PositiveIntegerField(
@@ -1333,33 +1365,128 @@ class Flight(TimeStampedModel, IndestructibleModel):
 
     @cached_method("flight_views_today")
     def views_today(self):
+        day = timezone.now().date()
         aggregation = AdImpression.objects.filter(
-            advertisement__in=self.advertisements.all(), date=timezone.now().date()
+            advertisement__in=self.advertisements.all(), date=day
         ).aggregate(total_views=models.Sum("views"))["total_views"]
 
         # The aggregation can be `None` if there are no impressions
-        return aggregation or 0
+        return (aggregation or 0) + self.get_pending_impressions(day)[VIEWS]
 
     @cached_method("flight_clicks_today")
     def clicks_today(self):
+        day = timezone.now().date()
         aggregation = AdImpression.objects.filter(
-            advertisement__in=self.advertisements.all(), date=timezone.now().date()
+            advertisement__in=self.advertisements.all(), date=day
         ).aggregate(total_clicks=models.Sum("clicks"))["total_clicks"]
 
         # The aggregation can be `None` if there are no impressions
-        return aggregation or 0
+        return (aggregation or 0) + self.get_pending_impressions(day)[CLICKS]
+
+    def get_pending_impressions(self, day):
+        """Get the impressions of this flight's ads that aren't in AdImpression yet."""
+        # The ads are only queried when impressions are counted
+        return get_pending_counts(self.advertisements.values_list("pk", flat=True), day)
 
     def spend_today(self):
         """Get the total spend for this flight today."""
         total = 0.0
+        impressions = self.get_daily_impressions()
 
         if self.cpm > 0:
-            total += self.views_today() * float(self.cpm) / 1000.0
+            total += impressions[VIEWS] * float(self.cpm) / 1000.0
         if self.cpc > 0:
-            total += self.clicks_today() * float(self.cpc)
+            total += impressions[CLICKS] * float(self.cpc)
 
         return total
 
+    @classmethod
+    def get_daily_impressions_cache_keys(cls, flight_id, day=None):
+        """Get the cache keys of a flight's daily counters without loading the flight."""
+        day = day or get_ad_day().date()
+        return {
+            impression_type: (
+                f"{cls.DAILY_IMPRESSIONS_CACHE_KEY_PREFIX}::{flight_id}"
+                f"::{impression_type}::{day:%Y-%m-%d}"
+            )
+            for impression_type in (VIEWS, CLICKS)
+        }
+
+    def daily_impressions_cache_keys(self, day=None):
+        return self.get_daily_impressions_cache_keys(self.pk, day)
+
+    def get_daily_impressions(self):
+        """
+        Get the views and clicks of this flight today from the shared cache.
+
+        Counters which aren't in the cache (eg. the flight's daily cap was just set)
+        are counted from the database.
+        """
+        cache_keys = self.daily_impressions_cache_keys()
+        counts = cache.get_many(cache_keys.values())
+        if len(counts) < len(cache_keys):
+            return self.reconcile_daily_impressions(only_missing=True)
+
+        return {
+            impression_type: counts[cache_key]
+            for impression_type, cache_key in cache_keys.items()
+        }
+
+    @classmethod
+    def increment_daily_impressions_by_id(
+        cls, flight_id, impression_type, day=None, delta=1
+    ):
+        """
+        Count (or with a negative ``delta``, refund) a view or click of a flight.
+
+        Only flights with a daily cap have counters (see ``get_daily_impressions``)
+        so this is a single cache call for flights without one.
+        """
+        cache_key = cls.get_daily_impressions_cache_keys(flight_id, day)[
+            impression_type
+        ]
+        try:
+            cache.incr(cache_key, delta=delta)
+        except ValueError:
+            # There's no counter yet. It is counted from the database when needed
+            pass
+
+    def increment_daily_impressions(self, impression_type, day=None, delta=1):
+        """Count a view or click of this flight in the shared cache."""
+        self.increment_daily_impressions_by_id(
+            self.pk, impression_type, day=day, delta=delta
+        )
+
+    def reconcile_daily_impressions(self, day=None, only_missing=False):
+        """
+        Set this flight's daily view and click counters from the database.
+
+        :param only_missing: only set the counters that aren't already in the cache
+        :returns: a dictionary of the views and clicks that day
+        """
+        day = day or get_ad_day().date()
+        aggregation = AdImpression.objects.filter(
+            advertisement__flight=self, date=day
+        ).aggregate(views=models.Sum("views"), clicks=models.Sum("clicks"))
+
+        # The aggregation can be `None` if there are no impressions
+        pending = self.get_pending_impressions(day)
+        counts = {
+            VIEWS: (aggregation["views"] or 0) + pending[VIEWS],
+            CLICKS: (aggregation["clicks"] or 0) + pending[CLICKS],
+        }
+        set_counter = cache.add if only_missing else cache.set
+        for impression_type, cache_key in self.daily_impressions_cache_keys(
+            day
+        ).items():
+            set_counter(
+                cache_key,
+                counts[impression_type],
+                timeout=self.DAILY_IMPRESSIONS_CACHE_TIMEOUT,
+            )
+
+        return counts
+
     def views_needed_this_interval(self):
         today = timezone.now().date()
         if (
@@ -1410,18 +1537,37 @@ class Flight(TimeStampedModel, IndestructibleModel):
         which causes higher paid and better CTR ads to be prioritized.
         Uses the passed publisher for a better CTR estimate if passed.
         """
+        publisher_ctr = None
+        if publisher and publisher.sampled_ctr > 0.01:
+            publisher_ctr = publisher.sampled_ctr
+
+        return self.weight_impressions_needed(
+            self.impressions_needed_this_interval(), publisher_ctr
+        )
+
+    def impressions_needed_this_interval(self):
+        """Clicks and views needed this interval where 1,000 views count as a click."""
         impressions_needed = 0
 
         # This is naive but we are counting a click as being worth 1,000 views
         impressions_needed += math.ceil(self.views_needed_this_interval() / 1000.0)
         impressions_needed += self.clicks_needed_this_interval()
 
+        return impressions_needed
+
+    def weight_impressions_needed(self, impressions_needed, publisher_ctr=None):
+        """
+        Weight the impressions needed by this flight's value, priority and how overdue it is.
+
+        This is split out from ``weighted_clicks_needed_this_interval``
+        so the weight can be computed for multiple publisher CTRs at once.
+        """
         if self.cpc:
             # Use the publisher CTR if available
             # Otherwise, use this flight's average CTR
             estimated_ctr = float(self.ctr())
-            if publisher and publisher.sampled_ctr > 0.01:
-                estimated_ctr = publisher.sampled_ctr
+            if publisher_ctr:
+                estimated_ctr = publisher_ctr
 
             # Note: CTR is in percent (eg. 0.1 means 0.1% not 0.001)
             estimated_ecpm = float(self.cpc) * estimated_ctr * 10
@@ -1515,8 +1661,8 @@ class Flight(TimeStampedModel, IndestructibleModel):
         """
         Check if the daily cap for a given flight has been exceeded.
 
-        When the daily cap is enabled (>0), then an extra query may be performed
-        for this check causing a slight performance degradation.
+        When the daily cap is enabled (>0), this reads the flight's
+        view and click counters from the shared cache.
         """
         if not self.daily_cap or self.daily_cap <= 0.0:
             return False
@@ -1681,6 +1827,19 @@ class AdType(TimeStampedModel, models.Model):
     See https://www.iab.com/newadportfolio/
     """
 
+    # Ad types are looked up on every offer but rarely change
+    # Saving an ad type changes the version in the shared cache
+    # which invalidates the ad types cached locally in every process
+    CACHE_KEY_PREFIX = "adtype"
+    CACHE_VERSION_KEY = "adtype-version"
+    CACHE_TIMEOUT = 60 * 5
+
+    # Templates using these render differently for every offer of the same ad
+    # Included/extended templates might use them too
+    PER_OFFER_TEMPLATE_RE = re.compile(
+        r"\b(keywords|topics)\b|{%\s*(include|extends)\b"
+    )
+
     name = models.CharField(_("Name"), max_length=200)
     slug = models.SlugField(_("Slug"), max_length=200, unique=True)
 
@@ -1754,6 +1913,60 @@ class AdType(TimeStampedModel, models.Model):
         """Simple override."""
         return self.name
 
+    def save(self, *args, **kwargs):
+        """Invalidate the cached ad types in every process after saving."""
+        super().save(*args, **kwargs)
+        cache.set(self.CACHE_VERSION_KEY, uuid.uuid7().hex, timeout=None)
+
+    @classmethod
+    def cache_key(cls, slug, version=None):
+        return f"{cls.CACHE_KEY_PREFIX}::{version}::{slug}"
+
+    @classmethod
+    def load_from_cache(cls, slug):
+        """Load an ad type by its slug from the local cache or database."""
+        cache_key = cls.cache_key(slug, cache.get(cls.CACHE_VERSION_KEY))
+        ad_type = caches[settings.CACHE_LOCAL_ALIAS].get(cache_key)
+        if ad_type is None:
+            ad_type = cls.objects.filter(slug=slug).first()
+            if ad_type:
+                caches[settings.CACHE_LOCAL_ALIAS].set(
+                    cache_key, ad_type, timeout=cls.CACHE_TIMEOUT
+                )
+        return ad_type
+
+    @classmethod
+    def get_compiled_template(cls, ad_type=None):
+        """
+        Get the compiled template for rendering ads of this ad type.
+
+        Templates are compiled once per process and again after the ad type changes.
+
+        :returns: a tuple of the template and whether it renders differently per offer
+        """
+        if not ad_type or not ad_type.template:
+            # Searching for a template is expensive but the template loader caches it
+            template = get_template("adserver/advertisement.html")
+            return template, cls.renders_per_offer(template.template.source)
+
+        cached = _compiled_ad_type_templates.get(ad_type.pk)
+        if cached and cached[0] == ad_type.modified:
+            return cached[1], cached[2]
+
+        template = engines["django"].from_string(ad_type.template)
+        per_offer = cls.renders_per_offer(ad_type.template)
+        _compiled_ad_type_templates[ad_type.pk] = (
+            ad_type.modified,
+            template,
+            per_offer,
+        )
+        return template, per_offer
+
+    @classmethod
+    def renders_per_offer(cls, template_source):
+        """Whether a template renders differently for every offer of the same ad."""
+        return bool(cls.PER_OFFER_TEMPLATE_RE.search(template_source))
+
     def validate_text(self, text):
         """Return true if this text is valid for this ad type and False otherwise."""
         text_length = len(text)
@@ -1809,6 +2022,11 @@ class Advertisement(TimeStampedModel, IndestructibleModel):
     and report to customers, they cannot be deleted once created.
     """
 
+    # Rendered offers are cached with this in place of the nonce
+    OFFER_CACHE_KEY_PREFIX = "ad-offer"
+    OFFER_CACHE_TIMEOUT = 60 * 15
+    OFFER_NONCE_PLACEHOLDER = "ea-offer-nonce-placeholder"
+
     name = models.CharField(_("Name"), max_length=200)
     slug = models.SlugField(_("Slug"), max_length=200, unique=True)
 
@@ -1988,22 +2206,42 @@ class Advertisement(TimeStampedModel, IndestructibleModel):
             # refreshed periodically by a background task.
             # See: Flight.refresh_denormalized_totals()
 
-        # Ensure that an impression object exists for today
-        # and make sure to query the writable DB for this
-        impression, created = AdImpression.objects.using("default").get_or_create(
-            advertisement=self,
-            publisher=publisher,
-            date=day,
-            defaults={imp_type: 1 for imp_type in impression_types},
-        )
-
-        if not created:
-            # If the object was created above, we don't need to update
-            # since the defaults will have already done the update for us.
-            AdImpression.objects.using("default").filter(pk=impression.pk).update(
-                **{imp_type: models.F(imp_type) + 1 for imp_type in impression_types}
+        if is_impression_counters_enabled():
+            # Counted and added to the AdImpression in bulk (see ``impressioncounters``)
+            record_impressions(
+                self.pk if self else None,
+                publisher.pk if publisher else None,
+                day,
+                {imp_type: 1 for imp_type in impression_types},
+            )
+        else:
+            # Ensure that an impression object exists for today
+            # and make sure to query the writable DB for this
+            impression, created = AdImpression.objects.using("default").get_or_create(
+                advertisement=self,
+                publisher=publisher,
+                date=day,
+                defaults={imp_type: 1 for imp_type in impression_types},
             )
 
+            if not created:
+                # If the object was created above, we don't need to update
+                # since the defaults will have already done the update for us.
+                AdImpression.objects.using("default").filter(pk=impression.pk).update(
+                    **{
+                        imp_type: models.F(imp_type) + 1
+                        for imp_type in impression_types
+                    }
+                )
+
+        # Count views and clicks toward the flight's daily cap
+        # Keyed by ``flight_id`` so the flight isn't loaded on every view and click
+        for imp_type in impression_types:
+            if imp_type in (VIEWS, CLICKS):
+                Flight.increment_daily_impressions_by_id(
+                    self.flight_id, imp_type, day=day
+                )
+
     def _record_base(
         self,
         request,
@@ -2025,7 +2263,7 @@ class Advertisement(TimeStampedModel, IndestructibleModel):
         ip_address = get_client_ip(request)
         user_agent = get_client_user_agent(request)
         client_id = get_client_id(request)
-        parsed_ua = parse(user_agent)
+        parsed_ua = parse_user_agent(user_agent)
         country = get_client_country(request)
         url = url or request.headers.get("referer")
         domain = get_domain_from_url(url)
@@ -2045,7 +2283,7 @@ class Advertisement(TimeStampedModel, IndestructibleModel):
             # we only store the first 100 characters of it.
             div_id = div_id[: Offer.DIV_MAXLENGTH]
 
-        obj = model.objects.create(
+        obj = model(
             date=timezone.now(),
             publisher=publisher,
             ip=anonymize_ip_address(ip_address),
@@ -2057,8 +2295,8 @@ class Advertisement(TimeStampedModel, IndestructibleModel):
             paid_eligible=paid_eligible,
             rotations=rotations,
             # Derived user agent data
-            browser_family=parsed_ua.browser.family,
-            os_family=parsed_ua.os.family,
+            browser_family=parsed_ua.browser_family,
+            os_family=parsed_ua.os_family,
             is_bot=parsed_ua.is_bot,
             is_mobile=parsed_ua.is_mobile,
             is_proxy=is_proxy_ip(ip_address),
@@ -2069,6 +2307,13 @@ class Advertisement(TimeStampedModel, IndestructibleModel):
             # Page info
             advertisement=self,
         )
+
+        if model is Offer and is_write_behind_enabled():
+            # Offers are inserted in batches in the background (see ``offerbuffer``)
+            buffer_offer(obj)
+        else:
+            obj.save(force_insert=True)
+
         return obj
 
     def track_impression(self, request, impression_type, publisher, offer):
@@ -2108,7 +2353,7 @@ class Advertisement(TimeStampedModel, IndestructibleModel):
 
         if request.GET.get("uplift"):
             # Don't overwrite Offer object here, since it might have changed prior to our writing
-            Offer.objects.filter(pk=offer.pk).update(uplifted=True)
+            update_offer(offer.pk, uplifted=True)
 
         if settings.ADSERVER_RECORD_VIEWS or publisher.record_views:
             return self._record_base(
@@ -2139,7 +2384,10 @@ class Advertisement(TimeStampedModel, IndestructibleModel):
             and not offer.view_time
             and view_time > 0
         ):
-            Offer.objects.filter(pk=offer.pk).update(view_time=view_time)
+            if is_signed_nonces_enabled():
+                return use_nonce(offer.pk, "view_time", view_time)
+
+            update_offer(offer.pk, view_time=view_time)
             return True
 
         log.info("View time was for an invalid view")
@@ -2162,7 +2410,7 @@ class Advertisement(TimeStampedModel, IndestructibleModel):
 
         Tracks an offer in the database to save data about it and compare against view.
         """
-        ad_type = AdType.objects.filter(slug=ad_type_slug).first()
+        ad_type = AdType.load_from_cache(ad_type_slug)
 
         offer = self._record_base(
             request=request,
@@ -2182,26 +2430,12 @@ class Advertisement(TimeStampedModel, IndestructibleModel):
             # By discarding the nonce, the ad view/click will never count.
             # We will still record data for unpaid campaign in reporting though.
             nonce = "forced"
+        elif is_signed_nonces_enabled():
+            # Views can be validated without reading the offer (see ``nonces``)
+            nonce = sign_nonce(offer)
         else:
             nonce = offer.pk
 
-        view_url = generate_absolute_url(
-            reverse("view-proxy", kwargs={"advertisement_id": self.pk, "nonce": nonce})
-        )
-
-        view_time_url = generate_absolute_url(
-            reverse(
-                "view-time-proxy", kwargs={"advertisement_id": self.pk, "nonce": nonce}
-            )
-        )
-
-        click_url = generate_absolute_url(
-            reverse("click-proxy", kwargs={"advertisement_id": self.pk, "nonce": nonce})
-        )
-
-        text = self.render_links(click_url)
-        body = html.unescape(bleach.clean(text, tags=[], strip=True))
-
         # Match keywords to topics, only when there are keywords to match
         topic_set = set()
         if keywords:
@@ -2211,6 +2445,16 @@ class Advertisement(TimeStampedModel, IndestructibleModel):
                     if topic_keyword in keywords:
                         topic_set.add(topic)
 
+        rendered = self.render_offer(
+            ad_type,
+            nonce=nonce,
+            publisher=publisher,
+            keywords=keywords,
+            topics=topic_set,
+        )
+        click_url = rendered["click_url"]
+        body = rendered["body"]
+
         logo = None
         if self.flight.flight_logo:
             logo = self.flight.flight_logo.url
@@ -2219,16 +2463,9 @@ class Advertisement(TimeStampedModel, IndestructibleModel):
 
         response = {
             "id": self.slug,
-            "text": text,
+            "text": rendered["text"],
             "body": body,
-            "html": self.render_ad(
-                ad_type,
-                click_url=click_url,
-                view_url=view_url,
-                publisher=publisher,
-                keywords=keywords,
-                topics=topic_set,
-            ),
+            "html": rendered["html"],
             # Breakdown of the ad text into its component parts
             "copy": {
                 "headline": self.headline or "",
@@ -2239,8 +2476,8 @@ class Advertisement(TimeStampedModel, IndestructibleModel):
             "logo": logo,
             "link": click_url,
             "link_domain": get_domain_from_url(self.link),
-            "view_url": view_url,
-            "view_time_url": view_time_url,
+            "view_url": rendered["view_url"],
+            "view_time_url": rendered["view_time_url"],
             "nonce": nonce,
             "display_type": ad_type_slug,
             "campaign_type": self.flight.campaign.campaign_type,
@@ -2271,17 +2508,29 @@ class Advertisement(TimeStampedModel, IndestructibleModel):
         Without this, when we don't offer an ad and a user doesn't have house ads on,
         we don't have any way to track how many requests for an ad there have been.
         """
-        offer = cls._record_base(
-            self=None,
-            request=request,
-            model=Offer,
-            publisher=publisher,
-            keywords=keywords,
-            url=url,
-            div_id=div_id,
-            ad_type_slug=ad_type_slug,
-            paid_eligible=paid_eligible,
-        )
+        if should_store_null_offer():
+            offer = cls._record_base(
+                self=None,
+                request=request,
+                model=Offer,
+                publisher=publisher,
+                keywords=keywords,
+                url=url,
+                div_id=div_id,
+                ad_type_slug=ad_type_slug,
+                paid_eligible=paid_eligible,
+            )
+        else:
+            # Only counted for the reports (see ``nulloffers``)
+            offer = None
+            count_null_offer(
+                publisher=publisher,
+                ad_type_slug=ad_type_slug,
+                div_id=div_id[: Offer.DIV_MAXLENGTH] if div_id else div_id,
+                country=get_client_country(request),
+                keywords=keywords,
+                paid_eligible=paid_eligible,
+            )
         cls.incr(self=None, impression_type=DECISIONS, publisher=publisher, offer=offer)
 
     def is_valid_offer(self, impression_type, offer):
@@ -2302,10 +2551,21 @@ class Advertisement(TimeStampedModel, IndestructibleModel):
         return False
 
     def invalidate_nonce(self, impression_type, nonce):
-        if impression_type == VIEWS:
-            Offer.objects.filter(id=nonce).update(viewed=True)
-        if impression_type == CLICKS:
-            Offer.objects.filter(id=nonce).update(clicked=True)
+        """
+        Mark the offer as viewed or clicked so its nonce can't be used again.
+
+        :returns: ``False`` if the nonce was already used
+        """
+        field = {VIEWS: "viewed", CLICKS: "clicked"}.get(impression_type)
+        if not field:
+            return False
+
+        if is_signed_nonces_enabled():
+            # Claimed in the cache and written to the offer later (see ``nonces``)
+            return use_nonce(nonce, field)
+
+        update_offer(nonce, **{field: True})
+        return True
 
     def view_ratio(self, day=None):
         if not day:
@@ -2326,13 +2586,19 @@ class Advertisement(TimeStampedModel, IndestructibleModel):
         if not day:
             day = get_ad_day()
         impression = self.impressions.get_or_create(date=day)[0]
-        return float(impression.clicks)
+        return float(impression.clicks + self.get_pending_impressions(day)[CLICKS])
 
     def views_shown_today(self, day=None):
         if not day:
             day = get_ad_day()
         impression = self.impressions.get_or_create(date=day)[0]
-        return float(impression.views)
+        return float(impression.views + self.get_pending_impressions(day)[VIEWS])
+
+    def get_pending_impressions(self, day):
+        """Get the impressions of this ad that aren't in AdImpression yet."""
+        if isinstance(day, datetime.datetime):
+            day = day.date()
+        return get_pending_counts([self.pk], day)
 
     def total_views(self):
         aggregate = self.impressions.aggregate(models.Sum("views"))["views__sum"]
@@ -2392,6 +2658,77 @@ class Advertisement(TimeStampedModel, IndestructibleModel):
 
         return mark_safe(ad_html.replace("<a>", a_tag))  # noqa: S308
 
+    def render_offer(self, ad_type, nonce, publisher, keywords=None, topics=None):
+        """
+        Render the text, HTML and proxy URLs for an offer of this ad.
+
+        Offers of an ad on a publisher only differ by their nonce
+        so the ad is rendered once with a placeholder nonce
+        and cached in the local cache by the ad, ad type and publisher.
+        Each offer substitutes its nonce into the cached copy.
+        Ad types with templates that use the keywords or topics are rendered every time.
+        """
+        template, per_offer = AdType.get_compiled_template(ad_type)
+        if per_offer:
+            return self._render_offer(
+                template, nonce, publisher, keywords=keywords, topics=topics
+            )
+
+        cache_key = "::".join(
+            str(part)
+            for part in (
+                self.OFFER_CACHE_KEY_PREFIX,
+                self.pk,
+                self.modified.timestamp() if self.modified else None,
+                ad_type.pk if ad_type else None,
+                ad_type.modified.timestamp() if ad_type else None,
+                publisher.pk,
+                publisher.modified.timestamp() if publisher.modified else None,
+                # The proxy URLs are absolute
+                generate_absolute_url(""),
+            )
+        )
+        rendered = caches[settings.CACHE_LOCAL_ALIAS].get(cache_key)
+        if rendered is None:
+            rendered = self._render_offer(
+                template, self.OFFER_NONCE_PLACEHOLDER, publisher
+            )
+            caches[settings.CACHE_LOCAL_ALIAS].set(
+                cache_key, rendered, timeout=self.OFFER_CACHE_TIMEOUT
+            )
+
+        nonce = str(nonce)
+        return {
+            name: value.replace(self.OFFER_NONCE_PLACEHOLDER, nonce)
+            for name, value in rendered.items()
+        }
+
+    def _render_offer(self, template, nonce, publisher, keywords=None, topics=None):
+        urls = {}
+        for name, url_name in (
+            ("view_url", "view-proxy"),
+            ("view_time_url", "view-time-proxy"),
+            ("click_url", "click-proxy"),
+        ):
+            urls[name] = generate_absolute_url(
+                reverse(url_name, kwargs={"advertisement_id": self.pk, "nonce": nonce})
+            )
+
+        text = self.render_links(urls["click_url"])
+        body = html.unescape(bleach.clean(text, tags=[], strip=True))
+        ad_html = self._render_template(
+            template,
+            click_url=urls["click_url"],
+            view_url=urls["view_url"],
+            publisher=publisher,
+            keywords=keywords,
+            topics=topics,
+            text=text,
+            body=body,
+        )
+
+        return {"text": text, "body": body, "html": ad_html, **urls}
+
     def render_ad(
         self,
         ad_type,
@@ -2408,24 +2745,48 @@ class Advertisement(TimeStampedModel, IndestructibleModel):
             # This is only used to preview the ad
             ad_type = self.ad_types.all().first()
 
-        if ad_type and ad_type.template:
-            # Check if the ad type has a specific template
-            template = engines["django"].from_string(ad_type.template)
-        else:
-            # Otherwise get the default template
-            # Don't do this by default as searching for a template is expensive
-            template = get_template("adserver/advertisement.html")
+        # Uses the ad type's template or the default template
+        template, _ = AdType.get_compiled_template(ad_type)
 
+        # Render old style ads where HTML was allowed
+        # New style ads just use headline/content/CTA
+        text = self.render_links(click_url or self.link)
+        body = html.unescape(bleach.clean(text, tags=[], strip=True))
+
+        return self._render_template(
+            template,
+            click_url=click_url,
+            view_url=view_url,
+            publisher=publisher,
+            keywords=keywords,
+            topics=topics,
+            text=text,
+            body=body,
+            preview=preview,
+        )
+
+    def _render_template(
+        self,
+        template,
+        click_url,
+        view_url,
+        publisher,
+        keywords,
+        topics,
+        text,
+        body,
+        preview=False,
+    ):
         image_preview_url = None
         if preview:
             # When previewing an ad (typically in the advertiser dashboard)
             # we want to display a simple placeholder image.
             image_preview_url = static("image-placeholder.png")
 
-        # Render old style ads where HTML was allowed
-        # New style ads just use headline/content/CTA
-        text = self.render_links(click_url or self.link)
-        body = html.unescape(bleach.clean(text, tags=[], strip=True))
+        text_as_html = text
+        if preview or not click_url:
+            # The text above is only rendered the same way for non-preview offers
+            text_as_html = self.render_links(link=click_url, preview=preview)
 
         return template.render(
             {
@@ -2435,7 +2796,7 @@ class Advertisement(TimeStampedModel, IndestructibleModel):
                 "link_url": click_url or self.link,
                 "link_domain": get_domain_from_url(self.link),
                 "view_url": view_url,
-                "text_as_html": self.render_links(link=click_url, preview=preview),
+                "text_as_html": text_as_html,
                 # Pass keywords and topics so we can be smart with what landing page
                 # to link the `Ads by EthicalAds` to.
                 "keywords": keywords,
@@ -2543,6 +2904,56 @@ class AdImpression(BaseImpression):
         return "%s on %s" % (self.advertisement, self.date)
 
 
+class NullOfferImpression(TimeStampedModel, models.Model):
+    """
+    Counts of null offers (ad decisions without an ad) that weren't stored as offers.
+
+    Null offers are counted here with ``ADSERVER_NULL_OFFER_AGGREGATION``
+    (see ``adserver.nulloffers``) and added to the reports with the stored offers.
+    """
+
+    date = models.DateField(_("Date"), db_index=True)
+    publisher = models.ForeignKey(
+        Publisher, related_name="null_offer_impressions", on_delete=models.PROTECT
+    )
+    # Missing values are "" rather than NULL so counts are unique on every database
+    ad_type_slug = models.CharField(
+        _("Ad type"), blank=True, default="", max_length=100
+    )
+    div_id = models.CharField(max_length=255, blank=True, default="")
+    country = CountryField(blank=True, default="")
+    keywords = models.JSONField(
+        _("Keyword targeting for this view"), blank=True, null=True
+    )
+    # A hash of the keywords so counts with the same keywords are unique
+    keywords_hash = models.CharField(max_length=32, blank=True, default="")
+    paid_eligible = models.BooleanField(default=False)
+
+    decisions = models.PositiveIntegerField(_("Decisions"), default=0)
+
+    class Meta:
+        constraints = (
+            UniqueConstraint(
+                fields=(
+                    "publisher",
+                    "date",
+                    "ad_type_slug",
+                    "div_id",
+                    "country",
+                    "keywords_hash",
+                    "paid_eligible",
+                ),
+                name="null_offer_impression_unique",
+            ),
+        )
+        ordering = ("-date",)
+        verbose_name_plural = _("Null offer impressions")
+
+    def __str__(self):
+        """Simple override."""
+        return "Null offers for %s on %s" % (self.publisher, self.date)
+
+
 class AdvertiserImpression(BaseImpression):
     """
     Create a daily index by advertiser (and nothing else).
@@ -2962,6 +3373,9 @@ class Offer(AdBase):
 
     MAX_VIEW_TIME = 5 * 60  # seconds
 
+    # Views and clicks of older offers aren't counted
+    MAX_AGE = datetime.timedelta(hours=2)
+
     # Use an ok user-facing pk value
     id = models.UUIDField(primary_key=True, default=uuid.uuid7, editable=False)
 
@@ -3003,7 +3417,17 @@ class Offer(AdBase):
             # Prevent double refunding
             return False
 
-        if self.advertisement:
+        if self.advertisement and is_impression_counters_enabled():
+            # Refunds are counted like any other impressions (see ``impressioncounters``)
+            counts = {self.impression_type: -1}
+            if self.viewed:
+                counts[VIEWS] = counts.get(VIEWS, 0) - 1
+            if self.clicked:
+                counts[CLICKS] = counts.get(CLICKS, 0) - 1
+            record_impressions(
+                self.advertisement_id, self.publisher_id, self.date.date(), counts
+            )
+        elif self.advertisement:
             # Update the denormalized aggregate impression object
             impression = self.advertisement.impressions.get(
                 publisher=self.publisher, date=self.date.date()
@@ -3024,6 +3448,20 @@ class Offer(AdBase):
                     **{CLICKS: models.F(CLICKS) - 1}
                 )
 
+        if self.advertisement:
+            # Refunded views and clicks no longer count toward the flight's daily cap
+            for impression_type, refunded in (
+                (VIEWS, self.viewed),
+                (CLICKS, self.clicked),
+            ):
+                if refunded:
+                    Flight.increment_daily_impressions_by_id(
+                        self.advertisement.flight_id,
+                        impression_type,
+                        day=self.date.date(),
+                        delta=-1,
+                    )
+
         self.is_refunded = True
         self.save()
 
@@ -3031,7 +3469,7 @@ class Offer(AdBase):
 
     def is_old(self):
         """Checks if this offer is "old" meaning not for a currently running ad."""
-        old_threshold = timezone.now() - datetime.timedelta(hours=2)
+        old_threshold = timezone.now() - self.MAX_AGE
         if old_threshold > self.date:
             return True
         return False
@@ -0,0 +1,254 @@
+"""
+Signed offer nonces so ad views and clicks can be validated without the database.
+
+Each offer's nonce is in its view and click URLs. Normally the nonce is the offer's ID,
+so every view and click reads the offer and then updates it (eg. ``viewed``)
+so the nonce can't be used again. With ``ADSERVER_SIGNED_NONCES`` enabled:
+
+* The nonce is a signed payload of the offer ID, ad, publisher, date,
+  OS and browser family and country. The view proxy checks the nonce
+  (signature, age and the user agent) from the payload alone.
+  Clicks (and views for publishers that record them) still read the offer
+  since they need the rest of its details.
+* Using a nonce (a view, click or view time) is claimed in the cache
+  with an atomic add that expires when the offer is too old to use.
+  Only the first request to claim it is counted.
+* The offer is updated in batches by the ``flush_used_nonces`` task.
+  Updates are queued in Redis hashes (with django-redis)
+  or a per-process queue otherwise (development and testing only).
+"""
+
+import collections
+import datetime
+import json
+import logging
+import threading
+import uuid
+from dataclasses import dataclass
+
+from django.apps import apps
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+
+from .counters import decode
+from .counters import get_redis_client
+from .offerbuffer import update_offers
+
+
+log = logging.getLogger(__name__)  # noqa
+
+NONCE_SALT = "adserver.nonces"
+
+CLAIM_CACHE_KEY_PREFIX = "nonce-used"
+UPDATES_CACHE_KEY_PREFIX = "nonce-updates"
+
+# Claims only need to last until the offer is too old to use (``Offer.is_old``)
+CLAIM_TIMEOUT_MARGIN = 60 * 10
+
+# The offer fields that are set when a nonce is used
+NONCE_FIELDS = ("viewed", "clicked", "view_time")
+
+# Field -> offer ID -> value
+# The updates queued when the cache isn't Redis (development and testing)
+_local_updates = collections.defaultdict(dict)
+_local_updates_lock = threading.Lock()
+
+
+@dataclass(frozen=True, slots=True)
+class NoncePayload:
+    """The offer details carried by a signed nonce."""
+
+    offer_id: uuid.UUID
+    advertisement_id: int
+    publisher_id: int
+    date: datetime.datetime
+    os_family: str
+    browser_family: str
+    country: str
+
+
+def _get_offer_model():
+    return apps.get_model("adserver", "Offer")
+
+
+def is_signed_nonces_enabled():
+    return settings.ADSERVER_SIGNED_NONCES
+
+
+def sign_nonce(offer):
+    """Get a signed nonce for an offer."""
+    return signing.dumps(
+        [
+            offer.pk.hex,
+            offer.advertisement_id,
+            offer.publisher_id,
+            int(offer.date.timestamp()),
+            offer.os_family,
+            offer.browser_family,
+            offer.country and str(offer.country),
+        ],
+        salt=NONCE_SALT,
+        compress=True,
+    )
+
+
+def load_nonce(nonce):
+    """
+    Get the offer details from a signed nonce.
+
+    The age of the nonce isn't checked here (see ``Offer.is_old``).
+
+    :returns: a ``NoncePayload`` or ``None`` if this isn't a valid signed nonce
+    """
+    try:
+        (
+            offer_id,
+            advertisement_id,
+            publisher_id,
+            timestamp,
+            os_family,
+            browser_family,
+            country,
+        ) = signing.loads(nonce, salt=NONCE_SALT)
+    except (signing.BadSignature, TypeError, ValueError):
+        return None
+
+    return NoncePayload(
+        offer_id=uuid.UUID(offer_id),
+        advertisement_id=advertisement_id,
+        publisher_id=publisher_id,
+        date=datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc),
+        os_family=os_family,
+        browser_family=browser_family,
+        country=country,
+    )
+
+
+def get_claim_cache_key(offer_id, field):
+    return f"{CLAIM_CACHE_KEY_PREFIX}::{offer_id}::{field}"
+
+
+def get_claims(offer_id):
+    """
+    Get the uses of this offer's nonce that haven't been written to the offer yet.
+
+    :returns: a dictionary of offer field (eg. ``viewed``) -> value
+    """
+    keys = {get_claim_cache_key(offer_id, field): field for field in NONCE_FIELDS}
+    return {keys[key]: value for key, value in cache.get_many(keys).items()}
+
+
+def apply_claims(offer):
+    """Set the fields of an offer from its nonce's uses that haven't been written yet."""
+    for field, value in get_claims(offer.pk).items():
+        setattr(offer, field, value)
+    return offer
+
+
+def get_nonce_offer(payload):
+    """
+    Get an (unsaved) offer with only the details in a signed nonce.
+
+    :param payload: a ``NoncePayload``
+    """
+    offer = _get_offer_model()(
+        id=payload.offer_id,
+        advertisement_id=payload.advertisement_id,
+        publisher_id=payload.publisher_id,
+        date=payload.date,
+        os_family=payload.os_family,
+        browser_family=payload.browser_family,
+        country=payload.country,
+    )
+    return apply_claims(offer)
+
+
+def use_nonce(offer_id, field, value=True):
+    """
+    Claim a use of an offer's nonce and queue the update to the offer.
+
+    :param field: the offer field set by this use (eg. ``viewed``)
+    :returns: whether this was the first use (``False`` if it was already claimed)
+    """
+    timeout = int(_get_offer_model().MAX_AGE.total_seconds()) + CLAIM_TIMEOUT_MARGIN
+    if not cache.add(get_claim_cache_key(offer_id, field), value, timeout=timeout):
+        return False
+
+    client = get_redis_client()
+    if client:
+        client.hset(
+            cache.make_key(f"{UPDATES_CACHE_KEY_PREFIX}::{field}"),
+            str(offer_id),
+            json.dumps(value),
+        )
+    else:
+        with _local_updates_lock:
+            _local_updates[field][str(offer_id)] = value
+
+    return True
+
+
+def _take_updates(client, field):
+    """Atomically read and delete the queued updates of a field."""
+    if not client:
+        with _local_updates_lock:
+            return _local_updates.pop(field, {})
+
+    key = cache.make_key(f"{UPDATES_CACHE_KEY_PREFIX}::{field}")
+    pipeline = client.pipeline(transaction=True)
+    pipeline.hgetall(key)
+    pipeline.delete(key)
+    values, _ = pipeline.execute()
+    return {decode(offer_id): json.loads(value) for offer_id, value in values.items()}
+
+
+def _restore_updates(client, field, updates):
+    if not updates:
+        return
+
+    if client:
+        client.hset(
+            cache.make_key(f"{UPDATES_CACHE_KEY_PREFIX}::{field}"),
+            mapping={
+                offer_id: json.dumps(value) for offer_id, value in updates.items()
+            },
+        )
+    else:
+        with _local_updates_lock:
+            _local_updates[field].update(updates)
+
+
+def flush_used_nonces(batch_size=1000):
+    """
+    Write the queued uses of nonces to their offers.
+
+    Offers with the same update are updated together in batches.
+
+    :returns: the number of offers updated
+    """
+    client = get_redis_client()
+
+    updated = 0
+    for field in NONCE_FIELDS:
+        updates = _take_updates(client, field)
+        offers_by_value = collections.defaultdict(list)
+        for offer_id, value in updates.items():
+            offers_by_value[value].append(offer_id)
+
+        try:
+            for value, offer_ids in offers_by_value.items():
+                for start in range(0, len(offer_ids), batch_size):
+                    batch = offer_ids[start : start + batch_size]
+                    update_offers(batch, **{field: value})
+                    updated += len(batch)
+        except Exception:
+            # Queue the updates again so they're written by the next flush.
+            # Writing an update twice is harmless
+            log.exception("Failed to write used nonces")
+            _restore_updates(client, field, updates)
+            raise
+
+    if updated:
+        log.info("Flushed used nonces. offers=%s", updated)
+    return updated
@@ -0,0 +1,152 @@
+"""
+Aggregated counts of null offers (ad decisions that didn't return an ad).
+
+A null offer is only stored to compute fill rates in the daily reports
+but storing a full ``Offer`` for each one is most of the writes
+for publishers with a low fill rate.
+When ``ADSERVER_NULL_OFFER_AGGREGATION`` is enabled, null offers are counted instead
+by publisher, day, ad type, placement (div ID), country, keywords and paid eligibility.
+A sample of null offers (``ADSERVER_NULL_OFFER_SAMPLE_RATE``) is still stored in full.
+
+* Counts are kept in a hash per publisher per day with a field per set of dimensions
+  (see ``counters``)
+* The ``flush_buffered_null_offers`` task adds the counts to ``NullOfferImpression``
+  every minute and the report tasks flush them before they run
+* The report tasks (eg. ``daily_update_placements``) add the counted null offers
+  to the ones stored as offers so reports count every null offer exactly once
+"""
+
+import datetime
+import hashlib
+import json
+import logging
+import random
+
+from django.apps import apps
+from django.conf import settings
+from django.db import models
+from django.db import transaction
+from django.utils import timezone
+
+from .counters import HashCounters
+
+
+log = logging.getLogger(__name__)  # noqa
+
+CACHE_KEY_PREFIX = "null-offers"
+
+# Counts are flushed every minute. This only stops abandoned counts living forever
+CACHE_TIMEOUT = 60 * 60 * 48
+
+# The fields of each publisher's daily hash are the dimensions as JSON
+_counters = HashCounters(CACHE_KEY_PREFIX, CACHE_TIMEOUT)
+
+
+def _get_null_offer_model():
+    return apps.get_model("adserver", "NullOfferImpression")
+
+
+def is_null_offer_aggregation_enabled():
+    return settings.ADSERVER_NULL_OFFER_AGGREGATION
+
+
+def should_store_null_offer():
+    """Whether this null offer should be stored in full rather than counted."""
+    if not is_null_offer_aggregation_enabled():
+        return True
+    return random.random() < settings.ADSERVER_NULL_OFFER_SAMPLE_RATE
+
+
+def get_keywords_hash(keywords):
+    """Get a short hash of a set of keywords ("" without any keywords)."""
+    if not keywords:
+        return ""
+    return hashlib.blake2b(
+        json.dumps(keywords).encode("utf-8"), digest_size=16
+    ).hexdigest()
+
+
+def get_counter_key(publisher_id, day):
+    return f"{CACHE_KEY_PREFIX}::{publisher_id}::{day:%Y-%m-%d}"
+
+
+def _parse_counter_key(key):
+    _, publisher_id, day = key.split("::")
+    return int(publisher_id), datetime.date.fromisoformat(day)
+
+
+def count_null_offer(
+    publisher, ad_type_slug, div_id, country, keywords, paid_eligible=False
+):
+    """Count a null offer to be added to ``NullOfferImpression``."""
+    keywords = sorted(set(keywords)) if keywords else None
+
+    day = timezone.now().date()
+    field = json.dumps(
+        [
+            ad_type_slug or "",
+            div_id or "",
+            str(country) if country else "",
+            keywords,
+            paid_eligible,
+        ]
+    )
+
+    _counters.incr(get_counter_key(publisher.pk, day), {field: 1})
+
+
+def _write_counts(counts):
+    """Add the counts to their ``NullOfferImpression`` rows (creating any that don't exist)."""
+    model = _get_null_offer_model()
+
+    rows = {}
+    for (key, field), count in counts.items():
+        publisher_id, day = _parse_counter_key(key)
+        ad_type_slug, div_id, country, keywords, paid_eligible = json.loads(field)
+        rows[(publisher_id, day, field)] = (
+            {
+                "publisher_id": publisher_id,
+                "date": day,
+                # Counts from before missing values were stored as "" may have None
+                "ad_type_slug": ad_type_slug or "",
+                "div_id": div_id or "",
+                "country": country or "",
+                "keywords_hash": get_keywords_hash(keywords),
+                "paid_eligible": paid_eligible,
+            },
+            keywords,
+            count,
+        )
+
+    with transaction.atomic(using="default"):
+        model.objects.using("default").bulk_create(
+            [
+                model(keywords=keywords, **lookup)
+                for lookup, keywords, _ in rows.values()
+            ],
+            ignore_conflicts=True,
+        )
+        # Sort the rows so concurrent flushes lock them in the same order
+        for key in sorted(rows):
+            lookup, _, count = rows[key]
+            model.objects.using("default").filter(**lookup).update(
+                decisions=models.F("decisions") + count
+            )
+
+    return len(rows)
+
+
+def flush_null_offer_counters(batch_size=None):
+    """
+    Add all the counted null offers to ``NullOfferImpression``.
+
+    :param batch_size: counter hashes per transaction
+        (``ADSERVER_NULL_OFFER_BATCH_SIZE`` by default)
+    :returns: the number of ``NullOfferImpression`` rows updated
+    """
+    batch_size = batch_size or settings.ADSERVER_NULL_OFFER_BATCH_SIZE
+    updated = _counters.flush(_write_counts, batch_size)
+
+    if updated:
+        log.info("Flushed null offer counters. rows=%s", updated)
+    return updated
@@ -0,0 +1,247 @@
+"""
+Write-behind buffering of ad offers.
+
+Every ad decision records an ``Offer`` and the Offer table is by far the largest
+and busiest table. When ``ADSERVER_OFFER_WRITE_BEHIND`` is enabled,
+offers aren't inserted while the decision is made.
+Instead, each offer (which already has its UUIDv7 ID) is:
+
+* Stored as a pending offer in the cache so the view and click proxies can find it
+  before it's in the database. Changes to the offer (eg. it was viewed)
+  are made to the pending offer as well as the database.
+* Appended to a Redis stream (with django-redis) or a per-process queue otherwise.
+  The queue is only suitable for development and testing
+  since offers in it are lost when the process exits.
+
+The ``flush_buffered_offers`` task reads the stream in batches
+and bulk inserts the offers with multi-row INSERTs using the latest pending state.
+Stream entries are only acknowledged after they're inserted so offers are never lost
+if a worker dies while flushing. Inserting an offer twice is ignored.
+"""
+
+import collections
+import json
+import logging
+import os
+import socket
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .counters import get_redis_client
+
+
+log = logging.getLogger(__name__)  # noqa
+
+STREAM_KEY = "offer-buffer"
+STREAM_GROUP = "offer-writers"
+
+PENDING_CACHE_KEY_PREFIX = "offer-pending"
+
+# Offers are only valid for views and clicks for a couple hours (``Offer.is_old``)
+PENDING_CACHE_TIMEOUT = 60 * 60 * 3
+
+# Pending entries that weren't acknowledged (eg. the worker died) are retried after this
+STREAM_RETRY_IDLE_MS = 60 * 1000
+
+# Fields that change after an offer is made (views, clicks, etc.)
+MUTABLE_FIELDS = ("viewed", "clicked", "uplifted", "view_time", "is_refunded")
+
+# The queue used when the cache isn't Redis (development and testing)
+_local_stream = collections.deque()
+
+
+def _get_offer_model():
+    return apps.get_model("adserver", "Offer")
+
+
+def is_write_behind_enabled():
+    return settings.ADSERVER_OFFER_WRITE_BEHIND
+
+
+def get_pending_cache_key(offer_id):
+    return f"{PENDING_CACHE_KEY_PREFIX}::{offer_id}"
+
+
+def serialize_offer(offer):
+    """Get the offer's field values (by attribute name eg. ``publisher_id``)."""
+    return {
+        field.attname: field.get_prep_value(field.value_from_object(offer))
+        for field in offer._meta.concrete_fields
+    }
+
+
+def deserialize_offer(data):
+    """Get an (unsaved) offer from its field values (as serialized or as JSON)."""
+    model = _get_offer_model()
+    values = {}
+    for field in model._meta.concrete_fields:
+        if field.attname in data:
+            values[field.attname] = field.to_python(data[field.attname])
+    return model(**values)
+
+
+def buffer_offer(offer):
+    """Queue an unsaved offer to be inserted in the background."""
+    data = serialize_offer(offer)
+    cache.set(get_pending_cache_key(offer.pk), data, PENDING_CACHE_TIMEOUT)
+
+    payload = json.dumps(data, cls=DjangoJSONEncoder)
+    client = get_redis_client()
+    if client:
+        client.xadd(cache.make_key(STREAM_KEY), {"offer": payload})
+    else:
+        _local_stream.append(payload)
+
+
+def get_pending_offer(offer_id):
+    """Get an offer that hasn't been inserted yet or ``None``."""
+    if not is_write_behind_enabled():
+        return None
+
+    data = cache.get(get_pending_cache_key(offer_id))
+    if data is None:
+        return None
+    return deserialize_offer(data)
+
+
+def update_offer(offer_id, **fields):
+    """
+    Update fields of an offer whether or not it has been inserted yet.
+
+    Like ``QuerySet.update``, this doesn't overwrite other fields of the offer.
+    """
+    if is_write_behind_enabled():
+        key = get_pending_cache_key(offer_id)
+        data = cache.get(key)
+        if data is not None:
+            data.update(fields)
+            cache.set(key, data, PENDING_CACHE_TIMEOUT)
+
+    # The pending offer is updated first. If the offer was inserted
+    # after reading the pending offer, this update applies to the inserted row
+    return _get_offer_model().objects.filter(pk=offer_id).update(**fields)
+
+
+def update_offers(offer_ids, **fields):
+    """Update fields of many offers whether or not they have been inserted yet."""
+    offer_ids = list(offer_ids)
+    if is_write_behind_enabled():
+        keys = [get_pending_cache_key(offer_id) for offer_id in offer_ids]
+        pending = cache.get_many(keys)
+        for data in pending.values():
+            data.update(fields)
+        if pending:
+            cache.set_many(pending, PENDING_CACHE_TIMEOUT)
+
+    return _get_offer_model().objects.filter(pk__in=offer_ids).update(**fields)
+
+
+def _read_stream(client, batch_size):
+    """
+    Read a batch of entries from the stream (retrying abandoned entries first).
+
+    :returns: a list of 2-tuples of the entry ID and the offer JSON
+        (``None`` if the entry was deleted)
+    """
+    from redis.exceptions import ResponseError  # noqa
+
+    stream_key = cache.make_key(STREAM_KEY)
+    consumer = f"{socket.gethostname()}-{os.getpid()}"
+
+    try:
+        client.xgroup_create(stream_key, STREAM_GROUP, id="0", mkstream=True)
+    except ResponseError as exception:
+        if "BUSYGROUP" not in str(exception):
+            raise
+
+    _, entries, *_ = client.xautoclaim(
+        stream_key,
+        STREAM_GROUP,
+        consumer,
+        min_idle_time=STREAM_RETRY_IDLE_MS,
+        count=batch_size,
+    )
+    if not entries:
+        response = client.xreadgroup(
+            STREAM_GROUP, consumer, {stream_key: ">"}, count=batch_size
+        )
+        entries = response[0][1] if response else []
+
+    return [
+        (entry_id, fields[b"offer"] if fields else None) for entry_id, fields in entries
+    ]
+
+
+def _write_offers(payloads):
+    """Insert the offers with their latest pending state."""
+    model = _get_offer_model()
+
+    offers = {}
+    for payload in payloads:
+        offer = deserialize_offer(json.loads(payload))
+        offers[get_pending_cache_key(offer.pk)] = offer
+
+    pending = cache.get_many(offers.keys())
+    for key, data in pending.items():
+        offers[key] = deserialize_offer(data)
+
+    model.objects.bulk_create(offers.values(), ignore_conflicts=True)
+
+    # Apply any changes made to the pending offers while they were inserted
+    for key, data in cache.get_many(offers.keys()).items():
+        offer = offers[key]
+        changes = {
+            field: data[field]
+            for field in MUTABLE_FIELDS
+            if field in data and data[field] != getattr(offer, field)
+        }
+        if changes:
+            model.objects.filter(pk=offer.pk).update(**changes)
+
+    # Views and clicks now update the inserted offers
+    cache.delete_many(offers.keys())
+
+
+def flush_offer_buffer(batch_size=None, max_batches=None):
+    """
+    Insert buffered offers into the database in batches.
+
+    :param batch_size: offers per insert (``ADSERVER_OFFER_BUFFER_BATCH_SIZE`` by default)
+    :param max_batches: stop after this many batches (all buffered offers by default)
+    :returns: the number of offers written
+    """
+    batch_size = batch_size or settings.ADSERVER_OFFER_BUFFER_BATCH_SIZE
+    client = get_redis_client()
+
+    written = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        if client:
+            entries = _read_stream(client, batch_size)
+        else:
+            entries = [
+                (None, _local_stream.popleft())
+                for _ in range(min(batch_size, len(_local_stream)))
+            ]
+
+        if not entries:
+            break
+
+        _write_offers([payload for _, payload in entries if payload])
+        if client:
+            entry_ids = [entry_id for entry_id, _ in entries]
+            stream_key = cache.make_key(STREAM_KEY)
+            client.xack(stream_key, STREAM_GROUP, *entry_ids)
+            client.xdel(stream_key, *entry_ids)
+
+        written += len(entries)
+        batches += 1
+        if len(entries) < batch_size:
+            break
+
+    if written:
+        log.info("Wrote buffered offers. offers=%s, batches=%s", written, batches)
+    return written
@@ -0,0 +1,326 @@
+"""
+Native Postgres range partitioning of the Offer table by date.
+
+The Offer table is by far the largest table and it used to be kept small
+by rolling it to a new table (``ADSERVER_OFFER_DB_TABLE``) and deleting archived offers
+with a ``DELETE`` that could run for hours.
+A partitioned Offer table is split into a partition per day or month
+(``ADSERVER_OFFER_PARTITION_INTERVAL``) so:
+
+* The daily aggregations (which always filter on ``date``) only scan their partition
+* Removing archived offers detaches and drops whole partitions
+  (see the ``archive_offers`` command) rather than deleting rows
+
+A partitioned table is created with ``django-admin partition_offers --create-table <name>``
+and used by setting ``ADSERVER_OFFER_DB_TABLE`` to its name.
+Postgres requires the partition key in the primary key so the table's primary key
+is ``(id, date)``. Offer IDs (UUIDv7) are still unique and Django still uses ``id``.
+
+The ``create_offer_partitions`` task creates the partitions ahead of time
+(``ADSERVER_OFFER_PARTITIONS_PREMAKE``). Offers outside of every partition
+(eg. the task stopped running) go to a DEFAULT partition rather than failing to insert.
+The task logs an error when the DEFAULT partition has offers.
+Postgres won't create a partition for dates that the DEFAULT partition has offers for
+so ``create_partitions`` moves them to the new partition.
+"""
+
+import datetime
+import logging
+import re
+from dataclasses import dataclass
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connections
+from django.db import transaction
+
+
+log = logging.getLogger(__name__)  # noqa
+
+DAY = "day"
+MONTH = "month"
+PARTITION_INTERVALS = (DAY, MONTH)
+
+# Matches the bounds of a range partition
+# eg. FOR VALUES FROM ('2026-10-01 00:00:00+00') TO ('2026-11-01 00:00:00+00')
+PARTITION_BOUND_RE = re.compile(
+    r"FROM \('(?P<start>\d{4}-\d{2}-\d{2})[^']*'\) TO \('(?P<end>\d{4}-\d{2}-\d{2})[^']*'\)"
+)
+
+# Indexes on the partitioned table (created on every partition)
+INDEXED_COLUMNS = ("date", "advertisement_id", "publisher_id")
+
+
+@dataclass(frozen=True, slots=True)
+class Partition:
+    """A partition of the Offer table with offers from ``start`` up to (not including) ``end``."""
+
+    name: str
+    start: datetime.date
+    end: datetime.date
+
+
+def _get_offer_table():
+    return apps.get_model("adserver", "Offer")._meta.db_table
+
+
+def get_partition_start(day, interval=None):
+    """Get the first day of the partition that would contain ``day``."""
+    interval = interval or settings.ADSERVER_OFFER_PARTITION_INTERVAL
+    if interval == MONTH:
+        return day.replace(day=1)
+    return day
+
+
+def get_next_partition_start(start, interval=None):
+    """Get the first day of the partition after the one starting on ``start``."""
+    interval = interval or settings.ADSERVER_OFFER_PARTITION_INTERVAL
+    if interval == MONTH:
+        return (start.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+    return start + datetime.timedelta(days=1)
+
+
+def get_partition_name(table, start, interval=None):
+    interval = interval or settings.ADSERVER_OFFER_PARTITION_INTERVAL
+    if interval == MONTH:
+        return f"{table}_p{start:%Y%m}"
+    return f"{table}_p{start:%Y%m%d}"
+
+
+def get_default_partition_name(table):
+    return f"{table}_default"
+
+
+def is_partitioned(table=None, using="default"):
+    """Whether the Offer table (or ``table``) is a partitioned table."""
+    table = table or _get_offer_table()
+    connection = connections[using]
+    if connection.vendor != "postgresql":
+        return False
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT 1 FROM pg_partitioned_table pt
+            JOIN pg_class c ON c.oid = pt.partrelid
+            WHERE c.oid = to_regclass(%s)
+            """,
+            [table],
+        )
+        return cursor.fetchone() is not None
+
+
+def get_partitions(table=None, using="default"):
+    """
+    Get the partitions of the Offer table (or ``table``) ordered by date.
+
+    Partitions that aren't a range of days (eg. a default partition) are skipped.
+
+    :returns: a list of ``Partition``
+    """
+    table = table or _get_offer_table()
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT child.relname, pg_get_expr(child.relpartbound, child.oid)
+            FROM pg_inherits
+            JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+            WHERE pg_inherits.inhparent = to_regclass(%s)
+            """,
+            [table],
+        )
+        rows = cursor.fetchall()
+
+    partitions = []
+    for name, bound in rows:
+        match = PARTITION_BOUND_RE.search(bound or "")
+        if not match:
+            continue
+        partitions.append(
+            Partition(
+                name=name,
+                start=datetime.date.fromisoformat(match.group("start")),
+                end=datetime.date.fromisoformat(match.group("end")),
+            )
+        )
+
+    return sorted(partitions, key=lambda partition: partition.start)
+
+
+def create_partitions(start, count=None, table=None, interval=None, using="default"):
+    """
+    Create the partitions from the one containing ``start`` that don't exist yet.
+
+    :param count: the number of partitions (``ADSERVER_OFFER_PARTITIONS_PREMAKE`` by default)
+    :returns: a list of the created ``Partition``
+    """
+    table = table or _get_offer_table()
+    count = count or settings.ADSERVER_OFFER_PARTITIONS_PREMAKE
+    interval = interval or settings.ADSERVER_OFFER_PARTITION_INTERVAL
+    connection = connections[using]
+    quote_name = connection.ops.quote_name
+
+    default_name = get_default_partition_name(table)
+    moved_name = f"{table}_moved"
+    existing = {partition.start for partition in get_partitions(table, using=using)}
+
+    # Tables partitioned before there was a DEFAULT partition don't have one
+    create_default_partition(table, using=using)
+
+    created = []
+    partition_start = get_partition_start(start, interval)
+    for _ in range(count):
+        partition_end = get_next_partition_start(partition_start, interval)
+        if partition_start not in existing:
+            name = get_partition_name(table, partition_start, interval)
+            log.info("Creating offer partition %s", name)
+            # DDL can't take parameters but these are dates, not user input
+            bounds = (
+                f"{partition_start:%Y-%m-%d} 00:00:00+00",
+                f"{partition_end:%Y-%m-%d} 00:00:00+00",
+            )
+            statement = f"""
+                CREATE TABLE IF NOT EXISTS {quote_name(name)}
+                PARTITION OF {quote_name(table)}
+                FOR VALUES FROM ('{bounds[0]}') TO ('{bounds[1]}')
+            """
+            with transaction.atomic(using=using), connection.cursor() as cursor:
+                # Table names can't be parameters but they're quoted and not user input
+                cursor.execute(
+                    f"""
+                    SELECT COUNT(*) FROM {quote_name(default_name)}
+                    WHERE "date" >= %s AND "date" < %s
+                    """,  # noqa: S608
+                    bounds,
+                )
+                (default_offers,) = cursor.fetchone()
+                if not default_offers:
+                    cursor.execute(statement)
+                else:
+                    # Postgres won't create a partition while the DEFAULT partition
+                    # has offers for it so they're moved out of it first
+                    log.error(
+                        "Moving %s offers from the default partition to %s",
+                        default_offers,
+                        name,
+                    )
+                    cursor.execute(
+                        f"CREATE TEMPORARY TABLE {quote_name(moved_name)} "
+                        f"(LIKE {quote_name(table)})"
+                    )
+                    cursor.execute(
+                        f"""
+                        WITH moved AS (
+                            DELETE FROM {quote_name(default_name)}
+                            WHERE "date" >= %s AND "date" < %s
+                            RETURNING *
+                        )
+                        INSERT INTO {quote_name(moved_name)} SELECT * FROM moved
+                        """,  # noqa: S608
+                        bounds,
+                    )
+                    cursor.execute(statement)
+                    cursor.execute(
+                        f"INSERT INTO {quote_name(name)} "  # noqa: S608
+                        f"SELECT * FROM {quote_name(moved_name)}"
+                    )
+                    cursor.execute(f"DROP TABLE {quote_name(moved_name)}")
+            created.append(Partition(name, partition_start, partition_end))
+        partition_start = partition_end
+
+    return created
+
+
+def create_default_partition(table=None, using="default"):
+    """Create the DEFAULT partition for offers outside of every other partition."""
+    table = table or _get_offer_table()
+    quote_name = connections[using].ops.quote_name
+
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {quote_name(get_default_partition_name(table))}
+            PARTITION OF {quote_name(table)} DEFAULT
+            """
+        )
+
+
+def count_default_partition_offers(table=None, using="default"):
+    """
+    Count the offers in the DEFAULT partition of the Offer table (or ``table``).
+
+    These offers are outside of every partition (eg. partitions weren't created in time).
+    """
+    table = table or _get_offer_table()
+    quote_name = connections[using].ops.quote_name
+
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            f"SELECT COUNT(*) FROM {quote_name(get_default_partition_name(table))}"  # noqa: S608
+        )
+        return cursor.fetchone()[0]
+
+
+def create_partitioned_table(name, source_table=None, using="default"):
+    """
+    Create an empty partitioned table like the Offer table (or ``source_table``).
+
+    The table has the same columns, a primary key of ``(id, date)``,
+    the Offer table's indexes and foreign keys and a DEFAULT partition.
+    Partitions need to be created for it (``create_partitions``).
+    """
+    source_table = source_table or _get_offer_table()
+    connection = connections[using]
+    quote_name = connection.ops.quote_name
+
+    statements = [
+        f"""
+        CREATE TABLE {quote_name(name)}
+        (LIKE {quote_name(source_table)} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)
+        PARTITION BY RANGE ("date")
+        """,
+        f'ALTER TABLE {quote_name(name)} ADD PRIMARY KEY ("id", "date")',
+    ]
+    for column in INDEXED_COLUMNS:
+        statements.append(
+            f"CREATE INDEX {quote_name(f'{name}_{column}')} "
+            f"ON {quote_name(name)} ({quote_name(column)})"
+        )
+    for column, referenced_table in (
+        ("advertisement_id", "adserver_advertisement"),
+        ("publisher_id", "adserver_publisher"),
+    ):
+        statements.append(
+            f"ALTER TABLE {quote_name(name)} "
+            f"ADD CONSTRAINT {quote_name(f'{name}_{column}_fk')} "
+            f"FOREIGN KEY ({quote_name(column)}) "
+            f'REFERENCES {quote_name(referenced_table)} ("id") '
+            "DEFERRABLE INITIALLY DEFERRED"
+        )
+    statements.append(
+        f"CREATE TABLE {quote_name(get_default_partition_name(name))} "
+        f"PARTITION OF {quote_name(name)} DEFAULT"
+    )
+
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        for statement in statements:
+            cursor.execute(statement)
+
+
+def drop_partition(partition, table=None, using="default"):
+    """
+    Detach and drop a partition of the Offer table (or ``table``).
+
+    This is a quick metadata change rather than deleting the offers
+    but it briefly locks the Offer table. Only drop partitions that have been archived.
+    """
+    table = table or _get_offer_table()
+    connection = connections[using]
+    quote_name = connection.ops.quote_name
+
+    log.info("Dropping offer partition %s", partition.name)
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        cursor.execute(
+            f"ALTER TABLE {quote_name(table)} DETACH PARTITION {quote_name(partition.name)}"
+        )
+        cursor.execute(f"DROP TABLE {quote_name(partition.name)}")
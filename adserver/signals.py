@@ -0,0 +1,124 @@
+"""Django signal receivers for the ad server."""
+
+import logging
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import m2m_changed
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from .decisionengine.inventory import invalidate_no_inventory
+from .decisionengine.publisher import invalidate_publisher_decision_context
+from .decisionengine.snapshot import FlightSnapshot
+from .models import Advertisement
+from .models import Campaign
+from .models import CountryRegion
+from .models import Flight
+from .models import Keyword
+from .models import Publisher
+from .models import PublisherGroup
+from .models import Region
+from .tasks import refresh_flight_snapshot
+
+
+log = logging.getLogger(__name__)  # noqa
+
+
+# The fields that can change which requests have inventory (see ``decisionengine.inventory``)
+# Saves of only other fields (eg. refreshing denormalized totals) don't invalidate it
+INVENTORY_FIELDS = {
+    Flight: frozenset(
+        (
+            "live",
+            "start_date",
+            "end_date",
+            "hard_stop",
+            "campaign",
+            "targeting_parameters",
+            "traffic_cap",
+        )
+    ),
+    Campaign: frozenset(("advertiser", "campaign_type")),
+    Advertisement: frozenset(("live", "flight", "ad_type")),
+}
+
+
+def _changes_inventory(sender, update_fields):
+    if update_fields is None or sender not in INVENTORY_FIELDS:
+        return True
+    return not INVENTORY_FIELDS[sender].isdisjoint(update_fields)
+
+
+def _enqueue_flight_snapshot_refresh():
+    # Many flights are saved at once (eg. refreshing denormalized totals)
+    # so only enqueue a rebuild if one isn't already pending
+    if cache.add(FlightSnapshot.REFRESH_PENDING_CACHE_KEY, True, timeout=60):
+        refresh_flight_snapshot.delay()
+
+
+@receiver(post_save, sender=Flight)
+@receiver(post_save, sender=Campaign)
+@receiver(post_save, sender=Advertisement)
+@receiver(post_save, sender=PublisherGroup)
+@receiver(post_delete, sender=PublisherGroup)
+@receiver(post_save, sender=Region)
+@receiver(post_save, sender=CountryRegion)
+@receiver(post_delete, sender=CountryRegion)
+@receiver(m2m_changed, sender=Campaign.publisher_groups.through)
+@receiver(m2m_changed, sender=Campaign.exclude_publishers.through)
+@receiver(m2m_changed, sender=Advertisement.ad_types.through)
+@receiver(m2m_changed, sender=PublisherGroup.publishers.through)
+@receiver(m2m_changed, sender=Keyword.topics.through)
+def invalidate_flight_snapshot(sender, **kwargs):
+    """Rebuild the decision engine's flight snapshot after targeting data changes."""
+    # Only rebuild after m2m changes are applied
+    action = kwargs.get("action")
+    if action and not action.startswith("post_"):
+        return
+
+    transaction.on_commit(_enqueue_flight_snapshot_refresh)
+
+    # Requests remembered as having no inventory may match now.
+    # Decisions before the commit still see the old data so only invalidate after it
+    if _changes_inventory(sender, kwargs.get("update_fields")):
+        transaction.on_commit(invalidate_no_inventory)
+
+
+def _invalidate_publisher_decision_contexts(publisher_slugs):
+    def invalidate():
+        for slug in publisher_slugs:
+            invalidate_publisher_decision_context(slug)
+
+    # Invalidate again after commit in case a decision cached the old data meanwhile
+    invalidate()
+    transaction.on_commit(invalidate)
+
+
+@receiver(post_save, sender=Publisher)
+def invalidate_publisher_decision_context_on_save(sender, instance, **kwargs):
+    """Invalidate the publisher's cached decision context after it changes."""
+    _invalidate_publisher_decision_contexts([instance.slug])
+
+
+@receiver(m2m_changed, sender=PublisherGroup.publishers.through)
+def invalidate_publisher_decision_context_on_groups(sender, instance, **kwargs):
+    """Invalidate the cached decision context of publishers whose groups changed."""
+    action = kwargs.get("action")
+    if action not in ("post_add", "post_remove", "pre_clear"):
+        return
+
+    if kwargs.get("reverse"):
+        # The publisher's groups were changed (publisher.publisher_groups)
+        slugs = [instance.slug]
+    elif action == "pre_clear":
+        slugs = list(instance.publishers.values_list("slug", flat=True))
+    else:
+        slugs = list(
+            Publisher.objects.filter(pk__in=kwargs.get("pk_set") or ()).values_list(
+                "slug", flat=True
+            )
+        )
+
+    _invalidate_publisher_decision_contexts(slugs)
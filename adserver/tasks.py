@@ -1,6 +1,7 @@
 """Celery tasks for the ad server."""
 
 import datetime
+import itertools
 import logging
 from collections import defaultdict
 
@@ -26,7 +27,12 @@ from .constants import FLIGHT_STATE_CURRENT
 from .constants import FLIGHT_STATE_UPCOMING
 from .constants import PAID_CAMPAIGN
 from .constants import PUBLISHER_HOUSE_CAMPAIGN
+from .decisionengine.embeddings import publish_embedding_index
+from .decisionengine.pacing import publish_pacing_snapshot
+from .decisionengine.snapshot import FlightSnapshot
+from .decisionengine.snapshot import publish_flight_snapshot
 from .importers import psf
+from .impressioncounters import flush_impression_counters
 from .models import AdImpression
 from .models import Advertisement
 from .models import Advertiser
@@ -35,6 +41,7 @@ from .models import DomainImpression
 from .models import Flight
 from .models import GeoImpression
 from .models import KeywordImpression
+from .models import NullOfferImpression
 from .models import Offer
 from .models import PlacementImpression
 from .models import Publisher
@@ -46,6 +53,12 @@ from .models import RegionTopicImpression
 from .models import RotationImpression
 from .models import Topic
 from .models import UpliftImpression
+from .nonces import flush_used_nonces
+from .nulloffers import flush_null_offer_counters
+from .offerbuffer import flush_offer_buffer
+from .partitions import count_default_partition_offers
+from .partitions import create_partitions
+from .partitions import is_partitioned
 from .reports import PublisherReport
 from .utils import calculate_ctr
 from .utils import calculate_percent_diff
@@ -57,6 +70,111 @@ from .utils import offers_dump_exists
 
 log = logging.getLogger(__name__)  # noqa
 
+# Fields of ``NullOfferImpression`` that are "" (rather than None like offers) when missing
+NULL_OFFER_BLANK_FIELDS = ("ad_type_slug", "div_id", "country")
+
+# For region and topic reports, we are excluding ads that were ineligible to be paid
+# from the aggregations unless the publisher isn't approved for paid ads.
+PAID_ELIGIBLE_FILTER = Q(paid_eligible=True) | Q(publisher__allow_paid_campaigns=False)
+
+
+def _get_null_offer_counts(start_date, end_date, fields, condition=None):
+    """
+    Get the null offers that were counted rather than stored as offers.
+
+    See ``ADSERVER_NULL_OFFER_AGGREGATION``.
+
+    Missing values are None like they are on offers so they can be merged with offers.
+
+    :arg fields: the fields to aggregate the null offers by
+    :arg condition: an optional ``Q`` to filter the null offers
+    :returns: an iterator of dictionaries of the fields and ``total_decisions``
+    """
+    # Make sure all the counted null offers are written first
+    flush_null_offer_counters()
+
+    # These were just written so read them from the writable DB
+    queryset = NullOfferImpression.objects.using("default").filter(
+        date__gte=start_date,
+        date__lt=end_date,
+    )
+    if condition is not None:
+        queryset = queryset.filter(condition)
+
+    rows = (
+        queryset.values(*fields)
+        .annotate(total_decisions=Sum("decisions"))
+        .filter(total_decisions__gt=0)
+        .order_by()
+        .iterator()
+    )
+    return (
+        {
+            field: None if field in NULL_OFFER_BLANK_FIELDS and not value else value
+            for field, value in values.items()
+        }
+        for values in rows
+    )
+
+
+def _merge_null_offer_counts(rows, null_offer_counts, fields):
+    """
+    Add counted null offers to the null offers aggregated from stored offers.
+
+    Counted null offers without any matching stored null offers are added as new rows.
+
+    :arg rows: an iterable of aggregated offers with ``advertisement`` and the ``fields``
+    :arg null_offer_counts: the counted null offers aggregated by the same ``fields``
+    """
+    counts = {
+        tuple(values[field] for field in fields): values["total_decisions"]
+        for values in null_offer_counts
+    }
+    for values in rows:
+        if values["advertisement"] is None:
+            key = tuple(values[field] for field in fields)
+            values["total_decisions"] += counts.pop(key, 0)
+        yield values
+
+    for key, total_decisions in counts.items():
+        yield {
+            **dict(zip(fields, key)),
+            "advertisement": None,
+            "total_decisions": total_decisions,
+            "total_offers": 0,
+            "total_views": 0,
+            "total_clicks": 0,
+            "view_time": None,
+        }
+
+
+def _add_null_offer_geos(start_date, end_date, geo=True, region=True):
+    """Add counted null offers to the day's GeoImpressions and RegionImpressions."""
+    for values in _get_null_offer_counts(
+        start_date, end_date, ("publisher", "country"), PAID_ELIGIBLE_FILTER
+    ):
+        if geo:
+            impression, _ = GeoImpression.objects.using("default").get_or_create(
+                publisher_id=values["publisher"],
+                advertisement_id=None,
+                country=values["country"],
+                date=start_date,
+            )
+            GeoImpression.objects.using("default").filter(pk=impression.pk).update(
+                decisions=F("decisions") + values["total_decisions"]
+            )
+
+        if region:
+            impression, _ = RegionImpression.objects.using("default").get_or_create(
+                publisher_id=values["publisher"],
+                advertisement_id=None,
+                region=Region.get_region_from_country_code(values["country"]),
+                date=start_date,
+            )
+            RegionImpression.objects.using("default").filter(pk=impression.pk).update(
+                decisions=F("decisions") + values["total_decisions"]
+            )
+
 
 @app.task()
 def daily_update_geos(day=None, geo=True, region=True):
@@ -71,6 +189,8 @@ def daily_update_geos(day=None, geo=True, region=True):
         log.error("geo or region required, please pass one as True")
         return
 
+    flush_offer_buffer()
+
     log.info(
         "Updating RegionImpressions and/or GeoImpressions for %s-%s",
         start_date,
@@ -101,6 +221,8 @@ def daily_update_geos(day=None, geo=True, region=True):
         if region:
             agg = RegionAggregation(start_date, end_date)
             agg.aggregate()
+
+        _add_null_offer_geos(start_date, end_date, geo=geo, region=region)
         return
 
     topic_mapping = defaultdict(
@@ -115,7 +237,7 @@ def daily_update_geos(day=None, geo=True, region=True):
         # For region and topic reports, we are excluding ads that were ineligible to be paid
         # from the aggregations unless the publisher isn't approved for paid ads.
         # This will give us more accurate KPIs on fill rates for paid publishers.
-        Q(paid_eligible=True) | Q(publisher__allow_paid_campaigns=False),
+        PAID_ELIGIBLE_FILTER,
         date__gte=start_date,
         date__lt=end_date,  # Things at UTC midnight should count towards tomorrow
     )
@@ -183,6 +305,8 @@ def daily_update_geos(day=None, geo=True, region=True):
                 clicks=F("clicks") + value["clicks"],
             )
 
+    _add_null_offer_geos(start_date, end_date, geo=geo, region=region)
+
 
 @app.task()
 def daily_update_placements(day=None):
@@ -193,6 +317,8 @@ def daily_update_placements(day=None):
     """
     start_date, end_date = get_day(day)
 
+    flush_offer_buffer()
+
     log.info("Updating PlacementImpressions for %s-%s", start_date, end_date)
 
     queryset = Offer.objects.using(settings.REPLICA_SLUG).filter(
@@ -200,7 +326,16 @@ def daily_update_placements(day=None):
         date__lt=end_date,  # Things at UTC midnight should count towards tomorrow
     )
 
-    for values in (
+    fields = ("publisher", "div_id", "ad_type_slug")
+    null_offer_counts = _get_null_offer_counts(
+        start_date,
+        end_date,
+        fields,
+        Q(publisher__record_placements=True)
+        & ~Q(div_id__regex=r"(rtd-\w{4}|ad_\w{4}).*"),
+    )
+
+    for values in _merge_null_offer_counts(
         queryset.values("publisher", "advertisement", "div_id", "ad_type_slug")
         .annotate(
             total_decisions=Count("div_id"),
@@ -212,7 +347,9 @@ def daily_update_placements(day=None):
         .filter(publisher__record_placements=True)
         .exclude(div_id__regex=r"(rtd-\w{4}|ad_\w{4}).*")
         .order_by("-total_decisions")
-        .iterator()
+        .iterator(),
+        null_offer_counts,
+        fields,
     ):
         impression, _ = PlacementImpression.objects.using("default").get_or_create(
             publisher_id=values["publisher"],
@@ -240,12 +377,21 @@ def daily_update_impressions(day=None):
 
     log.info("Updating AdImpressions for %s-%s", start_date, end_date)
 
+    # Offers buffered by ``ADSERVER_OFFER_WRITE_BEHIND`` aren't in the database yet
+    flush_offer_buffer()
+
+    # Counted impressions added after this would be counted twice
+    flush_impression_counters()
+
     queryset = Offer.objects.using(settings.REPLICA_SLUG).filter(
         date__gte=start_date,
         date__lt=end_date,  # Things at UTC midnight should count towards tomorrow
     )
 
-    for values in (
+    fields = ("publisher",)
+    null_offer_counts = _get_null_offer_counts(start_date, end_date, fields)
+
+    for values in _merge_null_offer_counts(
         queryset.values("publisher", "advertisement")
         # This needs to be publisher and not advertisement to gets decisions properly
         .annotate(
@@ -257,7 +403,9 @@ def daily_update_impressions(day=None):
         )
         .filter(total_decisions__gt=0)
         .order_by("-total_decisions")
-        .iterator()
+        .iterator(),
+        null_offer_counts,
+        fields,
     ):
         impression, _ = AdImpression.objects.using("default").get_or_create(
             publisher_id=values["publisher"],
@@ -282,6 +430,8 @@ def daily_update_keywords(day=None):
     """
     start_date, end_date = get_day(day)
 
+    flush_offer_buffer()
+
     log.info("Updating KeywordImpression for %s-%s", start_date, end_date)
 
     # Remove all old keyword impressions, because they are cumulative
@@ -394,6 +544,8 @@ def daily_update_regiontopic(day=None):
     """
     start_date, end_date = get_day(day)
 
+    flush_offer_buffer()
+
     log.info("Updating RegionTopic's for %s-%s", start_date, end_date)
 
     # Remove all old impressions, because they are cumulative
@@ -415,11 +567,24 @@ def daily_update_regiontopic(day=None):
         # For region and topic reports, we are excluding ads that were ineligible to be paid
         # from the aggregations unless the publisher isn't approved for paid ads.
         # This will give us more accurate KPIs on fill rates for paid publishers.
-        Q(paid_eligible=True) | Q(publisher__allow_paid_campaigns=False),
+        PAID_ELIGIBLE_FILTER,
         date__gte=start_date,
         date__lt=end_date,  # Things at UTC midnight should count towards tomorrow
     )
-    for values in (
+    # Topics are summed so counted null offers are simply more rows
+    null_offer_counts = (
+        {
+            **values,
+            "advertisement": None,
+            "total_offers": 0,
+            "total_views": 0,
+            "total_clicks": 0,
+        }
+        for values in _get_null_offer_counts(
+            start_date, end_date, ("keywords", "country"), PAID_ELIGIBLE_FILTER
+        )
+    )
+    for values in itertools.chain(
         queryset.values("advertisement", "keywords", "country")
         .annotate(
             total_decisions=Count("country"),
@@ -438,7 +603,8 @@ def daily_update_regiontopic(day=None):
             "total_views",
             "total_clicks",
         )
-        .iterator()
+        .iterator(),
+        null_offer_counts,
     ):
         if not (values["keywords"] and values["country"]):
             continue
@@ -499,6 +665,8 @@ def daily_update_uplift(day=None):
     """
     start_date, end_date = get_day(day)
 
+    flush_offer_buffer()
+
     log.info("Updating uplift for %s-%s", start_date, end_date)
 
     # Delete any previous uplift data for this day
@@ -520,7 +688,10 @@ def daily_update_uplift(day=None):
         date__lt=end_date,  # Things at UTC midnight should count towards tomorrow
     )
 
-    for values in (
+    fields = ("publisher",)
+    null_offer_counts = _get_null_offer_counts(start_date, end_date, fields)
+
+    for values in _merge_null_offer_counts(
         queryset.values("publisher", "advertisement")
         .annotate(
             total_decisions=Count("uplifted"),
@@ -538,7 +709,9 @@ def daily_update_uplift(day=None):
             "total_views",
             "total_clicks",
         )
-        .iterator()
+        .iterator(),
+        null_offer_counts,
+        fields,
     ):
         impression, _ = UpliftImpression.objects.using("default").get_or_create(
             publisher_id=values["publisher"],
@@ -562,6 +735,8 @@ def daily_update_domains(day=None):
     """
     start_date, end_date = get_day(day)
 
+    flush_offer_buffer()
+
     log.info("Updating domains for %s-%s", start_date, end_date)
 
     # Delete any previous domain data for this day
@@ -626,6 +801,8 @@ def daily_update_rotations(day=None):
     """
     start_date, end_date = get_day(day)
 
+    flush_offer_buffer()
+
     log.info("Updating rotation data for %s-%s", start_date, end_date)
 
     # Delete any previous rotations for this day
@@ -817,6 +994,10 @@ def update_previous_day_reports(day=None):
         # do the previous day now that the day is complete
         start_date -= datetime.timedelta(days=1)
 
+    # Offers must be inserted and up to date with their views and clicks first
+    flush_offer_buffer()
+    flush_used_nonces()
+
     # Do all reports
     daily_update_geos(start_date)
     daily_update_placements(start_date)
@@ -853,6 +1034,7 @@ def remove_old_report_data(days=366):
     - keyword data
     - uplift data
     - regiontopic data
+    - counted null offers
     """
     old_cutoff = get_ad_day() - datetime.timedelta(days=days)
 
@@ -862,6 +1044,7 @@ def remove_old_report_data(days=366):
         KeywordImpression,
         UpliftImpression,
         RegionTopicImpression,
+        NullOfferImpression,
     )
 
     for model in models:
@@ -883,6 +1066,25 @@ def remove_old_client_ids(days=90):
             break
 
 
+@app.task()
+def create_offer_partitions():
+    """Create upcoming partitions of the Offer table (when it's partitioned)."""
+    if not is_partitioned():
+        return
+
+    partitions = create_partitions(get_ad_day().date())
+    if partitions:
+        log.info(
+            "Created offer partitions: %s",
+            ", ".join(partition.name for partition in partitions),
+        )
+
+    # Offers are only in the DEFAULT partition if there was no partition for them
+    default_offers = count_default_partition_offers()
+    if default_offers:
+        log.error("Offers outside of every partition. offers=%s", default_offers)
+
+
 @app.task()
 def calculate_publisher_ctrs(days=7):
     """Calculate average CTRs for paid ads on a publisher for the last X days."""
@@ -959,6 +1161,95 @@ def refresh_flight_denormalized_totals():
     )
 
 
+@app.task()
+def reconcile_flight_daily_impressions():
+    """
+    Reset the daily view and click counters of live flights with a daily cap.
+
+    Counters are incremented in the shared cache as views and clicks happen.
+    This corrects any drift from the database (eg. refunded impressions).
+    """
+    flights = Flight.objects.filter(live=True, daily_cap__gt=0)
+    for flight in flights:
+        flight.reconcile_daily_impressions()
+
+    log.debug("Reconciled daily impressions for %d flights", len(flights))
+
+
+@app.task()
+def refresh_flight_snapshot():
+    """
+    Rebuild the decision engine's snapshot of live flights.
+
+    This is triggered when flights, campaigns, ads or publisher groups change
+    and is also run periodically so the snapshot never expires.
+    """
+    cache.delete(FlightSnapshot.REFRESH_PENDING_CACHE_KEY)
+    publish_flight_snapshot()
+
+
+@app.task()
+def refresh_pacing_snapshot():
+    """
+    Compute and publish the pacing of all live flights for the decision engine.
+
+    This runs every ``ADSERVER_PACING_SNAPSHOT_INTERVAL`` seconds.
+    """
+    publish_pacing_snapshot()
+
+
+@app.task()
+def flush_buffered_offers():
+    """
+    Insert offers buffered by ``ADSERVER_OFFER_WRITE_BEHIND`` into the database.
+
+    This runs every few seconds. Offers left in the buffer
+    after write-behind is disabled are still flushed.
+    """
+    flush_offer_buffer()
+
+
+@app.task()
+def flush_nonce_updates():
+    """
+    Write the views, clicks and view times claimed with ``ADSERVER_SIGNED_NONCES`` to offers.
+
+    This runs every few seconds and before the daily reports.
+    """
+    flush_used_nonces()
+
+
+@app.task()
+def flush_buffered_null_offers():
+    """
+    Add the null offers counted by ``ADSERVER_NULL_OFFER_AGGREGATION`` to the database.
+
+    This runs every minute and the report tasks also flush them before they run.
+    """
+    flush_null_offer_counters()
+
+
+@app.task()
+def flush_buffered_impressions():
+    """
+    Add the impressions counted by ``ADSERVER_IMPRESSION_COUNTERS`` to ``AdImpression``.
+
+    This runs every few seconds. Counts left after the counters
+    are disabled are still added.
+    """
+    flush_impression_counters()
+
+
+@app.task()
+def refresh_embedding_index():
+    """
+    Rebuild the decision engine's index of flight and ad embeddings.
+
+    This runs periodically and does nothing without ``ADSERVER_EMBEDDING_INDEX_LOADER``.
+    """
+    publish_embedding_index()
+
+
 @app.task()
 def notify_on_ad_image_change(advertisement_id):
     ad = Advertisement.objects.filter(id=advertisement_id).first()
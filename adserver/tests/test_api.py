@@ -1,3 +1,4 @@
+import asyncio
 import datetime
 import json
 import re
@@ -8,10 +9,13 @@ from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser
 from django.core.cache import cache
+from django.db import connection
 from django.test import Client
 from django.test import TestCase
 from django.test import override_settings
 from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve
 from django.urls import reverse
 from django.utils import timezone
 from django_dynamic_fixture import get
@@ -21,11 +25,17 @@ from .. import utils as adserver_utils
 from ..api.permissions import AdDecisionPermission
 from ..api.permissions import AdvertiserPermission
 from ..api.permissions import PublisherPermission
+from ..api.views import AsyncAdDecisionView
 from ..constants import CLICKS
 from ..constants import COMMUNITY_CAMPAIGN
 from ..constants import HOUSE_CAMPAIGN
 from ..constants import PAID_CAMPAIGN
 from ..constants import VIEWS
+from ..counters import HashCounters
+from ..decisionengine.snapshot import clear_local_flight_snapshot
+from ..decisionengine.snapshot import get_loaded_flight_snapshot
+from ..impressioncounters import flush_impression_counters
+from ..impressioncounters import get_counter_key
 from ..models import AdType
 from ..models import Advertisement
 from ..models import Advertiser
@@ -34,10 +44,16 @@ from ..models import Click
 from ..models import Flight
 from ..models import GeoImpression
 from ..models import Offer
+from ..models import PlacementImpression
 from ..models import Publisher
 from ..models import PublisherGroup
 from ..models import View
+from ..nonces import flush_used_nonces
+from ..nonces import load_nonce
+from ..offerbuffer import flush_offer_buffer
+from ..tasks import daily_update_placements
 from ..utils import GeolocationData
+from ..utils import get_ad_day
 
 
 class ApiPermissionTest(TestCase):
@@ -293,6 +309,155 @@ class AdDecisionApiTests(BaseApiTest):
         resp_json = resp.json()
         self.assertEqual(resp_json["id"], "ad-slug", resp_json)
 
+    def test_decision_trace(self):
+        self.flight.targeting_parameters = {"exclude_countries": ["US"]}
+        self.flight.save()
+        flight2 = get(
+            Flight, live=True, campaign=self.campaign, sold_clicks=1000, cpc=1.0
+        )
+        ad = get(Advertisement, slug="traced-ad", live=True, flight=flight2)
+        ad.ad_types.add(self.ad_type)
+
+        self.data["user_ip"] = "8.8.4.4"
+        with (
+            mock.patch("adserver.api.mixins.get_geolocation") as get_geo,
+            self.assertLogs("adserver.decisionengine.trace", level="INFO") as cm,
+        ):
+            get_geo.return_value = GeolocationData("US")
+            resp = self.staff_client.post(
+                self.url,
+                json.dumps(self.data),
+                content_type="application/json",
+                headers={"x-adserver-trace": "1"},
+            )
+        self.assertEqual(resp.status_code, 200, resp.content)
+        self.assertEqual(resp.json()["id"], "traced-ad")
+
+        trace = json.loads(cm.records[-1].args[0])
+        self.assertEqual(resp["X-Adserver-Trace"], trace["id"])
+        self.assertEqual(trace["publisher"], self.publisher.slug)
+        self.assertEqual(trace["country"], "US")
+        self.assertEqual(trace["candidates"], 2)
+        self.assertEqual(trace["rejections"], {"geo": 1})
+        self.assertEqual(trace["ads"], ["traced-ad"])
+        for stage in ("candidates", "filtering", "offer_ad"):
+            self.assertIn(stage, trace["timings"])
+
+        # Only staff can request a trace
+        with self.assertNoLogs("adserver.decisionengine.trace", level="INFO"):
+            resp = self.client.post(
+                self.url,
+                json.dumps(self.data),
+                content_type="application/json",
+                headers={"x-adserver-trace": "1"},
+            )
+        self.assertNotIn("X-Adserver-Trace", resp)
+
+        # Sampled decisions are traced without the header
+        with (
+            override_settings(ADSERVER_DECISION_TRACE_SAMPLE_RATE=1),
+            self.assertLogs("adserver.decisionengine.trace", level="INFO") as cm,
+        ):
+            resp = self.client.post(
+                self.url, json.dumps(self.data), content_type="application/json"
+            )
+        self.assertNotIn("X-Adserver-Trace", resp)
+        self.assertNotEqual(json.loads(cm.records[-1].args[0])["id"], trace["id"])
+
+    @override_settings(
+        ADSERVER_DECISION_SHADOW_BACKEND="adserver.decisionengine.backends.SnapshotFlightBackend",
+        ADSERVER_DECISION_SHADOW_SAMPLE_RATE=1,
+    )
+    def test_shadow_decision(self):
+        with mock.patch("adserver.decisionengine.shadow.log") as shadow_log:
+            resp = self.client.post(
+                self.url, json.dumps(self.data), content_type="application/json"
+            )
+        self.assertEqual(resp.status_code, 200, resp.content)
+        self.assertEqual(resp.json()["id"], self.ad.slug)
+
+        # The shadow backend made the same decision without recording an offer
+        self.assertEqual(Offer.objects.count(), 1)
+        shadow_log.info.assert_called_once()
+        data = json.loads(shadow_log.info.call_args[0][1])
+        self.assertEqual(data["publisher"], self.publisher.slug)
+        self.assertEqual(
+            data["primary"]["backend"],
+            "adserver.decisionengine.backends.ProbabilisticFlightBackend",
+        )
+        self.assertEqual(
+            data["shadow"]["backend"],
+            "adserver.decisionengine.backends.SnapshotFlightBackend",
+        )
+        self.assertEqual(data["primary"]["ad"], self.ad.slug)
+        self.assertEqual(data["shadow"]["ad"], self.ad.slug)
+        self.assertTrue(data["same_flight"])
+        self.assertTrue(data["same_ad"])
+        self.assertGreater(data["primary"]["queries"], 0)
+        self.assertIsNotNone(data["shadow"]["queries"])
+
+        # Forced decisions aren't compared
+        self.data["force_ad"] = self.ad.slug
+        with mock.patch("adserver.decisionengine.shadow.log") as shadow_log:
+            resp = self.client.post(
+                self.url, json.dumps(self.data), content_type="application/json"
+            )
+        self.assertEqual(resp.status_code, 200, resp.content)
+        shadow_log.info.assert_not_called()
+
+    def test_decision_time_budget(self):
+        house_campaign = get(
+            Campaign,
+            campaign_type=HOUSE_CAMPAIGN,
+            publisher_groups=[self.publisher_group],
+        )
+        house_flight = get(
+            Flight,
+            live=True,
+            campaign=house_campaign,
+            start_date=get_ad_day().date(),
+        )
+        house_ad = get(
+            Advertisement, slug="house-ad", image=None, live=True, flight=house_flight
+        )
+        house_ad.ad_types.add(self.ad_type)
+
+        # A generous budget doesn't change the decision
+        with override_settings(ADSERVER_DECISION_TIME_BUDGET=60):
+            resp = self.client.post(
+                self.url, json.dumps(self.data), content_type="application/json"
+            )
+        self.assertEqual(resp.status_code, 200, resp.content)
+        self.assertEqual(resp.json()["id"], self.ad.slug)
+
+        # The probabilistic backend doesn't load the flight snapshot
+        # but the snapshot is loaded for fallback ads before the budget starts
+        clear_local_flight_snapshot()
+        with override_settings(
+            ADSERVER_DECISION_TIME_BUDGET=1e-9,
+            ADSERVER_DECISION_BACKEND="adserver.decisionengine.backends.ProbabilisticFlightBackend",
+        ):
+            resp = self.client.post(
+                self.url, json.dumps(self.data), content_type="application/json"
+            )
+        self.assertEqual(resp.status_code, 200, resp.content)
+        self.assertEqual(resp.json()["id"], house_ad.slug)
+        self.assertIsNotNone(get_loaded_flight_snapshot())
+
+        # Fallback ads are chosen from the snapshot already loaded
+        with (
+            override_settings(ADSERVER_DECISION_TIME_BUDGET=1e-9),
+            self.assertLogs("adserver.decisionengine.deadline", level="INFO") as cm,
+        ):
+            resp = self.client.post(
+                self.url, json.dumps(self.data), content_type="application/json"
+            )
+        self.assertEqual(resp.status_code, 200, resp.content)
+        self.assertEqual(resp.json()["id"], house_ad.slug)
+        degraded = [record.args[0] for record in cm.records]
+        self.assertIn("candidates", degraded)
+        self.assertIn("fallback", degraded)
+
     def test_invalid_auth(self):
         client = Client()
         resp = client.post(
@@ -877,6 +1042,162 @@ class AdDecisionApiTests(BaseApiTest):
             self.assertDictEqual(resp.json(), {})
 
 
+class AdBatchDecisionApiTests(BaseApiTest):
+    def setUp(self):
+        super().setUp()
+
+        self.url = reverse("api:decision-batch")
+
+        self.publisher.allow_multiple_placements = True
+        self.publisher.save()
+
+        # A second advertiser
+        self.advertiser2 = get(Advertiser, slug="another-advertiser")
+        self.campaign2 = get(
+            Campaign,
+            advertiser=self.advertiser2,
+            publisher_groups=[self.publisher_group],
+        )
+        self.flight2 = get(
+            Flight, live=True, campaign=self.campaign2, sold_clicks=1000, cpc=1.0
+        )
+        self.ad2 = get(
+            Advertisement,
+            slug="ad2-slug",
+            link="http://example.com",
+            image=None,
+            live=True,
+            flight=self.flight2,
+        )
+        self.ad2.ad_types.add(self.ad_type)
+
+        self.data["placements"] = [
+            {"div_id": "a", "ad_type": self.ad_type.slug},
+            {"div_id": "b", "ad_type": self.ad_type.slug},
+            {"div_id": "c", "ad_type": self.ad_type.slug},
+        ]
+
+    def post(self, data):
+        return self.client.post(
+            self.url, json.dumps(data), content_type="application/json"
+        )
+
+    def test_batch_decision(self):
+        resp = self.post(self.data)
+        self.assertEqual(resp.status_code, 200, resp.content)
+
+        # Only 2 advertisers so only 2 of the placements are filled
+        decisions = resp.json()["decisions"]
+        self.assertEqual(len(decisions), 2)
+        self.assertEqual({d["id"] for d in decisions}, {self.ad.slug, self.ad2.slug})
+        self.assertEqual([d["div_id"] for d in decisions], ["a", "b"])
+        self.assertEqual(len({d["nonce"] for d in decisions}), 2)
+
+        # An offer for each ad and a null offer for the unfilled placement
+        self.assertEqual(Offer.objects.filter(advertisement__isnull=False).count(), 2)
+        self.assertEqual(Offer.objects.filter(advertisement__isnull=True).count(), 1)
+
+    def test_get_request(self):
+        self.query_params["div_ids"] = "a|b"
+        self.query_params["ad_types"] = f"{self.ad_type.slug}|{self.ad_type.slug}"
+        resp = self.client.get(self.url, self.query_params)
+        self.assertEqual(resp.status_code, 200, resp.content)
+        self.assertEqual(len(resp.json()["decisions"]), 2)
+
+    def test_deduplicate(self):
+        # Move the second flight to the first advertiser
+        self.flight2.campaign = self.campaign
+        self.flight2.save()
+
+        resp = self.post(self.data)
+        self.assertEqual(resp.status_code, 200, resp.content)
+        self.assertEqual(len(resp.json()["decisions"]), 1)
+
+        # Ads only have to be from different flights
+        self.data["deduplicate"] = "flight"
+        resp = self.post(self.data)
+        self.assertEqual(resp.status_code, 200, resp.content)
+        self.assertEqual(len(resp.json()["decisions"]), 2)
+
+        self.data["deduplicate"] = "invalid"
+        resp = self.post(self.data)
+        self.assertEqual(resp.status_code, 400, resp.content)
+
+    def test_multiple_placements_disallowed(self):
+        self.publisher.allow_multiple_placements = False
+        self.publisher.save()
+
+        resp = self.post(self.data)
+        self.assertEqual(resp.status_code, 200, resp.content)
+        decisions = resp.json()["decisions"]
+        self.assertEqual(len(decisions), 1)
+        self.assertEqual(decisions[0]["div_id"], "a")
+
+    def test_too_many_placements(self):
+        self.data["placements"] = [
+            {"div_id": f"div-{i}", "ad_type": self.ad_type.slug} for i in range(11)
+        ]
+        resp = self.post(self.data)
+        self.assertEqual(resp.status_code, 400, resp.content)
+        self.assertIn("placements", resp.json())
+
+    def test_no_ads(self):
+        self.ad.live = False
+        self.ad.save()
+        self.ad2.live = False
+        self.ad2.save()
+
+        resp = self.post(self.data)
+        self.assertEqual(resp.status_code, 200, resp.content)
+        self.assertEqual(resp.json(), {"decisions": []})
+
+    def test_sticky_decisions_ignored(self):
+        self.publisher.cache_ads = True
+        self.publisher.save()
+
+        with override_settings(ADSERVER_STICKY_DECISION_DURATION=5):
+            resp = self.post(self.data)
+            self.assertEqual(resp.status_code, 200, resp.content)
+            self.assertEqual(len(resp.json()["decisions"]), 2)
+
+        cache.clear()
+
+
+# The test database transaction is only visible in the test's thread
+@mock.patch("adserver.api.views.AsyncAdDecisionView.thread_sensitive", True)
+class AsyncAdDecisionApiTests(BaseApiTest):
+    def setUp(self):
+        super().setUp()
+
+        self.url = reverse("api:decision-async")
+
+    def test_async_view(self):
+        match = resolve(self.url)
+        self.assertTrue(asyncio.iscoroutinefunction(match.func))
+        self.assertIs(match.func.cls, AsyncAdDecisionView)
+
+    def test_get_request(self):
+        resp = self.client.get(self.url, self.query_params)
+        self.assertEqual(resp.status_code, 200, resp.content)
+        self.assertEqual(resp.json()["id"], self.ad.slug)
+        self.assertEqual(Offer.objects.filter(advertisement=self.ad).count(), 1)
+
+    def test_post_request(self):
+        resp = self.client.post(
+            self.url, json.dumps(self.data), content_type="application/json"
+        )
+        self.assertEqual(resp.status_code, 200, resp.content)
+        self.assertEqual(resp.json()["id"], self.ad.slug)
+
+    def test_invalid_request(self):
+        # No data passed
+        resp = self.client.get(self.url)
+        self.assertEqual(resp.status_code, 400)
+
+        resp = self.unauth_client.get(self.url, self.query_params)
+        self.assertEqual(resp.status_code, 401)
+
+
 class AdvertiserApiTests(BaseApiTest):
     def setUp(self):
         super().setUp()
@@ -1294,6 +1615,205 @@ class AdvertisingIntegrationTests(BaseApiTest):
         self.assertEqual(impression.offers, 1)
         self.assertEqual(impression.views, 0)
 
+    @override_settings(ADSERVER_OFFER_WRITE_BEHIND=True)
+    def test_offer_write_behind(self):
+        data = {
+            "placements": self.placements,
+            "publisher": self.publisher1.slug,
+            "user_ip": self.ip_address,
+            "user_ua": self.user_agent,
+        }
+        resp = self.client.post(
+            self.url, json.dumps(data), content_type="application/json"
+        )
+        self.assertEqual(resp.status_code, 200, resp.content)
+        nonce = resp.json()["nonce"]
+
+        # The offer isn't written during the decision
+        self.assertFalse(Offer.objects.filter(pk=nonce).exists())
+        impression = self.ad.impressions.filter(publisher=self.publisher1).first()
+        self.assertEqual(impression.offers, 1)
+
+        # Views are tracked against the pending offer
+        view_url = reverse(
+            "view-proxy", kwargs={"advertisement_id": self.ad.pk, "nonce": nonce}
+        )
+        resp = self.proxy_client.get(view_url)
+        self.assertEqual(resp["X-Adserver-Reason"], "Billed view")
+        resp = self.proxy_client.get(view_url)
+        self.assertEqual(resp["X-Adserver-Reason"], "Old/Invalid nonce")
+
+        # Buffered offers are written with their latest state
+        self.assertEqual(flush_offer_buffer(), 1)
+        self.assertEqual(flush_offer_buffer(), 0)
+        offer = Offer.objects.get(pk=nonce)
+        self.assertEqual(offer.publisher, self.publisher1)
+        self.assertEqual(offer.advertisement, self.ad)
+        self.assertTrue(offer.viewed)
+        self.assertFalse(offer.clicked)
+
+        # Once written, clicks update the offer in the database
+        click_url = reverse(
+            "click-proxy", kwargs={"advertisement_id": self.ad.pk, "nonce": nonce}
+        )
+        resp = self.proxy_client.get(click_url)
+        self.assertEqual(resp["X-Adserver-Reason"], "Billed click")
+        offer.refresh_from_db()
+        self.assertTrue(offer.clicked)
+
+    @override_settings(ADSERVER_OFFER_WRITE_BEHIND=True)
+    def test_offer_write_behind_reports(self):
+        self.publisher1.record_placements = True
+        self.publisher1.save()
+        data = {
+            "placements": self.placements,
+            "publisher": self.publisher1.slug,
+            "user_ip": self.ip_address,
+            "user_ua": self.user_agent,
+        }
+        resp = self.client.post(
+            self.url, json.dumps(data), content_type="application/json"
+        )
+        self.assertEqual(resp.status_code, 200, resp.content)
+        self.assertFalse(Offer.objects.filter(pk=resp.json()["nonce"]).exists())
+
+        # The report tasks write the buffered offers before aggregating them
+        daily_update_placements()
+        self.assertTrue(Offer.objects.filter(pk=resp.json()["nonce"]).exists())
+        impression = PlacementImpression.objects.get(
+            publisher=self.publisher1, advertisement=self.ad
+        )
+        self.assertEqual(impression.decisions, 1)
+        self.assertEqual(impression.offers, 1)
+
+    @override_settings(ADSERVER_IMPRESSION_COUNTERS=True)
+    def test_impression_counters(self):
+        cache.clear()
+        data = {
+            "placements": self.placements,
+            "publisher": self.publisher1.slug,
+            "user_ip": self.ip_address,
+            "user_ua": self.user_agent,
+        }
+        resp = self.client.post(
+            self.url, json.dumps(data), content_type="application/json"
+        )
+        self.assertEqual(resp.status_code, 200, resp.content)
+        nonce = resp.json()["nonce"]
+
+        view_url = reverse(
+            "view-proxy", kwargs={"advertisement_id": self.ad.pk, "nonce": nonce}
+        )
+        resp = self.proxy_client.get(view_url)
+        self.assertEqual(resp["X-Adserver-Reason"], "Billed view")
+
+        # Impressions are counted but not written yet
+        self.assertFalse(self.ad.impressions.filter(publisher=self.publisher1).exists())
+        self.assertEqual(self.ad.flight.views_today(), 1)
+
+        self.assertEqual(flush_impression_counters(), 1)
+        self.assertEqual(flush_impression_counters(), 0)
+        impression = self.ad.impressions.get(publisher=self.publisher1)
+        self.assertEqual(impression.decisions, 1)
+        self.assertEqual(impression.offers, 1)
+        self.assertEqual(impression.views, 1)
+        self.assertEqual(impression.clicks, 0)
+
+        # Refunds are counted too
+        self.assertTrue(Offer.objects.get(pk=nonce).refund())
+        flush_impression_counters()
+        impression.refresh_from_db()
+        self.assertEqual(impression.offers, 0)
+        self.assertEqual(impression.views, 0)
+
+        # Flushing continues after a full batch that a concurrent flush emptied
+        key = get_counter_key(self.ad.pk, impression.date)
+        field = f"{self.publisher1.pk}:clicks"
+        with mock.patch.object(
+            HashCounters, "take", side_effect=[({}, 2), ({(key, field): 1}, 1)]
+        ):
+            self.assertEqual(flush_impression_counters(batch_size=2), 1)
+        impression.refresh_from_db()
+        self.assertEqual(impression.clicks, 1)
+
+    @override_settings(ADSERVER_SIGNED_NONCES=True, ADSERVER_RECORD_VIEWS=False)
+    def test_signed_nonces(self):
+        cache.clear()
+        self.publisher1.record_views = False
+        self.publisher1.save()
+        data = {
+            "placements": self.placements,
+            "publisher": self.publisher1.slug,
+            "user_ip": self.ip_address,
+            "user_ua": self.user_agent,
+        }
+        resp = self.client.post(
+            self.url, json.dumps(data), content_type="application/json"
+        )
+        self.assertEqual(resp.status_code, 200, resp.content)
+        nonce = resp.json()["nonce"]
+
+        payload = load_nonce(nonce)
+        self.assertIsNotNone(payload)
+        self.assertEqual(payload.advertisement_id, self.ad.pk)
+        self.assertEqual(payload.publisher_id, self.publisher1.pk)
+        offer = Offer.objects.get(pk=payload.offer_id)
+
+        # A tampered nonce is never valid
+        self.assertIsNone(load_nonce(nonce[:-1] + ("a" if nonce[-1] != "a" else "b")))
+
+        # Views are checked without reading the offer
+        view_url = reverse(
+            "view-proxy", kwargs={"advertisement_id": self.ad.pk, "nonce": nonce}
+        )
+        with CaptureQueriesContext(connection) as context:
+            resp = self.proxy_client.get(view_url)
+        self.assertEqual(resp["X-Adserver-Reason"], "Billed view")
+        self.assertFalse(
+            [
+                query
+                for query in context.captured_queries
+                if '"adserver_offer"' in query["sql"]
+            ]
+        )
+        resp = self.proxy_client.get(view_url)
+        self.assertEqual(resp["X-Adserver-Reason"], "Old/Invalid nonce")
+
+        # The nonce can only be used for its ad
+        other_ad = get(
+            Advertisement,
+            slug="other-ad-slug",
+            link="http://example.com",
+            image=None,
+            live=True,
+            flight=self.flight,
+        )
+        other_url = reverse(
+            "view-proxy", kwargs={"advertisement_id": other_ad.pk, "nonce": nonce}
+        )
+        resp = self.proxy_client.get(other_url)
+        self.assertEqual(resp["X-Adserver-Reason"], "Unknown offer")
+
+        # Clicks count before the view is written to the offer
+        offer.refresh_from_db()
+        self.assertFalse(offer.viewed)
+        click_url = reverse(
+            "click-proxy", kwargs={"advertisement_id": self.ad.pk, "nonce": nonce}
+        )
+        resp = self.proxy_client.get(click_url)
+        self.assertEqual(resp["X-Adserver-Reason"], "Billed click")
+        resp = self.proxy_client.get(click_url)
+        self.assertEqual(resp["X-Adserver-Reason"], "Old/Invalid nonce")
+
+        self.assertEqual(flush_used_nonces(), 2)
+        offer.refresh_from_db()
+        self.assertTrue(offer.viewed)
+        self.assertTrue(offer.clicked)
+
+        impression = self.ad.impressions.get(publisher=self.publisher1)
+        self.assertEqual(impression.views, 1)
+        self.assertEqual(impression.clicks, 1)
+
     def test_multiple_ad_offers_views(self):
         data = {
             "placements": self.placements,
@@ -2,12 +2,16 @@ import datetime
 import unittest
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.cache import caches
+from django.db import connection
+from django.test import SimpleTestCase
 from django.test import TestCase
 from django.test import override_settings
 from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from django_dynamic_fixture import get
-from user_agents import parse
 
 from ..constants import AFFILIATE_CAMPAIGN
 from ..constants import CLICKS
@@ -19,14 +23,45 @@ from ..decisionengine import get_ad_decision_backend
 from ..decisionengine.backends import AdvertisingDisabledBackend
 from ..decisionengine.backends import AdvertisingEnabledBackend
 from ..decisionengine.backends import ProbabilisticFlightBackend
+from ..decisionengine.backends import SnapshotFlightBackend
+from ..decisionengine.deadline import DecisionDeadline
+from ..decisionengine.deadline import DecisionDeadlineExceeded
+from ..decisionengine.deadline import NullDecisionDeadline
+from ..decisionengine.embeddings import EmbeddingScores
+from ..decisionengine.embeddings import NumpyEmbeddingIndex
+from ..decisionengine.embeddings import get_embedding_index
+from ..decisionengine.embeddings import np
+from ..decisionengine.embeddings import publish_embedding_index
+from ..decisionengine.frequency import get_frequency_counts
+from ..decisionengine.frequency import record_frequency
+from ..decisionengine.inventory import check_no_inventory
+from ..decisionengine.pacing import PACING_CTR_BUCKETS
+from ..decisionengine.pacing import PacingSnapshot
+from ..decisionengine.pacing import get_ctr_bucket
+from ..decisionengine.pacing import get_pacing_snapshot
+from ..decisionengine.pacing import publish_pacing_snapshot
+from ..decisionengine.publisher import get_publisher_decision_context
+from ..decisionengine.sampling import WeightedSampler
+from ..decisionengine.snapshot import FlightSnapshot
+from ..decisionengine.snapshot import clear_local_flight_snapshot
+from ..decisionengine.snapshot import get_flight_snapshot
+from ..decisionengine.snapshot import publish_flight_snapshot
+from ..decisionengine.trace import DecisionTrace
 from ..models import AdType
 from ..models import Advertisement
+from ..models import Advertiser
 from ..models import Campaign
 from ..models import Flight
+from ..models import Keyword
 from ..models import Publisher
 from ..models import PublisherGroup
+from ..models import Region
+from ..models import Topic
+from ..tasks import reconcile_flight_daily_impressions
 from ..utils import GeolocationData
 from ..utils import get_ad_day
+from ..utils import get_client_id
+from ..utils import parse_user_agent
 
 
 if "adserver.analyzer" in settings.INSTALLED_APPS:
@@ -203,6 +238,8 @@ class DecisionEngineTests(TestCase):
         self.assertFalse(self.backend.filter_flight(self.cpm_flight))
 
     def test_flight_daily_cap(self):
+        # Clear the daily view and click counters
+        cache.clear()
         self.assertTrue(self.backend.filter_flight(self.include_flight))
 
         # Set a daily cap of $2.50 while each click is $2.00
@@ -247,6 +284,82 @@ class DecisionEngineTests(TestCase):
         caches[settings.CACHE_LOCAL_ALIAS].clear()
         self.assertFalse(self.backend.filter_flight(self.cpm_flight))
 
+    def test_flight_frequency_cap(self):
+        cache.clear()
+        client_id = get_client_id(self.request)
+        self.include_flight.frequency_cap = 2
+        self.include_flight.save()
+
+        # Another user's views don't count toward this user's cap
+        record_frequency("another-user", self.include_flight)
+        record_frequency(client_id, self.include_flight)
+        self.assertTrue(self.backend.filter_flight(self.include_flight))
+
+        # The counts of all the candidates are read at once
+        record_frequency(client_id, self.include_flight)
+        self.assertEqual(
+            get_frequency_counts(client_id, [self.include_flight, self.basic_flight]),
+            {self.include_flight.pk: 2, self.basic_flight.pk: 0},
+        )
+
+        backend = AdvertisingEnabledBackend(
+            request=self.request, placements=self.placements, publisher=self.publisher
+        )
+        self.assertFalse(backend.filter_flight(self.include_flight))
+
+        # Flights without a frequency cap aren't counted
+        self.assertTrue(backend.filter_flight(self.basic_flight))
+        self.assertNotIn(self.basic_flight.pk, backend.frequency_counts)
+
+    def test_traced_candidates(self):
+        backend = ProbabilisticFlightBackend(
+            request=self.request,
+            placements=self.placements,
+            publisher=self.publisher,
+            trace=DecisionTrace(),
+        )
+
+        with CaptureQueriesContext(connection) as context:
+            backend.select_flight()
+
+        # The timed candidate query is the one used for the decision
+        candidate_queries = [
+            query
+            for query in context.captured_queries
+            if 'FROM "adserver_flight"' in query["sql"]
+        ]
+        self.assertEqual(len(candidate_queries), 1)
+        self.assertIn("max_placement_priority", candidate_queries[0]["sql"])
+        self.assertGreater(backend.trace.candidates, 0)
+
+    def test_flight_daily_impressions(self):
+        cache.clear()
+        self.include_flight.daily_cap = 10
+        self.include_flight.save()
+
+        # No counters yet, they are counted from the database
+        self.advertisement1.incr(CLICKS, self.publisher)
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                self.include_flight.get_daily_impressions(), {VIEWS: 0, CLICKS: 1}
+            )
+
+        # Views and clicks are counted in the cache
+        self.advertisement1.incr(CLICKS, self.publisher)
+        self.advertisement1.incr(VIEWS, self.publisher)
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                self.include_flight.get_daily_impressions(), {VIEWS: 1, CLICKS: 2}
+            )
+            self.assertAlmostEqual(self.include_flight.spend_today(), 4.0)
+
+        # Counters that drifted from the database are reconciled
+        cache.set(self.include_flight.daily_impressions_cache_keys()[CLICKS], 10)
+        reconcile_flight_daily_impressions()
+        self.assertEqual(
+            self.include_flight.get_daily_impressions(), {VIEWS: 1, CLICKS: 2}
+        )
+
     def test_custom_interval(self):
         now = get_ad_day()
 
@@ -380,7 +493,7 @@ class DecisionEngineTests(TestCase):
         self.assertEqual(ad, self.advertisement1)
 
         # Setup a mobile user agent
-        self.backend.user_agent = parse(
+        self.backend.user_agent = parse_user_agent(
             "Mozilla/5.0 (iPhone; CPU iPhone OS 10_3_1 like Mac OS X) "
             "AppleWebKit/603.1.30 (KHTML, like Gecko) Version/10.0 Mobile/14E304 Safari/602.1"
         )
@@ -397,7 +510,7 @@ class DecisionEngineTests(TestCase):
         self.assertEqual(ad, self.advertisement1)
 
         # Set a non-mobile UA
-        self.backend.user_agent = parse(
+        self.backend.user_agent = parse_user_agent(
             "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_5) "
             "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/83.0.4103.116 Safari/537.36"
         )
@@ -411,7 +524,7 @@ class DecisionEngineTests(TestCase):
         self.publisher.save()
 
         # Set a non-mobile UA
-        self.backend.user_agent = parse(
+        self.backend.user_agent = parse_user_agent(
             "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_5) "
             "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/83.0.4103.116 Safari/537.36"
         )
@@ -420,7 +533,7 @@ class DecisionEngineTests(TestCase):
         self.assertIsNotNone(ad)
 
         # Setup a mobile user agent
-        self.backend.user_agent = parse(
+        self.backend.user_agent = parse_user_agent(
             "Mozilla/5.0 (iPhone; CPU iPhone OS 10_3_1 like Mac OS X) "
             "AppleWebKit/603.1.30 (KHTML, like Gecko) Version/10.0 Mobile/14E304 Safari/602.1"
         )
@@ -980,6 +1093,8 @@ class DecisionEngineTests(TestCase):
 
     @unittest.skipIf(AnalyzedUrl is None, "Analyzer not setup")
     def test_analyzer_keywords(self):
+        # Analyzed keywords are cached on this worker
+        self.addCleanup(caches[settings.CACHE_LOCAL_ALIAS].clear)
         url = "http://example.com"
 
         backend = AdvertisingEnabledBackend(
@@ -1251,3 +1366,744 @@ class DecisionEngineTests(TestCase):
         scores = {999: 0.9}
         weight = backend.get_ad_similarity_weight(self.advertisement1, scores)
         self.assertEqual(weight, 0)
+
+    @override_settings(ADSERVER_DECISION_NEGATIVE_CACHE_TIMEOUT=60)
+    def test_no_inventory_cache(self):
+        cache.clear()
+        niche_ad_type = get(AdType, has_image=False, slug="niche")
+        placements = [{"div_id": "a", "ad_type": niche_ad_type.slug}]
+
+        def get_backend(**kwargs):
+            kwargs.setdefault("placements", placements)
+            return ProbabilisticFlightBackend(
+                request=self.request, publisher=self.publisher, **kwargs
+            )
+
+        # Requests that don't display ads have no candidate flights
+        # but other requests for the same ad types may have inventory
+        self.publisher.allow_multiple_placements = False
+        self.publisher.save()
+        backend = get_backend(placements=self.placements, placement_index=1)
+        self.assertIsNone(backend.get_inventory_request())
+        self.assertEqual(backend.get_ad_and_placement(), (None, self.placements[0]))
+        no_inventory, _ = check_no_inventory(
+            **get_backend(placements=self.placements).get_inventory_request()
+        )
+        self.assertFalse(no_inventory)
+
+        # Shadow decisions (see ``shadow``) don't use or remember requests
+        backend = get_backend(shadow=True)
+        self.assertIsNone(backend.get_inventory_request())
+        self.assertEqual(backend.get_ad_and_placement(), (None, placements[0]))
+        no_inventory, _ = check_no_inventory(**get_backend().get_inventory_request())
+        self.assertFalse(no_inventory)
+
+        # No flights have ads of this type
+        backend = get_backend()
+        self.assertEqual(backend.get_ad_and_placement(), (None, placements[0]))
+        self.assertIn(PAID_CAMPAIGN, backend.campaign_types)
+        no_inventory, _ = check_no_inventory(**backend.get_inventory_request())
+        self.assertTrue(no_inventory)
+
+        # Similar requests only look for house ads
+        backend = get_backend()
+        self.assertEqual(backend.get_ad_and_placement(), (None, placements[0]))
+        self.assertNotIn(PAID_CAMPAIGN, backend.campaign_types)
+
+        # Forced decisions aren't affected
+        backend = get_backend(campaign_slug=self.campaign.slug)
+        self.assertIsNone(backend.get_inventory_request())
+
+        # Adding an ad of this type (a flight change) forgets the request
+        with self.captureOnCommitCallbacks(execute=True):
+            self.advertisement3.ad_types.add(niche_ad_type)
+        backend = get_backend()
+        backend.get_ad_and_placement()
+        self.assertIn(PAID_CAMPAIGN, backend.campaign_types)
+        no_inventory, _ = check_no_inventory(**backend.get_inventory_request())
+        self.assertFalse(no_inventory)
+
+        # Flights that only fail targeting for this country are remembered
+        self.basic_flight.targeting_parameters = {"include_countries": ["CA"]}
+        with self.captureOnCommitCallbacks(execute=True):
+            self.basic_flight.save()
+        backend = get_backend()
+        self.assertEqual(backend.get_ad_and_placement(), (None, placements[0]))
+        no_inventory, _ = check_no_inventory(**backend.get_inventory_request())
+        self.assertTrue(no_inventory)
+
+        # Refreshing the denormalized totals doesn't forget the request
+        with self.captureOnCommitCallbacks(execute=True):
+            self.basic_flight.refresh_denormalized_totals()
+        no_inventory, _ = check_no_inventory(**backend.get_inventory_request())
+        self.assertTrue(no_inventory)
+
+        # But not when they fail targeting that depends on more than the country
+        self.basic_flight.targeting_parameters = {"include_keywords": ["python"]}
+        with self.captureOnCommitCallbacks(execute=True):
+            self.basic_flight.save()
+        backend = get_backend()
+        self.assertEqual(backend.get_ad_and_placement(), (None, placements[0]))
+        no_inventory, _ = check_no_inventory(**backend.get_inventory_request())
+        self.assertFalse(no_inventory)
+
+        with override_settings(ADSERVER_DECISION_NEGATIVE_CACHE_TIMEOUT=0):
+            self.assertIsNone(get_backend().get_inventory_request())
+
+    def test_decision_deadline(self):
+        cache.clear()
+
+        deadline = NullDecisionDeadline()
+        self.assertTrue(deadline.allows("analyzer"))
+        deadline.check("candidates")
+
+        deadline = DecisionDeadline(60)
+        self.assertTrue(deadline.allows("analyzer"))
+        self.assertGreater(deadline.remaining(), 0)
+
+        # Optional stages are skipped and the decision is abandoned without time left
+        deadline = DecisionDeadline(0)
+        backend = ProbabilisticFlightBackend(
+            request=self.request,
+            placements=self.placements,
+            publisher=self.publisher,
+            url="https://example.com/page",
+            deadline=deadline,
+        )
+        self.assertEqual(backend.keywords, [])
+        with self.assertRaises(DecisionDeadlineExceeded) as context:
+            backend.get_ad_and_placement()
+        self.assertEqual(context.exception.stage, "candidates")
+
+        with unittest.mock.patch.object(
+            ProbabilisticFlightBackend, "embeddings_enabled", return_value=True
+        ):
+            self.assertEqual(
+                backend.select_ad_for_flight(self.include_flight), self.advertisement1
+            )
+
+        self.assertEqual(
+            deadline.degradations, ["analyzer", "candidates", "similarity"]
+        )
+
+    def test_concurrent_embedding_lookups(self):
+        backend = ProbabilisticFlightBackend(
+            request=self.request,
+            placements=self.placements,
+            publisher=self.publisher,
+            url="https://example.com/page",
+            concurrent_lookups=True,
+        )
+
+        with (
+            unittest.mock.patch.object(
+                ProbabilisticFlightBackend, "embeddings_enabled", return_value=True
+            ),
+            unittest.mock.patch(
+                "adserver.decisionengine.backends._get_publisher_embeddings",
+                return_value=("publisher", "domain"),
+            ) as get_embeddings,
+        ):
+            backend.start_concurrent_lookups()
+            self.assertIsNotNone(backend.embeddings_future)
+            self.assertEqual(
+                backend.get_publisher_embeddings(), ("publisher", "domain")
+            )
+            get_embeddings.assert_called_once_with("https://example.com/page")
+
+            # Without concurrent lookups, the embeddings are looked up when needed
+            backend.concurrent_lookups = False
+            backend.start_concurrent_lookups()
+            self.assertIsNone(backend.embeddings_future)
+            self.assertEqual(
+                backend.get_publisher_embeddings(), ("publisher", "domain")
+            )
+            self.assertEqual(get_embeddings.call_count, 2)
+
+
+class WeightedSamplerTests(SimpleTestCase):
+    def test_find(self):
+        sampler = WeightedSampler([("a", 10), ("b", 0), ("c", 5)])
+        self.assertEqual(len(sampler), 3)
+        self.assertEqual(sampler.total_weight, 15)
+
+        # Ranges are inclusive and the first match wins
+        self.assertIsNone(sampler.find(-1))
+        self.assertEqual(sampler.find(0), "a")
+        self.assertEqual(sampler.find(10), "a")
+        self.assertEqual(sampler.find(11), "c")
+        self.assertEqual(sampler.find(15), "c")
+        self.assertIsNone(sampler.find(16))
+
+        self.assertIsNone(WeightedSampler([]).find(0))
+
+    def test_sample(self):
+        sampler = WeightedSampler([("a", 3), ("b", 0), ("c", 1)])
+        with unittest.mock.patch("random.randrange") as randrange:
+            randrange.return_value = 0
+            self.assertEqual(sampler.sample(), "a")
+            randrange.return_value = 2
+            self.assertEqual(sampler.sample(), "a")
+            randrange.return_value = 3
+            self.assertEqual(sampler.sample(), "c")
+            randrange.assert_called_with(4)
+
+        # Items without weight are never chosen
+        self.assertEqual({sampler.sample() for _ in range(100)}, {"a", "c"})
+        self.assertIsNone(WeightedSampler([("a", 0)]).sample())
+        self.assertIsNone(WeightedSampler([]).sample())
+
+        # Float weights (eg. niche weighting) are supported
+        self.assertIn(WeightedSampler([("a", 0.5), ("b", 1.5)]).sample(), ("a", "b"))
+
+
+def load_test_embeddings():
+    return (
+        [(2, [0.0, 1.0]), (1, [1.0, 0.0]), (2, [1.0, 1.0])],
+        [(10, [1.0, 0.0]), (11, [0.0, 1.0])],
+    )
+
+
+class EmbeddingIndexTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    @unittest.skipIf(np is None, "NumPy is only installed with the analyzer extra")
+    def test_score(self):
+        index = NumpyEmbeddingIndex.build(*load_test_embeddings())
+        self.assertEqual(index.flight_ids.tolist(), [1, 2])
+
+        scores = index.score(([1.0, 0.0], None))
+        self.assertAlmostEqual(scores.flight_distances[1], 0.0, places=5)
+        # Flight 2 is scored by its closest niche URL
+        self.assertAlmostEqual(scores.flight_distances[2], 1 - 0.5**0.5, places=5)
+        self.assertAlmostEqual(scores.ad_similarities[10], 1.0, places=5)
+        self.assertAlmostEqual(scores.ad_similarities[11], 0.0, places=5)
+
+        # Each flight and ad is scored by the closest of the page's embeddings
+        scores = index.score(([1.0, 0.0], [0.0, 2.0]))
+        self.assertAlmostEqual(scores.flight_distances[2], 0.0, places=5)
+        self.assertAlmostEqual(scores.ad_similarities[11], 1.0, places=5)
+
+        # Only the most similar ads are scored
+        with unittest.mock.patch.object(NumpyEmbeddingIndex, "AD_SIMILARITY_TOP_K", 1):
+            scores = index.score(([1.0, 0.0], None))
+            self.assertEqual(list(scores.ad_similarities), [10])
+
+        self.assertEqual(
+            index.score((None, None)),
+            EmbeddingScores(flight_distances={}, ad_similarities={}),
+        )
+        self.assertEqual(
+            NumpyEmbeddingIndex.build([], []).score(([1.0, 0.0],)),
+            EmbeddingScores(flight_distances={}, ad_similarities={}),
+        )
+
+    @unittest.skipIf(np is None, "NumPy is only installed with the analyzer extra")
+    def test_publish(self):
+        # Without a loader, there's no index
+        self.assertIsNone(publish_embedding_index())
+        self.assertIsNone(get_embedding_index())
+
+        with override_settings(
+            ADSERVER_EMBEDDING_INDEX_LOADER="adserver.tests.test_decision_engine.load_test_embeddings"
+        ):
+            self.assertIsNone(get_embedding_index())
+
+            index = publish_embedding_index()
+            self.assertIsNotNone(index)
+            self.assertEqual(get_embedding_index().version, index.version)
+
+            # A new version is picked up
+            new_index = publish_embedding_index()
+            self.assertNotEqual(new_index.version, index.version)
+            self.assertEqual(get_embedding_index().version, new_index.version)
+
+    @override_settings(
+        ADSERVER_EMBEDDING_INDEX_LOADER="adserver.tests.test_decision_engine.load_test_embeddings"
+    )
+    def test_without_numpy(self):
+        # The default index isn't built or used without NumPy
+        with unittest.mock.patch("adserver.decisionengine.embeddings.np", None):
+            self.assertIsNone(publish_embedding_index())
+            self.assertIsNone(get_embedding_index())
+
+    def test_backend_scores(self):
+        publisher = get(Publisher, slug="test-publisher")
+        advertiser = get(Advertiser, slug="test-advertiser")
+        campaign = get(Campaign, advertiser=advertiser)
+        flight1 = get(Flight, campaign=campaign)
+        flight2 = get(Flight, campaign=campaign)
+        ad1 = get(Advertisement, flight=flight1)
+        ad2 = get(Advertisement, flight=flight2)
+
+        request = RequestFactory().get("/")
+        request.geo = GeolocationData("US", "CA", None)
+        backend = ProbabilisticFlightBackend(
+            request=request,
+            placements=[{"div_id": "a", "ad_type": "z"}],
+            publisher=publisher,
+        )
+        backend.embedding_scores = EmbeddingScores(
+            flight_distances={flight1.pk: 0.4, flight2.pk: 0.2},
+            ad_similarities={ad1.pk: 0.9},
+        )
+
+        # The advertiser's closest flight is used
+        self.assertEqual(
+            backend.get_niche_weights([flight1, flight2]), {advertiser: 0.2}
+        )
+        self.assertEqual(backend.get_ad_similarity_scores([ad1, ad2]), {ad1.pk: 0.9})
+
+
+class SnapshotDecisionEngineTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        clear_local_flight_snapshot()
+
+        self.publisher = get(
+            Publisher, slug="test-publisher", allow_paid_campaigns=True
+        )
+        self.publisher_group = get(PublisherGroup)
+        self.publisher_group.publishers.add(self.publisher)
+
+        self.ad_type = get(AdType, has_image=False, slug="z")
+        self.campaign = get(
+            Campaign,
+            campaign_type=PAID_CAMPAIGN,
+            publisher_groups=[self.publisher_group],
+        )
+        self.flight = get(
+            Flight,
+            live=True,
+            campaign=self.campaign,
+            sold_clicks=1_000,
+            cpc=2.0,
+            start_date=get_ad_day().date(),
+            end_date=get_ad_day().date() + datetime.timedelta(days=30),
+            targeting_parameters={"include_countries": ["US", "CA", "MX"]},
+            pacing_interval=24 * 60 * 60,
+        )
+        self.advertisement = get(
+            Advertisement,
+            slug="ad-slug",
+            live=True,
+            image=None,
+            flight=self.flight,
+        )
+        self.advertisement.ad_types.add(self.ad_type)
+
+        self.placements = [{"div_id": "a", "ad_type": "z"}]
+
+        self.factory = RequestFactory()
+        self.request = self.factory.get("/")
+        self.request.geo = GeolocationData("US", "CA", None)
+
+    def get_backend(self, **kwargs):
+        return SnapshotFlightBackend(
+            request=self.request,
+            placements=self.placements,
+            publisher=self.publisher,
+            **kwargs,
+        )
+
+    def test_snapshot_build(self):
+        snapshot = FlightSnapshot.build()
+        self.assertEqual(len(snapshot.flights), 1)
+
+        sflight = snapshot.flights[0]
+        self.assertEqual(sflight.flight, self.flight)
+        self.assertEqual(sflight.campaign_type, PAID_CAMPAIGN)
+        self.assertEqual(sflight.publisher_group_ids, {self.publisher_group.pk})
+        self.assertEqual(sflight.ad_type_slugs, {"z"})
+        self.assertEqual(sflight.targeting.include_countries, {"US", "CA", "MX"})
+
+        with self.assertRaises(AttributeError):
+            sflight.campaign_type = HOUSE_CAMPAIGN
+
+    def test_candidate_flights_match_database(self):
+        # A flight that is not live and one in a future
+        get(Flight, live=False, campaign=self.campaign)
+        future_flight = get(
+            Flight,
+            live=True,
+            campaign=self.campaign,
+            start_date=get_ad_day().date() + datetime.timedelta(days=2),
+        )
+        future_ad = get(Advertisement, live=True, flight=future_flight)
+        future_ad.ad_types.add(self.ad_type)
+
+        publish_flight_snapshot()
+
+        db_backend = ProbabilisticFlightBackend(
+            request=self.request, placements=self.placements, publisher=self.publisher
+        )
+        self.assertEqual(
+            list(db_backend.get_candidate_flights()),
+            self.get_backend().get_candidate_flights(),
+        )
+
+        # Once the snapshot is loaded, no queries are needed for candidates
+        backend = self.get_backend()
+        with self.assertNumQueries(0):
+            self.assertEqual(backend.get_candidate_flights(), [self.flight])
+
+        # Different ad types, campaign types, and publishers
+        self.placements = [{"div_id": "a", "ad_type": "unknown"}]
+        self.assertEqual(self.get_backend().get_candidate_flights(), [])
+        self.placements = [{"div_id": "a", "ad_type": "z"}]
+        self.assertEqual(
+            self.get_backend(campaign_types=[HOUSE_CAMPAIGN]).get_candidate_flights(),
+            [],
+        )
+
+        self.campaign.exclude_publishers.add(self.publisher)
+        publish_flight_snapshot()
+        self.assertEqual(self.get_backend().get_candidate_flights(), [])
+
+    def test_snapshot_reloads_on_version_change(self):
+        snapshot = get_flight_snapshot()
+        self.assertIs(get_flight_snapshot(), snapshot)
+
+        # Publishing a new version causes workers to load it
+        new_snapshot = publish_flight_snapshot()
+        self.assertNotEqual(new_snapshot.version, snapshot.version)
+        self.assertEqual(get_flight_snapshot().version, new_snapshot.version)
+
+    def test_snapshot_invalidated_on_changes(self):
+        version = get_flight_snapshot().version
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.flight.live = False
+            self.flight.save()
+
+        self.assertNotEqual(get_flight_snapshot().version, version)
+        self.assertEqual(self.get_backend().get_candidate_flights(), [])
+
+        version = get_flight_snapshot().version
+        with self.captureOnCommitCallbacks(execute=True):
+            self.flight.live = True
+            self.flight.save()
+        self.assertNotEqual(get_flight_snapshot().version, version)
+
+        # Removing the publisher from the group is applied
+        with self.captureOnCommitCallbacks(execute=True):
+            self.publisher_group.publishers.remove(self.publisher)
+        self.assertEqual(self.get_backend().get_candidate_flights(), [])
+
+    def test_select_flight(self):
+        backend = self.get_backend()
+        self.assertEqual(backend.select_flight(), self.flight)
+
+        ad, placement = backend.get_ad_and_placement()
+        self.assertEqual(ad, self.advertisement)
+        self.assertEqual(placement, self.placements[0])
+
+        # Forcing an ad still works through the database
+        self.flight.live = False
+        self.flight.save()
+        backend = self.get_backend(ad_slug=self.advertisement.slug)
+        ad, _ = backend.get_ad_and_placement()
+        self.assertEqual(ad, self.advertisement)
+
+    def test_snapshot_ads(self):
+        ad_type_y = get(AdType, slug="y")
+        ad_y = get(Advertisement, live=True, flight=self.flight)
+        ad_y.ad_types.add(ad_type_y)
+        not_live_ad = get(Advertisement, live=False, flight=self.flight)
+        not_live_ad.ad_types.add(self.ad_type)
+
+        sflight = FlightSnapshot.build().flights[0]
+        self.assertEqual(sflight.ad_type_slugs, {"y", "z"})
+        self.assertEqual(
+            {sad.advertisement for sad in sflight.ads}, {self.advertisement, ad_y}
+        )
+
+        backend = self.get_backend()
+        backend.get_candidate_flights()
+
+        # Choosing an ad, its placement and rendering it don't hit the database
+        with self.assertNumQueries(0):
+            ad = backend.select_ad_for_flight(self.flight)
+            self.assertEqual(ad, self.advertisement)
+            self.assertEqual(backend.get_placement(ad), self.placements[0])
+            self.assertEqual(ad.flight.campaign.advertiser, self.campaign.advertiser)
+
+        # The ad types come from the snapshot however the ad was loaded
+        ad = Advertisement.objects.get(pk=self.advertisement.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(backend.get_placement(ad), self.placements[0])
+
+        # Ads are in the snapshot for the ad types of the placements
+        self.placements = [{"div_id": "a", "ad_type": "y"}]
+        backend = self.get_backend()
+        backend.get_candidate_flights()
+        self.assertEqual(backend.get_candidate_ads(self.flight, ["y"]), [ad_y])
+        self.assertEqual(backend.get_candidate_ads(self.flight, ["x"]), [])
+
+    def test_placement_priority(self):
+        self.placements = [
+            {"div_id": "a", "ad_type": "y", "priority": 5},
+            {"div_id": "b", "ad_type": "z", "priority": 3},
+        ]
+        backend = self.get_backend()
+        backend.get_candidate_flights()
+        self.assertEqual(backend.get_placement_priority(self.flight), 3)
+
+    def test_pacing_snapshot(self):
+        self.assertIsNone(get_pacing_snapshot())
+
+        pacing = publish_pacing_snapshot()
+        self.assertEqual(get_pacing_snapshot().version, pacing.version)
+        self.assertEqual(
+            pacing.get_weight(self.flight),
+            self.flight.weighted_clicks_needed_this_interval(),
+        )
+
+        # Publisher CTRs are bucketed
+        self.assertEqual(get_ctr_bucket(self.publisher), 0)
+        self.publisher.sampled_ctr = 0.11
+        self.assertEqual(PACING_CTR_BUCKETS[get_ctr_bucket(self.publisher) - 1], 0.1)
+
+        publisher_weight = pacing.get_weight(self.flight, self.publisher)
+        self.publisher.sampled_ctr = 0.1
+        self.assertEqual(
+            publisher_weight,
+            self.flight.weighted_clicks_needed_this_interval(self.publisher),
+        )
+
+        # Unknown flights aren't in the snapshot
+        self.assertIsNone(pacing.get_weight(get(Flight, live=False)))
+
+    def test_backend_uses_pacing_snapshot(self):
+        backend = self.get_backend()
+        self.assertEqual(backend.select_flight(), self.flight)
+        self.assertIsNone(backend.pacing)
+
+        # The flight needs no more impressions according to the pacing snapshot
+        pacing = PacingSnapshot(
+            version="test-version",
+            created=timezone.now(),
+            weights={self.flight.pk: (0,) * (len(PACING_CTR_BUCKETS) + 1)},
+        )
+        cache.set(PacingSnapshot.CACHE_KEY, pacing)
+        cache.set(PacingSnapshot.VERSION_CACHE_KEY, pacing.version)
+
+        backend = self.get_backend()
+        self.assertIsNone(backend.select_flight())
+        self.assertEqual(backend.pacing.version, pacing.version)
+
+        publish_pacing_snapshot()
+        self.assertEqual(self.get_backend().select_flight(), self.flight)
+
+    def test_batch_decision(self):
+        flight2 = get(
+            Flight,
+            live=True,
+            campaign=get(
+                Campaign,
+                campaign_type=PAID_CAMPAIGN,
+                publisher_groups=[self.publisher_group],
+            ),
+            sold_clicks=1_000,
+            cpc=2.0,
+            start_date=get_ad_day().date(),
+            end_date=get_ad_day().date() + datetime.timedelta(days=30),
+        )
+        ad2 = get(Advertisement, live=True, image=None, flight=flight2)
+        ad2.ad_types.add(self.ad_type)
+
+        self.publisher.allow_multiple_placements = True
+        self.placements = [
+            {"div_id": "a", "ad_type": "z"},
+            {"div_id": "b", "ad_type": "z"},
+            {"div_id": "c", "ad_type": "z"},
+        ]
+
+        results = self.get_backend().get_ads_and_placements()
+        self.assertEqual([p for _, p in results], self.placements)
+        self.assertEqual({ad for ad, _ in results}, {self.advertisement, ad2, None})
+        self.assertIsNone(results[2][0])
+
+        # Only the first placement is filled without multiple placements
+        self.publisher.allow_multiple_placements = False
+        results = self.get_backend().get_ads_and_placements()
+        self.assertIsNotNone(results[0][0])
+        self.assertIsNone(results[1][0])
+        self.assertIsNone(results[2][0])
+
+    def test_batch_decision_tiers(self):
+        self.placements = [{"div_id": "a", "ad_type": "z", "priority": 3}]
+        backend = self.get_backend()
+
+        evaluated_tiers = []
+        get_weighted_flight_tiers = backend.get_weighted_flight_tiers
+
+        def get_tiers(flights):
+            for tier in get_weighted_flight_tiers(flights):
+                evaluated_tiers.append(tier)
+                yield tier
+
+        chosen_weights = []
+        choose_flight = backend.choose_flight
+
+        def choose(weighted_flights):
+            chosen_weights.extend(weighted_flights)
+            return choose_flight(weighted_flights)
+
+        backend.get_weighted_flight_tiers = get_tiers
+        backend.choose_flight = choose
+        results = backend.get_ads_and_placements()
+        self.assertEqual(results, [(self.advertisement, self.placements[0])])
+
+        # The paid tier filled the placement so the other tiers weren't evaluated
+        self.assertEqual(len(evaluated_tiers), 1)
+
+        # Flights are weighted by placement priority like single decisions
+        ((flight, weight),) = evaluated_tiers[0]
+        self.assertEqual(chosen_weights, [(flight, weight * 3)])
+
+    def test_keyword_index(self):
+        topic = get(Topic, slug="test-topic")
+        for slug in ("test-pandas", "test-numpy"):
+            get(Keyword, slug=slug).topics.add(topic)
+
+        targeting_options = [
+            {},
+            {"include_keywords": ["python", "django"]},
+            {"exclude_keywords": ["python"]},
+            {"include_topics": ["test-topic"]},
+            {"include_topics": ["unknown-topic"]},
+            {"include_keywords": ["python"], "include_topics": ["test-topic"]},
+            {"include_topics": ["test-topic"], "exclude_keywords": ["test-numpy"]},
+        ]
+        self.flight.targeting_parameters = targeting_options[0]
+        self.flight.save()
+        flights = [self.flight]
+        for targeting in targeting_options[1:]:
+            flights.append(get(Flight, live=True, targeting_parameters=targeting))
+
+        snapshot = FlightSnapshot.build()
+        topics = Topic.load_from_cache()
+        for keywords in (
+            [],
+            ["python"],
+            ["django", "test-pandas"],
+            ["python", "test-pandas"],
+            ["test-numpy", "test-pandas"],
+            ["ruby"],
+        ):
+            match = snapshot.keyword_index.match(keywords)
+            for flight in flights:
+                self.assertEqual(
+                    flight.pk in match,
+                    flight.show_to_keywords(keywords, topics=topics),
+                    f"flight={flight.targeting_parameters}, keywords={keywords}",
+                )
+
+        # The backend uses the index
+        backend = self.get_backend(keywords=["ruby"])
+        self.assertEqual(backend.get_candidate_flights(), [self.flight])
+        self.assertTrue(backend.flight_matches_keywords(self.flight))
+        self.assertFalse(backend.keyword_match.included)
+
+    def test_geo_index(self):
+        targeting_options = [
+            ({}, None, None),
+            ({"include_countries": ["US", "CA"]}, None, None),
+            ({"exclude_countries": ["US"]}, None, None),
+            (
+                {"include_countries": ["US"], "include_state_provinces": ["CA"]},
+                None,
+                None,
+            ),
+            ({"include_countries": ["US"], "include_metro_codes": [807]}, None, None),
+            ({"include_regions": ["us-ca"]}, None, None),
+            ({"include_regions": ["unknown-region"]}, None, None),
+            ({"exclude_regions": ["us-ca"]}, None, None),
+            (
+                {"include_regions": ["us-ca", "eu-aus-nz"]},
+                {"countries": {"US": 10.0}},
+                {"countries": {"US": 15.0, "DE": 5.0}},
+            ),
+            (
+                {},
+                {"regions": {"eu-aus-nz": 20.0}},
+                {"regions": {"eu-aus-nz": 25.0, "us-ca": 50.0}},
+            ),
+        ]
+        flights = []
+        for targeting, traffic_cap, traffic_fill in targeting_options:
+            flights.append(
+                get(
+                    Flight,
+                    live=True,
+                    targeting_parameters=targeting,
+                    traffic_cap=traffic_cap,
+                    traffic_fill=traffic_fill,
+                )
+            )
+
+        snapshot = FlightSnapshot.build()
+        regions = Region.load_from_cache()
+        for geo in (
+            GeolocationData(),
+            GeolocationData("US"),
+            GeolocationData("US", "CA", 807),
+            GeolocationData("US", "NY", 501),
+            GeolocationData("CA"),
+            GeolocationData("DE"),
+            GeolocationData("MX"),
+        ):
+            match = snapshot.geo_index.match(geo)
+            for flight in flights:
+                self.assertEqual(
+                    flight.pk in match,
+                    flight.show_to_geo(geo, regions=regions),
+                    f"flight={flight.targeting_parameters}, geo={geo}",
+                )
+
+        # The backend uses the index
+        backend = self.get_backend()
+        backend.geolocation = GeolocationData("FR")
+        self.assertEqual(backend.get_candidate_flights(), [self.flight])
+        self.assertFalse(backend.flight_matches_geo(self.flight))
+        backend.geolocation = GeolocationData("MX")
+        backend.get_candidate_flights()
+        self.assertTrue(backend.flight_matches_geo(self.flight))
+
+    def test_publisher_decision_context(self):
+        self.publisher.default_keywords = "Machine_Learning, python,,"
+        self.publisher.allowed_domains = "example.com docs.example.com"
+        self.publisher.daily_cap = 10
+        self.publisher.save()
+
+        context = get_publisher_decision_context(self.publisher.slug)
+        self.assertEqual(context.publisher, self.publisher)
+        self.assertEqual(context.publisher_group_ids, {self.publisher_group.pk})
+        self.assertEqual(context.keywords, ("machine-learning", "python"))
+        self.assertEqual(context.allowed_domains, {"example.com", "docs.example.com"})
+        self.assertEqual(context.daily_cap, 10.0)
+        self.assertIsNone(get_publisher_decision_context("invalid-publisher"))
+
+        # Cached contexts don't query the database
+        with self.assertNumQueries(0):
+            context = get_publisher_decision_context(self.publisher.slug)
+            backend = self.get_backend(publisher_context=context)
+        self.assertIn("python", backend.keywords)
+
+        # Saving the publisher invalidates the context
+        self.publisher.default_keywords = "rust"
+        self.publisher.save()
+        context = get_publisher_decision_context(self.publisher.slug)
+        self.assertEqual(context.keywords, ("rust",))
+
+        # As does changing the publisher's groups
+        self.publisher_group.publishers.remove(self.publisher)
+        context = get_publisher_decision_context(self.publisher.slug)
+        self.assertEqual(context.publisher_group_ids, frozenset())
+
+        group = get(PublisherGroup)
+        self.publisher.publisher_groups.add(group)
+        context = get_publisher_decision_context(self.publisher.slug)
+        self.assertEqual(context.publisher_group_ids, {group.pk})
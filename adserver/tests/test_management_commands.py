@@ -1,20 +1,37 @@
+import datetime
 import io
+import json
 import os
+import unittest
 from unittest.mock import patch
 
 from django.contrib.auth import get_user_model
 from django.core import management
+from django.core.cache import cache
+from django.db import connection
 from django.db import models
 from django.test import TestCase
 from django.test import override_settings
+from django_dynamic_fixture import get
 
+from ..decisionengine.snapshot import FlightSnapshot
 from ..models import AdImpression
 from ..models import Advertisement
 from ..models import Advertiser
 from ..models import Campaign
 from ..models import Click
 from ..models import Flight
+from ..models import Offer
 from ..models import Publisher
+from ..partitions import DAY
+from ..partitions import MONTH
+from ..partitions import PARTITION_BOUND_RE
+from ..partitions import count_default_partition_offers
+from ..partitions import create_partitioned_table
+from ..partitions import create_partitions
+from ..partitions import get_next_partition_start
+from ..partitions import get_partition_name
+from ..partitions import get_partition_start
 
 
 User = get_user_model()
@@ -185,3 +202,124 @@ class TestArchiveOffers(TestCase):
 
         output = self.out.getvalue()
         self.assertTrue("already exists in backups" in output)
+
+
+class TestPartitionOffers(TestCase):
+    def test_partition_offers_errors(self):
+        # The tests don't use a partitioned (Postgres) offers table
+        with self.assertRaises(management.CommandError):
+            management.call_command("partition_offers", stdout=io.StringIO())
+
+        with self.assertRaises(management.CommandError):
+            management.call_command(
+                "partition_offers", "-s", "not-valid-date", stdout=io.StringIO()
+            )
+
+    def test_partition_bounds(self):
+        day = datetime.date(2026, 12, 15)
+
+        start = get_partition_start(day, interval=MONTH)
+        self.assertEqual(start, datetime.date(2026, 12, 1))
+        self.assertEqual(
+            get_next_partition_start(start, interval=MONTH), datetime.date(2027, 1, 1)
+        )
+        self.assertEqual(
+            get_partition_name("adserver_offer", start, interval=MONTH),
+            "adserver_offer_p202612",
+        )
+
+        start = get_partition_start(day, interval=DAY)
+        self.assertEqual(start, day)
+        self.assertEqual(
+            get_next_partition_start(start, interval=DAY), datetime.date(2026, 12, 16)
+        )
+        self.assertEqual(
+            get_partition_name("adserver_offer", start, interval=DAY),
+            "adserver_offer_p20261215",
+        )
+
+    @unittest.skipUnless(
+        connection.vendor == "postgresql", "Partitioning requires Postgres"
+    )
+    def test_partition_offers_default_partition(self):
+        table = "adserver_offer_partitioned_test"
+        quote_name = connection.ops.quote_name
+        create_partitioned_table(table)
+        self.assertEqual(count_default_partition_offers(table), 0)
+
+        # Offers without a partition (eg. the task didn't run) are still written
+        offer = get(
+            Offer,
+            publisher=get(Publisher),
+            advertisement=None,
+            date=datetime.datetime(2026, 12, 1, 12, tzinfo=datetime.timezone.utc),
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {quote_name(table)} "
+                f"SELECT * FROM {quote_name(Offer._meta.db_table)} WHERE id = %s",
+                [offer.pk],
+            )
+        self.assertEqual(count_default_partition_offers(table), 1)
+
+        # Creating the partition for them moves them out of the default partition
+        created = create_partitions(
+            datetime.date(2026, 12, 1), count=1, table=table, interval=DAY
+        )
+        self.assertEqual(
+            [partition.name for partition in created],
+            [f"{table}_p20261201"],
+        )
+        self.assertEqual(count_default_partition_offers(table), 0)
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT id FROM {quote_name(f'{table}_p20261201')}")
+            self.assertEqual(cursor.fetchall(), [(offer.pk,)])
+
+    def test_partition_bound_expression(self):
+        match = PARTITION_BOUND_RE.search(
+            "FOR VALUES FROM ('2026-10-01 00:00:00+00') TO ('2026-11-01 00:00:00+00')"
+        )
+        self.assertEqual(match.group("start"), "2026-10-01")
+        self.assertEqual(match.group("end"), "2026-11-01")
+        self.assertIsNone(PARTITION_BOUND_RE.search("DEFAULT"))
+
+
+class TestBenchmarkDecisionsManagementCommand(TestCase):
+    def test_benchmark_decisions(self):
+        flights = Flight.objects.count()
+        cache.set(FlightSnapshot.CACHE_KEY, "live-snapshot")
+        self.addCleanup(cache.delete, FlightSnapshot.CACHE_KEY)
+        out = io.StringIO()
+        management.call_command(
+            "benchmark_decisions",
+            "--flights=5,20",
+            "--decisions=3",
+            "--warmup=1",
+            "--backend=adserver.decisionengine.backends.ProbabilisticFlightBackend",
+            "--backend=adserver.decisionengine.backends.SnapshotFlightBackend",
+            "--output=-",
+            stdout=out,
+        )
+
+        output = out.getvalue()
+        results = json.loads(output[output.index("{") :])["results"]
+        self.assertEqual(
+            [(r["flights"], r["backend"].rsplit(".", 1)[-1]) for r in results],
+            [
+                (5, "ProbabilisticFlightBackend"),
+                (5, "SnapshotFlightBackend"),
+                (20, "ProbabilisticFlightBackend"),
+                (20, "SnapshotFlightBackend"),
+            ],
+        )
+        for result in results:
+            self.assertEqual(result["decisions"], 3)
+            self.assertGreater(result["decisions_per_second"], 0)
+            self.assertGreater(result["queries"]["mean"], 0)
+            self.assertIn("p99", result["latency_ms"])
+
+        # The synthetic data is discarded
+        self.assertEqual(Flight.objects.count(), flights)
+
+        # Snapshots are published to the benchmark's own caches
+        self.assertEqual(cache.get(FlightSnapshot.CACHE_KEY), "live-snapshot")
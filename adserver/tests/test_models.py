@@ -3,6 +3,7 @@ import tempfile
 from unittest import mock
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.cache import caches
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.db import IntegrityError
@@ -436,6 +437,69 @@ class TestAdModels(BaseAdModelsTestCase):
         self.assertIn(view_url, output)
         self.assertIn(click_url, output)
 
+    def test_compiled_ad_type_template(self):
+        ad_type = get(AdType, slug="compiled", template="<p>{{ ad.name }}</p>")
+        self.assertEqual(AdType.load_from_cache("compiled"), ad_type)
+        self.addCleanup(caches[settings.CACHE_LOCAL_ALIAS].clear)
+
+        template, per_offer = AdType.get_compiled_template(ad_type)
+        self.assertFalse(per_offer)
+        self.assertIs(AdType.get_compiled_template(ad_type)[0], template)
+
+        # Changing the ad type recompiles the template and clears the cached ad type
+        ad_type.template = "<p>{{ ad.name }} {{ keywords|join:',' }}</p>"
+        ad_type.save()
+        new_template, per_offer = AdType.get_compiled_template(ad_type)
+        self.assertTrue(per_offer)
+        self.assertIsNot(new_template, template)
+        self.assertEqual(AdType.load_from_cache("compiled").template, ad_type.template)
+
+        # Saving in another process changes the version in the shared cache
+        template_source = ad_type.template
+        AdType.objects.filter(pk=ad_type.pk).update(template="<p>Updated</p>")
+        self.assertEqual(AdType.load_from_cache("compiled").template, template_source)
+        cache.set(AdType.CACHE_VERSION_KEY, "another-process")
+        self.assertEqual(AdType.load_from_cache("compiled").template, "<p>Updated</p>")
+
+    def test_offer_rendering_cache(self):
+        self.ad1.ad_types.add(self.text_ad_type)
+        self.addCleanup(caches[settings.CACHE_LOCAL_ALIAS].clear)
+        request = self.factory.get("/")
+
+        offer_kwargs = {
+            "request": request,
+            "publisher": self.publisher,
+            "ad_type_slug": self.text_ad_type.slug,
+            "div_id": "foo",
+            "keywords": None,
+        }
+        output1 = self.ad1.offer_ad(**offer_kwargs)
+
+        # The second offer uses the pre-rendered ad with its own nonce
+        with mock.patch.object(Advertisement, "_render_template") as render:
+            output2 = self.ad1.offer_ad(**offer_kwargs)
+            render.assert_not_called()
+
+        self.assertNotEqual(output1["nonce"], output2["nonce"])
+        for output in (output1, output2):
+            nonce = str(output["nonce"])
+            self.assertIn(nonce, output["link"])
+            self.assertIn(nonce, output["view_url"])
+            self.assertIn(nonce, output["view_time_url"])
+            self.assertIn(output["link"], output["html"])
+            self.assertNotIn(Advertisement.OFFER_NONCE_PLACEHOLDER, output["html"])
+        self.assertEqual(
+            output2["html"].replace(str(output2["nonce"]), str(output1["nonce"])),
+            output1["html"],
+        )
+
+        # Ad types with templates that use the keywords are rendered for each offer
+        self.text_ad_type.template = "{{ keywords|join:',' }} {{ text_as_html }}"
+        self.text_ad_type.save()
+        output = self.ad1.offer_ad(**{**offer_kwargs, "keywords": ["python"]})
+        self.assertIn("python", output["html"])
+        self.assertIn(output["link"], output["html"])
+
     def test_body_escaping_ad(self):
         self.ad1.text = "<a>Call to Action & such!</a>"
         self.ad1.save()
@@ -930,10 +994,20 @@ class TestAdModels(BaseAdModelsTestCase):
         self.assertAlmostEqual(report.total["clicks"], 3)
         self.assertAlmostEqual(report.total["cost"], 6.0)
 
+        # Count the flight's daily views and clicks in the cache
+        cache.clear()
+        self.assertEqual(
+            self.flight.reconcile_daily_impressions(), {VIEWS: 3, CLICKS: 3}
+        )
+
         # Refund 2 of the 3 offers (including the clicks/views)
         self.assertTrue(offer1.refund())
         self.assertTrue(offer2.refund())
 
+        # Refunds are taken off the daily counters right away
+        with self.assertNumQueries(0):
+            self.assertEqual(self.flight.get_daily_impressions(), {VIEWS: 1, CLICKS: 1})
+
         # Ensure you can't double refund
         self.assertFalse(offer1.refund())
 
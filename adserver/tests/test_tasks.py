@@ -3,17 +3,20 @@ import datetime
 from django.contrib.auth.models import AnonymousUser
 from django.core import mail
 from django.test import override_settings
+from django.test.client import RequestFactory
 from django.utils import timezone
 from django_dynamic_fixture import get
 from django_slack.utils import get_backend
 
 from ..constants import HOUSE_CAMPAIGN
 from ..models import AdImpression
+from ..models import Advertisement
 from ..models import AdvertiserImpression
 from ..models import DomainImpression
 from ..models import Flight
 from ..models import GeoImpression
 from ..models import KeywordImpression
+from ..models import NullOfferImpression
 from ..models import Offer
 from ..models import PlacementImpression
 from ..models import PublisherImpression
@@ -21,6 +24,8 @@ from ..models import PublisherPaidImpression
 from ..models import RegionImpression
 from ..models import RegionTopicImpression
 from ..models import UpliftImpression
+from ..nulloffers import count_null_offer
+from ..nulloffers import flush_null_offer_counters
 from ..tasks import calculate_ad_ctrs
 from ..tasks import calculate_publisher_ctrs
 from ..tasks import daily_update_advertisers
@@ -41,6 +46,7 @@ from ..tasks import notify_of_publisher_changes
 from ..tasks import remove_old_client_ids
 from ..tasks import remove_old_report_data
 from ..tasks import update_previous_day_reports
+from ..utils import GeolocationData
 from ..utils import get_ad_day
 from .common import BaseAdModelsTestCase
 
@@ -903,6 +909,105 @@ class AggregationTaskTests(BaseAdModelsTestCase):
         self.assertEqual(pi2_ad2.views, 2)
         self.assertEqual(pi2_ad2.clicks, 0)
 
+    @override_settings(
+        ADSERVER_NULL_OFFER_AGGREGATION=True, ADSERVER_NULL_OFFER_SAMPLE_RATE=0
+    )
+    def test_null_offer_aggregation(self):
+        # A null offer stored in full (eg. sampled)
+        get(
+            Offer,
+            advertisement=None,
+            publisher=self.publisher,
+            country="CA",
+            paid_eligible=True,
+            keywords=["backend"],
+            div_id="id_1",
+            ad_type_slug=self.text_ad_type.slug,
+        )
+
+        # Null offers counted rather than stored
+        request = RequestFactory().get("/")
+        request.geo = GeolocationData("CA")
+        Advertisement.record_null_offer(
+            request=request,
+            publisher=self.publisher,
+            ad_type_slug=self.text_ad_type.slug,
+            div_id="id_1",
+            keywords=["backend"],
+            url=None,
+            paid_eligible=True,
+        )
+        self.assertEqual(Offer.objects.filter(advertisement=None).count(), 1)
+        for _ in range(2):
+            count_null_offer(
+                publisher=self.publisher,
+                ad_type_slug=self.text_ad_type.slug,
+                div_id="id_1",
+                country="CA",
+                keywords=["backend"],
+                paid_eligible=True,
+            )
+
+        # Reports count every null offer once no matter how many times they run
+        for _ in range(2):
+            update_previous_day_reports(get_ad_day())
+
+            impression = AdImpression.objects.get(
+                publisher=self.publisher, advertisement=None
+            )
+            self.assertEqual(impression.decisions, 4)
+            self.assertEqual(impression.offers, 0)
+
+            placement = PlacementImpression.objects.get(
+                publisher=self.publisher, advertisement=None, div_id="id_1"
+            )
+            self.assertEqual(placement.decisions, 4)
+
+            geo = GeoImpression.objects.get(
+                publisher=self.publisher, advertisement=None, country="CA"
+            )
+            self.assertEqual(geo.decisions, 4)
+
+            uplift = UpliftImpression.objects.get(
+                publisher=self.publisher, advertisement=None
+            )
+            self.assertEqual(uplift.decisions, 4)
+
+        null_offers = NullOfferImpression.objects.get(publisher=self.publisher)
+        self.assertEqual(null_offers.decisions, 3)
+        self.assertEqual(null_offers.keywords, ["backend"])
+
+        # Null offers without a placement, ad type or country are still counted once
+        for _ in range(2):
+            count_null_offer(
+                publisher=self.publisher,
+                ad_type_slug=None,
+                div_id=None,
+                country=None,
+                keywords=None,
+            )
+            flush_null_offer_counters()
+        null_offers = NullOfferImpression.objects.get(
+            publisher=self.publisher, div_id=""
+        )
+        self.assertEqual(null_offers.decisions, 2)
+        self.assertEqual(null_offers.ad_type_slug, "")
+
+        # The uplift index counts them with the stored null offers
+        get(
+            Offer,
+            advertisement=None,
+            publisher=self.publisher,
+            country=None,
+            div_id=None,
+            ad_type_slug=None,
+        )
+        daily_update_uplift(get_ad_day())
+        uplift = UpliftImpression.objects.get(
+            publisher=self.publisher, advertisement=None
+        )
+        self.assertEqual(uplift.decisions, 7)
+
     def test_remove_old_report_data(self):
         # Add a very old offer
         old_date = timezone.now() - datetime.timedelta(days=370)
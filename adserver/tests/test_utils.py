@@ -29,6 +29,7 @@ from ..utils import get_domain_from_url
 from ..utils import get_geoipdb_geolocation
 from ..utils import get_geolocation
 from ..utils import get_ipproxy_db
+from ..utils import get_user_agent_cache_stats
 from ..utils import is_allowed_domain
 from ..utils import is_asn_ratelimited
 from ..utils import is_blocklisted_ip
@@ -39,6 +40,7 @@ from ..utils import is_proxy_ip
 from ..utils import is_view_ratelimited
 from ..utils import offers_dump_exists
 from ..utils import parse_date_string
+from ..utils import parse_user_agent
 
 
 class UtilsTest(TestCase):
@@ -73,6 +75,27 @@ class UtilsTest(TestCase):
             anonymize_user_agent("Some rare user agent"), "Rare user agent"
         )
 
+    def test_parse_user_agent(self):
+        parse_user_agent.cache_clear()
+
+        ua = "Mozilla/5.0 (iPhone; CPU iPhone OS 10_3_1 like Mac OS X) AppleWebKit/603.1.30 (KHTML, like Gecko) Version/10.0 Mobile/14E304 Safari/602.1"
+        parsed_ua = parse_user_agent(ua)
+        self.assertEqual(parsed_ua.browser_family, "Mobile Safari")
+        self.assertEqual(parsed_ua.os_family, "iOS")
+        self.assertFalse(parsed_ua.is_bot)
+        self.assertTrue(parsed_ua.is_mobile)
+
+        # The second parse is cached
+        self.assertIs(parse_user_agent(ua), parsed_ua)
+        stats = get_user_agent_cache_stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["size"], 1)
+
+        parsed_ua = parse_user_agent("Googlebot/2.1 (+http://www.google.com/bot.html)")
+        self.assertTrue(parsed_ua.is_bot)
+        self.assertEqual(parse_user_agent(None).browser_family, "Other")
+
     def test_calculate_ecpm(self):
         self.assertAlmostEqual(calculate_ecpm(100, 0), 0)
         self.assertAlmostEqual(calculate_ecpm(100, 1), 100_000)
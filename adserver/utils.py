@@ -238,11 +238,51 @@ def anonymize_ip_address(ip_address):
     return anonymized_ip.compressed
 
 
+@dataclass(frozen=True, slots=True)
+class ParsedUserAgent:
+    """The parts of a parsed user agent used by the ad server."""
+
+    browser_family: str
+    os_family: str
+    is_bot: bool
+    is_mobile: bool
+
+
+@functools.lru_cache(maxsize=10_000)
+def parse_user_agent(user_agent):
+    """
+    Parse a user agent string into a ``ParsedUserAgent``.
+
+    Parsing a user agent runs many regular expressions
+    but the same user agents are seen over and over
+    so parsed user agents are kept in a bounded, per-process LRU cache
+    shared by ad decisions, views and clicks.
+    """
+    parsed_ua = parse(user_agent or "")
+    return ParsedUserAgent(
+        browser_family=parsed_ua.browser.family,
+        os_family=parsed_ua.os.family,
+        is_bot=parsed_ua.is_bot,
+        is_mobile=parsed_ua.is_mobile,
+    )
+
+
+def get_user_agent_cache_stats():
+    """Get the hits, misses and size of this process' parsed user agent cache."""
+    info = parse_user_agent.cache_info()
+    return {
+        "hits": info.hits,
+        "misses": info.misses,
+        "size": info.currsize,
+        "maxsize": info.maxsize,
+    }
+
+
 def anonymize_user_agent(user_agent):
     """Anonymizes rare user agents."""
     # If the browser family is not recognized, this is a rare user agent
-    parsed_ua = parse(user_agent)
-    if parsed_ua.browser.family == "Other" or parsed_ua.os.family == "Other":
+    parsed_ua = parse_user_agent(user_agent)
+    if parsed_ua.browser_family == "Other" or parsed_ua.os_family == "Other":
         return "Rare user agent"
 
     return user_agent
@@ -52,7 +52,6 @@ from djstripe.enums import InvoiceStatus
 from djstripe.models import Account
 from djstripe.models import Invoice
 from rest_framework.authtoken.models import Token
-from user_agents import parse as parse_user_agent
 
 from .auth.models import UserAdvertiserMember
 from .auth.models import UserPublisherMember
@@ -65,6 +64,7 @@ from .constants import PAID
 from .constants import PAYOUT_STRIPE
 from .constants import PUBLISHER_HOUSE_CAMPAIGN
 from .constants import VIEWS
+from .decisionengine.frequency import record_frequency
 from .forms import AccountForm
 from .forms import AdvertisementCopyForm
 from .forms import AdvertisementForm
@@ -108,6 +108,11 @@ from .models import RegionImpression
 from .models import RegionTopicImpression
 from .models import Topic
 from .models import UpliftImpression
+from .nonces import apply_claims
+from .nonces import get_nonce_offer
+from .nonces import is_signed_nonces_enabled
+from .nonces import load_nonce
+from .offerbuffer import get_pending_offer
 from .reports import AdvertiserPublisherReport
 from .reports import AdvertiserReport
 from .reports import OptimizedAdvertiserReport
@@ -126,6 +131,7 @@ from .utils import calculate_ecpm
 from .utils import generate_absolute_url
 from .utils import generate_publisher_payout_data
 from .utils import get_ad_day
+from .utils import get_client_id
 from .utils import get_client_ip
 from .utils import get_client_user_agent
 from .utils import get_geolocation
@@ -136,6 +142,7 @@ from .utils import is_blocklisted_referrer
 from .utils import is_blocklisted_user_agent
 from .utils import is_click_ratelimited
 from .utils import is_view_ratelimited
+from .utils import parse_user_agent
 
 
 log = logging.getLogger(__name__)  # noqa
@@ -1221,7 +1228,7 @@ class BaseProxyView(View):
         elif (
             parsed_ua.is_bot
             or "bot" in user_agent.lower()
-            or "bot" in parsed_ua.browser.family.lower()
+            or "bot" in parsed_ua.browser_family.lower()
         ):
             log.log(self.log_level, "Bot impression. User Agent: [%s]", user_agent)
             reason = "Bot impression"
@@ -1231,7 +1238,7 @@ class BaseProxyView(View):
                 self.log_level, "Internal IP impression. User Agent: [%s]", user_agent
             )
             reason = "Internal IP"
-        elif parsed_ua.os.family == "Other" or parsed_ua.browser.family == "Other":
+        elif parsed_ua.os_family == "Other" or parsed_ua.browser_family == "Other":
             # This is probably a bot/proxy server/prefetcher/etc.
             log.log(self.log_level, "Unknown user agent impression [%s]", user_agent)
             reason = "Unrecognized user agent"
@@ -1298,7 +1305,7 @@ class BaseProxyView(View):
                 user_agent,
             )
             reason = "Ratelimited view impression"
-        elif offer and offer.os_family != parsed_ua.os.family:
+        elif offer and offer.os_family != parsed_ua.os_family:
             log.log(
                 self.log_level,
                 "Mismatched OS between offer and impression. Publisher: [%s], Offer OS: [%s], User agent: [%s]",
@@ -1307,7 +1314,7 @@ class BaseProxyView(View):
                 user_agent,
             )
             reason = "Mismatched OS"
-        elif offer and offer.browser_family != parsed_ua.browser.family:
+        elif offer and offer.browser_family != parsed_ua.browser_family:
             log.log(
                 self.log_level,
                 "Mismatched browser between offer and impression. Publisher: [%s], Offer Browser: [%s], User agent: [%s]",
@@ -1328,7 +1335,8 @@ class BaseProxyView(View):
             # Note: this does not set a reason so it only logs mismatches
 
         # This is out of the elif block and will be run everytime
-        if offer and offer.ip != anonymize_ip_address(ip_address):
+        # Offers from signed nonces don't have an IP
+        if offer and offer.ip and offer.ip != anonymize_ip_address(ip_address):
             # Because this block doesn't set a reason, it will only log mismatches. Not stop them.
             log.log(
                 self.log_level,
@@ -1339,22 +1347,49 @@ class BaseProxyView(View):
 
         return reason
 
-    def get_offer(self, nonce):
+    def needs_offer_details(self, publisher):
+        """Whether tracking this impression needs more of the offer than a signed nonce has."""
+        return self.impression_type == CLICKS or (
+            settings.ADSERVER_RECORD_VIEWS or publisher.record_views
+        )
+
+    def get_offer(self, nonce, advertisement_id=None):
+        payload = load_nonce(nonce)
+        if payload:
+            if payload.advertisement_id != advertisement_id:
+                log.debug("Signed nonce for a different ad. nonce=%s", nonce)
+                return None
+
+            offer = get_nonce_offer(payload)
+            if offer.publisher and not self.needs_offer_details(offer.publisher):
+                return offer
+            nonce = payload.offer_id
+
         try:
-            offer = Offer.objects.get(id=nonce)
+            # Offers may not be written to the database yet (see ``offerbuffer``)
+            offer = get_pending_offer(nonce) or Offer.objects.get(id=nonce)
         except (ValidationError, Offer.DoesNotExist) as exception:
             log.debug("Invalid Offer. exception=%s", exception)
-            offer = None
+            return None
 
+        if is_signed_nonces_enabled():
+            # Uses of the nonce may not be written to the offer yet
+            apply_claims(offer)
         return offer
 
     def handle_action(self, request, advertisement, offer, publisher):
         """Handle the view or click and return a reason if it was ignored."""
         ignore_reason = self.ignore_tracking_reason(request, advertisement, offer)
 
+        if not ignore_reason and not advertisement.invalidate_nonce(
+            self.impression_type, offer.pk
+        ):
+            # Another request used this nonce since it was checked
+            log.log(self.log_level, "Old or nonexistent impression nonce")
+            ignore_reason = "Old/Invalid nonce"
+
         if not ignore_reason:
             log.log(self.log_level, self.success_message)
-            advertisement.invalidate_nonce(self.impression_type, offer.pk)
             advertisement.track_impression(
                 request, self.impression_type, publisher=publisher, offer=offer
             )
@@ -1365,12 +1400,18 @@ class BaseProxyView(View):
             if self.impression_type == VIEWS and advertisement.flight.cpm:
                 publisher.increment_daily_earn(float(advertisement.flight.cpm) / 1000)
 
+            # Count this user's views of the flight for its frequency cap
+            if self.impression_type == VIEWS and advertisement.flight.frequency_cap:
+                record_frequency(
+                    offer.client_id or get_client_id(request), advertisement.flight
+                )
+
         return ignore_reason
 
     def get(self, request, advertisement_id, nonce):
         """Handles proxying ad views and clicks and collecting metrics on them."""
         advertisement = get_object_or_404(Advertisement, pk=advertisement_id)
-        offer = self.get_offer(nonce)
+        offer = self.get_offer(nonce, advertisement_id=advertisement.pk)
         publisher = None
 
         if offer:
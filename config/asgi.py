@@ -0,0 +1,18 @@
+"""
+ASGI config for adserver project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+This is only needed to serve the async ad decision API (``/api/v1/decision/async/``).
+
+For more information on this file, see
+https://docs.djangoproject.com/en/dev/howto/deployment/asgi/
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
+
+application = get_asgi_application()
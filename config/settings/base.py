@@ -167,7 +167,19 @@ DEFAULT_AUTO_FIELD = "django.db.models.AutoField"
 # ```
 # * Then backup & truncate the old offers table:
 # django-admin archive_offers --start-date 2021-11-01 --end-date 2022-07-01
+#
+# Alternatively, roll to a partitioned Offer table (see adserver/partitions.py) once
+# and archiving drops partitions rather than deleting offers:
+# django-admin partition_offers --create-table adserver_offer_partitioned
 ADSERVER_OFFER_DB_TABLE = env("ADSERVER_OFFER_DB_TABLE", default=None)
+# Partitions of a partitioned Offer table hold a "day" or "month" of offers
+ADSERVER_OFFER_PARTITION_INTERVAL = env(
+    "ADSERVER_OFFER_PARTITION_INTERVAL", default="month"
+)
+# How many partitions (including the current one) are created ahead of time
+ADSERVER_OFFER_PARTITIONS_PREMAKE = env.int(
+    "ADSERVER_OFFER_PARTITIONS_PREMAKE", default=3
+)
 
 
 # Add support for a read replica, mostly used in reporting.
@@ -213,6 +225,8 @@ CACHES = {
     CACHE_LOCAL_ALIAS: {
         "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
         "LOCATION": "fast-local",
+        # Least recently used entries are removed when full
+        "OPTIONS": {"MAX_ENTRIES": 10_000},
     },
 }
 
@@ -610,8 +624,54 @@ ADSERVER_ASN_RATELIMITS = env.list("ADSERVER_ASN_RATELIMITS", default=[])
 ADSERVER_MINIMUM_PAYOUT = env.int("ADSERVER_MINIMUM_PAYOUT", default=50)
 # Recording views is highly discouraged in production but useful in development
 ADSERVER_RECORD_VIEWS = True
+# Insert offers in batches in the background rather than during ad decisions
+ADSERVER_OFFER_WRITE_BEHIND = env.bool("ADSERVER_OFFER_WRITE_BEHIND", default=False)
+ADSERVER_OFFER_BUFFER_BATCH_SIZE = env.int(
+    "ADSERVER_OFFER_BUFFER_BATCH_SIZE", default=1000
+)
+ADSERVER_IMPRESSION_COUNTERS = env.bool("ADSERVER_IMPRESSION_COUNTERS", default=False)
+ADSERVER_IMPRESSION_COUNTERS_BATCH_SIZE = env.int(
+    "ADSERVER_IMPRESSION_COUNTERS_BATCH_SIZE", default=1000
+)
+ADSERVER_NULL_OFFER_AGGREGATION = env.bool(
+    "ADSERVER_NULL_OFFER_AGGREGATION", default=False
+)
+ADSERVER_NULL_OFFER_SAMPLE_RATE = env.float(
+    "ADSERVER_NULL_OFFER_SAMPLE_RATE", default=0.01
+)
+ADSERVER_NULL_OFFER_BATCH_SIZE = env.int("ADSERVER_NULL_OFFER_BATCH_SIZE", default=1000)
+ADSERVER_SIGNED_NONCES = env.bool("ADSERVER_SIGNED_NONCES", default=False)
 ADSERVER_HTTPS = False  # Should be True in most production setups
 ADSERVER_STICKY_DECISION_DURATION = 0
+# How often (seconds) flight pacing is precomputed for the decision engine
+ADSERVER_PACING_SNAPSHOT_INTERVAL = env.int(
+    "ADSERVER_PACING_SNAPSHOT_INTERVAL", default=60
+)
+# The fraction of ad decisions to trace (0-1). Staff can also request a trace
+ADSERVER_DECISION_TRACE_SAMPLE_RATE = env.float(
+    "ADSERVER_DECISION_TRACE_SAMPLE_RATE", default=0.0
+)
+# Seconds an ad decision may take before optional stages are skipped (0 for no limit)
+ADSERVER_DECISION_TIME_BUDGET = env.float("ADSERVER_DECISION_TIME_BUDGET", default=0.0)
+# Seconds to remember requests that no paid, affiliate or community flight can match
+ADSERVER_DECISION_NEGATIVE_CACHE_TIMEOUT = env.int(
+    "ADSERVER_DECISION_NEGATIVE_CACHE_TIMEOUT", default=60
+)
+# A second decision backend compared against the main one on a fraction of decisions
+ADSERVER_DECISION_SHADOW_BACKEND = env("ADSERVER_DECISION_SHADOW_BACKEND", default=None)
+ADSERVER_DECISION_SHADOW_SAMPLE_RATE = env.float(
+    "ADSERVER_DECISION_SHADOW_SAMPLE_RATE", default=0.0
+)
+# Counters per row of each capped flight's daily frequency sketch (memory is fixed)
+ADSERVER_FREQUENCY_CAP_SKETCH_WIDTH = env.int(
+    "ADSERVER_FREQUENCY_CAP_SKETCH_WIDTH", default=2**16
+)
+# Local index of flight niche and ad embeddings (see adserver.decisionengine.embeddings)
+ADSERVER_EMBEDDING_INDEX_BACKEND = env(
+    "ADSERVER_EMBEDDING_INDEX_BACKEND",
+    default="adserver.decisionengine.embeddings.NumpyEmbeddingIndex",
+)
+ADSERVER_EMBEDDING_INDEX_LOADER = env("ADSERVER_EMBEDDING_INDEX_LOADER", default=None)
 
 # For customer support emails
 ADSERVER_SUPPORT_TO_EMAIL = env("ADSERVER_SUPPORT_TO_EMAIL", default=None)
@@ -240,6 +240,10 @@ CELERY_BEAT_SCHEDULE = {
         "task": "adserver.tasks.notify_of_daily_traffic_spikes",
         "schedule": crontab(hour="3", minute="15"),
     },
+    "every-day-create-offer-partitions": {
+        "task": "adserver.tasks.create_offer_partitions",
+        "schedule": crontab(hour="2", minute="45"),
+    },
     "every-week-notify-publisher-changes": {
         "task": "adserver.tasks.notify_of_publisher_changes",
         # Runs on Wednesday
@@ -268,6 +272,38 @@ CELERY_BEAT_SCHEDULE = {
         "task": "adserver.tasks.refresh_flight_denormalized_totals",
         "schedule": crontab(minute="*/5"),  # Every 5 minutes
     },
+    "frequent-reconcile-flight-daily-impressions": {
+        "task": "adserver.tasks.reconcile_flight_daily_impressions",
+        "schedule": crontab(minute="*/5"),
+    },
+    "frequent-refresh-flight-snapshot": {
+        "task": "adserver.tasks.refresh_flight_snapshot",
+        "schedule": crontab(minute="*/10"),
+    },
+    "frequent-refresh-pacing-snapshot": {
+        "task": "adserver.tasks.refresh_pacing_snapshot",
+        "schedule": ADSERVER_PACING_SNAPSHOT_INTERVAL,
+    },
+    "frequent-flush-offer-buffer": {
+        "task": "adserver.tasks.flush_buffered_offers",
+        "schedule": 5,  # Every 5 seconds
+    },
+    "frequent-flush-impression-counters": {
+        "task": "adserver.tasks.flush_buffered_impressions",
+        "schedule": 5,  # Every 5 seconds
+    },
+    "frequent-flush-nonce-updates": {
+        "task": "adserver.tasks.flush_nonce_updates",
+        "schedule": 5,  # Every 5 seconds
+    },
+    "frequent-flush-null-offers": {
+        "task": "adserver.tasks.flush_buffered_null_offers",
+        "schedule": crontab(minute="*"),
+    },
+    "frequent-refresh-embedding-index": {
+        "task": "adserver.tasks.refresh_embedding_index",
+        "schedule": crontab(minute="*/30"),
+    },
     # Run publisher importers daily
     "every-day-sync-publisher-data": {
         "task": "adserver.tasks.run_publisher_importers",
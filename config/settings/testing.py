@@ -51,6 +51,10 @@ CACHES["default"] = {
     "LOCATION": "",
 }
 
+# Requests remembered as having no inventory are only forgotten after a commit
+# so they would leak between tests (see ``adserver.decisionengine.inventory``)
+ADSERVER_DECISION_NEGATIVE_CACHE_TIMEOUT = 0
+
 # Celery should be always eager - there's no distributed celery workers in test
 CELERY_TASK_ALWAYS_EAGER = True
 